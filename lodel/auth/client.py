@@ -29,8 +29,7 @@ LodelContext.expose_modules(globals(), {
     'lodel.logger': 'logger',
     'lodel.plugin': [('SessionHandlerPlugin', 'SessionHandler')],
     'lodel.auth.exceptions': ['ClientError', 'ClientAuthenticationFailure',
-                              'ClientPermissionDenied', 'ClientAuthenticationError'],
-    'lodel.leapi.query': ['LeGetQuery'], })
+                              'ClientPermissionDenied', 'ClientAuthenticationError'], })
 
 ## @brief Client metaclass designed to implements container accessor on
 # Client Class
@@ -169,11 +168,10 @@ class Client(object, metaclass=ClientMetaclass):
                 qfilter = qfilter.format(
                     passfname=passfname,
                     passhash=password)
-            getq = LeGetQuery(infos['login'][0], qfilter,
-                              field_list=[uid_fname], limit=1)
-            req = getq.execute()
+            req = login_cls.values_list(
+                qfilter, [uid_fname], flat=True, limit=1)
             if len(req) == 1:
-                self.__set_authenticated(infos['login'][0], req[0][uid_fname])
+                self.__set_authenticated(infos['login'][0], req[0])
                 break
         if self.is_anonymous():
             self.authentication_failure()  # Security logging
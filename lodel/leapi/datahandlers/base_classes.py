@@ -48,6 +48,7 @@ LodelContext.expose_modules(globals(), {
         'ValidationError'
     ],
     'lodel.logger': 'logger',
+    'lodel.leapi.identity_map': ['LeIdentityMap'],
     'lodel.utils.mlstring': ['MlString']})
 
 ##
@@ -215,6 +216,18 @@ class DataHandler(MlNamedObject):
             return None, expt
         return value, None
 
+    ##
+    # @brief Checks a column of values (the values of a field in many
+    # records)
+    #
+    # Child classes override it with checks specialized for their type,
+    # results are the same as the check_data_value() ones.
+    # @param values list
+    # @return a list of tuples (value|None, None|error) (see
+    # check_data_value() )
+    def check_data_values(self, values):
+        return [self.check_data_value(value) for value in values]
+
     ##
     # @brief Checks if this class can override the given data handler.
     #        i.e. both class having the same base_type.  
@@ -227,6 +240,16 @@ class DataHandler(MlNamedObject):
         return True
 
 
+    ##
+    # @brief Returns the names of the fields the constructed value depends on
+    #
+    # Used to compute the fields construction order (see
+    # @ref construct_order() )
+    # @return a tuple of field names, or None if the value has to be
+    # constructed again whenever a field is modified
+    def construct_dependencies(self):
+        return ()
+
     ##
     # @brief Build field value
     #
@@ -447,7 +470,8 @@ class Reference(DataHandler):
     #                mentions what that means, and nothing seems to be aware
     #                of an 'automatic' value (at least not in leapi package)
     def __init__(self, allowed_classes=None, back_reference=None, internal=False, **kwargs):
-        self.__allowed_classes = set() if allowed_classes is None else set(allowed_classes)
+        self.__allowed_classes = frozenset() if allowed_classes is None \
+            else frozenset(allowed_classes)
         ##
         # @note what is "useful to Jinja 2"?
         # For now useful to jinja 2
@@ -462,6 +486,7 @@ class Reference(DataHandler):
             # or not isinstance(back_reference[1], str):
             # raise TypeError("Back reference was expected to be a tuple(<class LeObject>, str)
             # but got : (%s, %s)" % (back_reference[0], back_reference[1]))
+            back_reference = tuple(back_reference)
         self.__back_reference = back_reference
         super().__init__(internal=internal, **kwargs)
 
@@ -476,10 +501,11 @@ class Reference(DataHandler):
 
 
     ##
-    # @brief Property that takes value of a copy of the back_reference tuple
+    # @brief Property that takes value of the back_reference tuple
+    # @return a (LeObject child class, fieldname) tuple or None
     @property
     def back_reference(self):
-        return copy.copy(self.__back_reference)
+        return self.__back_reference
 
 
     ##
@@ -491,14 +517,19 @@ class Reference(DataHandler):
             return None
         return self.__back_reference[0].data_handler(self.__back_reference[1])
 
+    ##
+    # @brief Property that takes value of the allowed classes
+    # @return a frozenset of LeObject child classes
     @property
     def linked_classes(self):
-        return copy.copy(self.__allowed_classes)
+        return self.__allowed_classes
 
 
     ##
     # @brief Sets a back reference.
     def _set_back_reference(self, back_reference):
+        if back_reference is not None:
+            back_reference = tuple(back_reference)
         self.__back_reference = back_reference
 
 
@@ -670,12 +701,25 @@ class MultipleRef(Reference):
     # @return A list of LeObject child class instance
     # @throw LodelDataHandlerConsistencyException if some referenced objects
     # were not found
+    # @note objects stored in the opened identity map are not fetched again
+    # (see @ref lodel.leapi.identity_map)
     def get_referenced(self, values):
         if values is None or len(values) == 0:
             return list()
         left = set(values)
         values = set(values)
         res = list()
+        imap = LeIdentityMap.current()
+        if imap is not None:
+            for value in values:
+                for leo_cls in self.linked_classes:
+                    leo = imap.lookup(leo_cls, value)
+                    if leo is not None:
+                        res.append(leo)
+                        left.discard(value)
+                        break
+            if len(left) == 0:
+                return res
         for leo_cls in self.linked_classes:
             uidname = leo_cls.uid_fieldname()[0]  # MULTIPLE UID BROKEN HERE
             tmp_res = leo_cls.get(('%s in (%s)' % (uidname, ','.join(
@@ -711,10 +755,10 @@ class DatasConstructor(object):
         self._datas = copy.copy(datas)
         # Stores fieldtypes
         self._fields_handler = fields_handler
-        # Stores list of fieldname for constructed 
-        self._constructed = []
-        # Stores construct calls list
-        self._construct_calls = []
+        # Stores the names of the constructed fields
+        self._constructed = set()
+        # Stores the names of the fields being constructed
+        self._construct_calls = set()
 
 
     ##
@@ -738,9 +782,13 @@ class DatasConstructor(object):
             if fname in self._construct_calls:
                 raise RuntimeError('Probably circular dependencies in fieldtypes')
             cur_value = self._datas[fname] if fname in self._datas else None
-            self._datas[fname] = self._fields_handler[fname].construct_data(
-                self._leobject, fname, self, cur_value)
-            self._constructed.append(fname)
+            self._construct_calls.add(fname)
+            try:
+                self._datas[fname] = self._fields_handler[fname].construct_data(
+                    self._leobject, fname, self, cur_value)
+            finally:
+                self._construct_calls.discard(fname)
+            self._constructed.add(fname)
         return self._datas[fname]
 
 
@@ -755,6 +803,60 @@ class DatasConstructor(object):
         warnings.warn("Setting value of an DatasConstructor instance")
 
 
+## @brief Computes the fields construction order
+#
+# The fields a field construction depends on (see
+# DataHandler.construct_dependencies() ) are placed before it, the other
+# fields keep their order.
+# @param fields dict : data handlers indexed by field names
+# @return a tuple of field names
+# @throw RuntimeError if there are circular dependencies
+def construct_order(fields):
+    order = list()
+    # False while the field dependencies are visited, True once placed
+    visited = dict()
+
+    def visit(fname):
+        if visited.get(fname) is True:
+            return
+        if fname in visited:
+            raise RuntimeError(
+                "Circular dependencies in fields construction : %s" % fname)
+        visited[fname] = False
+        for dep in fields[fname].construct_dependencies() or ():
+            if dep in fields:
+                visit(dep)
+        visited[fname] = True
+        order.append(fname)
+
+    for fname in fields:
+        visit(fname)
+    return tuple(order)
+
+
+## @brief Computes the fields to construct again when a field is modified
+# @param fields dict : data handlers indexed by field names
+# @param order tuple : the fields construction order (see construct_order())
+# @return a dict with field names as keys and tuples of the fields downstream
+# of them (in construction order) as values
+def construct_downstream(fields, order):
+    res = dict()
+    for fname in order:
+        changed = {fname}
+        downstream = list()
+        # Dependencies come first in order : one pass gives the transitive
+        # dependents
+        for other in order:
+            if other == fname:
+                continue
+            deps = fields[other].construct_dependencies()
+            if deps is None or not changed.isdisjoint(deps):
+                changed.add(other)
+                downstream.append(other)
+        res[fname] = tuple(downstream)
+    return res
+
+
 ##
 # @brief Class designed to handle a DataHandler option
 class DatahandlerOption(MlNamedObject):
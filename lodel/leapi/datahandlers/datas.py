@@ -66,6 +66,10 @@ class FormatString(Varchar):
             ret = ret[:self.max_length]
         return ret
 
+    ## @return the names of the formatted fields
+    def construct_dependencies(self):
+        return tuple(self._field_list)
+
 
 ## @brief Varchar validated by a regex
 class Regex(Varchar):
@@ -94,6 +98,21 @@ max_length and regex'
             raise FieldValidationError(msg)
         return value
 
+    ## @brief Checks a column of values, matching strings are accepted
+    # without exception handling
+    # @param values list
+    # @return a list of tuples (value|None, None|error)
+    def check_data_values(self, values):
+        if type(self)._check_data_value is not Regex._check_data_value:
+            return super().check_data_values(values)
+        max_length = self.max_length
+        match = self.compiled_re.match
+        return [(value, None)
+                if type(value) is str and len(value) <= max_length
+                and match(value)
+                else self.check_data_value(value)
+                for value in values]
+
     ## @brief checks if another datahandler can override this one
     #
     # @param data_handler Datahandler
@@ -129,8 +148,9 @@ class UniqID(Integer):
     # @remarks fname and datas are not used and should become non mandatory, cur_value should have a None default value
     def construct_data(self, emcomponent, fname, datas, cur_value):
         if cur_value is None:
-            #Ask datasource to provide a new uniqID
-            return emcomponent._ro_datasource.new_numeric_id(emcomponent)
+            # Ask datasource to provide a new uniqID, ids are reserved by the
+            # read write datasource
+            return emcomponent._rw_datasource.new_numeric_id(emcomponent)
         return cur_value
 
 
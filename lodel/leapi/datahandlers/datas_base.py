@@ -25,6 +25,11 @@ import time
 import os
 from lodel.context import LodelContext
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 LodelContext.expose_modules(globals(), {
     'lodel.leapi.datahandlers.base_classes': ['DataField'],
@@ -91,6 +96,37 @@ class Integer(DataField):
             raise FieldValidationError("The value '%s' is not an integer nor could be cast to." % value)
         return value
 
+    ##
+    # @brief Checks and casts a column of values
+    #
+    # With numpy the whole column is cast at once if it only contains finite
+    # numbers or numeric strings. Else python integers are accepted as is
+    # and other values are checked one by one.
+    # @param values list
+    # @return a list of tuples (value|None, None|error)
+    def check_data_values(self, values):
+        if type(self)._check_data_value is not Integer._check_data_value:
+            return super().check_data_values(values)
+        if numpy is not None and len(values) > 0:
+            try:
+                floats = numpy.array(values, dtype=numpy.float64)
+            except (ValueError, TypeError, OverflowError):
+                floats = None
+            # None values give NaN : they are checked one by one
+            if floats is not None and floats.ndim == 1 \
+                    and numpy.isfinite(floats).all() \
+                    and (numpy.abs(floats) < 2 ** 63).all():
+                return [(value, None)
+                        for value in floats.astype(numpy.int64).tolist()]
+        res = list()
+        for value in values:
+            # int(float(value)) == value for these integers
+            if type(value) is int and -2 ** 53 <= value <= 2 ** 53:
+                res.append((value, None))
+            else:
+                res.append(self.check_data_value(value))
+        return res
+
 
 ##
 # @brief Data field designed to handle string
@@ -133,6 +169,20 @@ class Varchar(DataField):
             raise FieldValidationError("The value '%s' is longer than the maximum length of this field (%s)" % (value, self.max_length))
         return value
 
+    ##
+    # @brief Checks a column of values, valid strings are accepted without
+    # exception handling
+    # @param values list
+    # @return a list of tuples (value|None, None|error)
+    def check_data_values(self, values):
+        if type(self)._check_data_value is not Varchar._check_data_value:
+            return super().check_data_values(values)
+        max_length = self.max_length
+        return [(value, None)
+                if type(value) is str and len(value) <= max_length
+                else self.check_data_value(value)
+                for value in values]
+
 
 ##
 # @brief Data field designed to handle date & time
@@ -173,11 +223,34 @@ class DateTime(DataField):
             raise FieldValidationError("Tue value has to be a string or a datetime")
         return value
 
+    ##
+    # @brief Checks a column of values, each distinct string is parsed once
+    # @param values list
+    # @return a list of tuples (value|None, None|error)
+    def check_data_values(self, values):
+        if type(self)._check_data_value is not DateTime._check_data_value:
+            return super().check_data_values(values)
+        parsed = dict()
+        res = list()
+        for value in values:
+            if type(value) is str:
+                if value not in parsed:
+                    parsed[value] = self.check_data_value(value)
+                res.append(parsed[value])
+            else:
+                res.append(self.check_data_value(value))
+        return res
+
     def _construct_data(self, emcomponent, fname, datas, cur_value):
         if (self.now_on_create and cur_value is None) or self.now_on_update:
             return datetime.datetime.now()
         return cur_value
 
+    ## @return None if the date is set on update (it depends on all the
+    # fields) else an empty tuple
+    def construct_dependencies(self):
+        return None if self.now_on_update else ()
+
 
 ##
 # @brief Data field designed to handle long string
@@ -0,0 +1,125 @@
+#
+# This file is part of Lodel 2 (https://github.com/OpenEdition)
+#
+# Copyright (C) 2015-2017 Cléo UMS-3287
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+## @package lodel.leapi.identity_map
+# This module defines the LeIdentityMap class, a scoped cache of fetched
+# LeObject instances indexed by class and uid.
+#
+# An identity map is opened at the beginning of a unit of work (a web request
+# for example) and closed at its end :
+#<pre>LeIdentityMap.open()
+#try:
+#    obj = Person.get_from_uid(42) # query
+#    obj = Person.get_from_uid(42) # no query, same instance
+#finally:
+#    LeIdentityMap.close()</pre>
+#
+# When no identity map is opened nothing is cached. Any write query
+# (insert, update or delete) clears the opened identity map, because
+# back references may modify records that are not targeted by the query.
+
+import threading
+
+
+## @brief Scoped cache of LeObject instances indexed by (class, uid)
+#
+# Identity maps are stored in a per thread stack : open() and close() calls
+# can be nested, only the last opened identity map is used.
+class LeIdentityMap(object):
+
+    ## @brief Per thread stack of opened identity maps
+    _local = threading.local()
+
+    def __init__(self):
+        ## @brief LeObject instances indexed by (class, uid) tuples. An
+        # instance is stored once for its class and once for each of its
+        # parent classes
+        self.__objects = dict()
+        ## @brief Number of lookups that found an instance
+        self.hits = 0
+        ## @brief Number of lookups that found nothing
+        self.misses = 0
+
+    ## @brief Opens a new identity map for the current thread
+    # @return the opened LeIdentityMap instance
+    @classmethod
+    def open(cls):
+        imap = cls()
+        cls.__stack().append(imap)
+        return imap
+
+    ## @brief Closes the last identity map opened in the current thread
+    # @return the closed LeIdentityMap instance or None if no identity map
+    # was opened
+    @classmethod
+    def close(cls):
+        stack = cls.__stack()
+        if len(stack) == 0:
+            return None
+        imap = stack.pop()
+        imap.clear()
+        return imap
+
+    ## @brief Returns the identity map in use in the current thread
+    # @return a LeIdentityMap instance or None if no identity map is opened
+    @classmethod
+    def current(cls):
+        stack = cls.__stack()
+        return stack[-1] if len(stack) > 0 else None
+
+    ## @brief Clears the identity map in use in the current thread (if any)
+    @classmethod
+    def invalidate(cls):
+        imap = cls.current()
+        if imap is not None:
+            imap.clear()
+
+    ## @return the current thread identity maps stack
+    @classmethod
+    def __stack(cls):
+        if not hasattr(cls._local, 'stack'):
+            cls._local.stack = list()
+        return cls._local.stack
+
+    ## @brief Looks for an instance
+    # @param leo_cls LeObject child class : the expected class (abstract
+    # classes are allowed)
+    # @param uid * : the instance uid
+    # @return a LeObject child class instance or None if not found
+    def lookup(self, leo_cls, uid):
+        res = self.__objects.get((leo_cls, uid), None)
+        if res is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return res
+
+    ## @brief Stores an instance
+    # @param leo LeObject child class instance fetched with all its fields
+    def add(self, leo):
+        uid = leo.uid()
+        for leo_cls in leo.hierarch():
+            self.__objects[(leo_cls, uid)] = leo
+
+    ## @brief Removes all the stored instances
+    def clear(self):
+        self.__objects.clear()
+
+    def __len__(self):
+        return len(set(id(leo) for leo in self.__objects.values()))
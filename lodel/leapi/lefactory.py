@@ -28,7 +28,8 @@ LodelContext.expose_modules(globals(), {
     'lodel.editorial_model.components': ['EmComponent', 'EmClass', 'EmField',
                                          'EmGroup'],
     'lodel.leapi.leobject': ['LeObject'],
-    'lodel.leapi.datahandlers.base_classes': ['DataHandler'],
+    'lodel.leapi.datahandlers.base_classes': ['DataHandler',
+                                              'construct_order'],
     'lodel.logger': 'logger'})
 
 ## @brief Generates python module code from a given model
@@ -159,6 +160,8 @@ def generate_classes(model):
     res = ""
 
     bootstrap = ""
+    # Metadata tables are built once all the classes are bootstraped
+    metadata_bootstrap = ""
     # Generating field list for LeObjects generated from EmClass
     for em_class in get_classes(model):
         logger.info("Generating a dynamic class for %s" % em_class.uid)
@@ -175,10 +178,19 @@ def generate_classes(model):
         else:
             parents.append('LeObject')
         datasource_name = em_class.datasource
+        # Field names tables (see LeObject._set__metadata())
+        fieldnames = tuple(field.uid for field in em_class.fields())
+        writable_fieldnames = tuple(
+            field.uid for field in em_class.fields()
+            if not field.data_handler_instance.is_internal())
+        fields_construct_order = construct_order(
+            {field.uid: field.data_handler_instance
+             for field in em_class.fields()})
 
         # Dynamic code generation for LeObject child classes
         em_cls_code = """
 class {clsname}({parents}):
+    __slots__ = ()
     _abstract = {abstract}
     _fields = None
     _uid = {uid_list}
@@ -186,6 +198,9 @@ class {clsname}({parents}):
     _rw_datasource = None
     _datasource_name = {datasource_name}
     _child_classes = None
+    _fieldnames_all = {fieldnames}
+    _fieldnames_writable = {writable_fieldnames}
+    _construct_order = {construct_order}
 
 """.format(
             clsname=LeObject.name2objname(em_class.uid),
@@ -193,10 +208,14 @@ class {clsname}({parents}):
             abstract='True' if em_class.abstract else 'False',
             uid_list=repr(uid),
             datasource_name=repr(datasource_name),
+            fieldnames=repr(fieldnames),
+            writable_fieldnames=repr(writable_fieldnames),
+            construct_order=repr(fields_construct_order),
         )
         res += em_cls_code
         # Dyncode fields bootstrap instructions
-        child_classes = model.get_class_childs(em_class.uid)
+        child_classes = sorted(
+            model.get_class_childs(em_class.uid), key=lambda emcls: emcls.uid)
         if len(child_classes) == 0:
             child_classes = 'tuple()'
         else:
@@ -210,5 +229,8 @@ class {clsname}({parents}):
                                                      data_handler_constructor(emfield)) for emfield in em_class.fields()])) + '}',
             child_classes=child_classes,
         )
+        metadata_bootstrap += "%s._set__metadata()\n" % (
+            LeObject.name2objname(em_class.uid))
+    bootstrap += metadata_bootstrap
     bootstrap += "\n"
     return res, bootstrap
@@ -34,6 +34,11 @@ def name2class(name):
     return dynclasses_dict[name]
 
 
+##@brief Gives the dynamic classes table to LeObject.name2class()
+for _dyncls in dynclasses:
+    _dyncls._dynclasses = dynclasses_dict
+
+
 ##@brief Returns a dynamically generated class given its name
 #@note Case insensitive version of name2class
 #@param name str
@@ -23,7 +23,8 @@
 
 import importlib
 import warnings
-import copy
+import sys
+import types
 
 from lodel.context import LodelContext
 
@@ -32,7 +33,9 @@ LodelContext.expose_modules(globals(), {
     'lodel.settings': 'Settings',
     'lodel.settings.utils': 'SettingsError',
     'lodel.leapi.query': ['LeInsertQuery', 'LeUpdateQuery', 'LeDeleteQuery',
-                          'LeGetQuery'],
+                          'LeGetQuery', 'LeCountQuery', 'LeAggregateQuery',
+                          'LeQueryFilter', 'LeQueryParam',
+                          'LeCompiledFilters'],
     'lodel.leapi.exceptions': ['LeApiError', 'LeApiErrors',
                                'LeApiDataCheckError', 'LeApiDataCheckErrors', 'LeApiQueryError',
                                'LeApiQueryErrors'],
@@ -41,7 +44,11 @@ LodelContext.expose_modules(globals(), {
     'lodel.exceptions': ['LodelFatalError'],
     'lodel.plugin.hooks': ['LodelHook'],
     'lodel.plugin': ['Plugin', 'DatasourcePlugin'],
-    'lodel.leapi.datahandlers.base_classes': ['DatasConstructor', 'Reference']})
+    'lodel.leapi.identity_map': ['LeIdentityMap'],
+    'lodel.leapi.session': ['LeSession'],
+    'lodel.leapi.datahandlers.base_classes': [
+        'DatasConstructor', 'Reference', 'construct_order',
+        'construct_downstream']})
 
 ## @brief Stores the name of the field present in each LeObject that indicates the name of LeObject subclass represented by this object
 CLASS_ID_FIELDNAME = "classname"
@@ -78,9 +85,113 @@ class LeObjectValues(object):
         return setter(fname, fval)
 
 
+## @brief Immutable per class metadata tables
+#
+# Built once per LeObject child class by LeObject._set__metadata() (called at
+# the end of the dynamic code bootstrap) and returned as is by the LeObject
+# accessors : field names are tuples, field dicts are read only
+# mappingproxy views and class sets are frozensets.
+class LeObjectMetadata(object):
+
+    __slots__ = ('fieldnames', 'writable_fieldnames', 'internal_fieldnames',
+                 'fieldnames_set', 'writable_fieldnames_set',
+                 'mandatory_fieldnames_set',
+                 'writable_mandatory_fieldnames_set', 'fields',
+                 'writable_fields', 'reference_handlers',
+                 'backref_handlers', 'backref_fieldnames', 'hierarch',
+                 'child_classes', 'descendants', 'uid_source',
+                 'construct_order', 'construct_downstream')
+
+    ##
+    # @param leo_cls LeObject child class
+    def __init__(self, leo_cls):
+        fields = leo_cls._fields
+        # Names tables are emitted by lefactory, computed from the data
+        # handlers for classes that are not generated
+        if '_fieldnames_all' in leo_cls.__dict__:
+            fieldnames = tuple(leo_cls._fieldnames_all)
+            writable = tuple(leo_cls._fieldnames_writable)
+        else:
+            fieldnames = tuple(fields)
+            writable = tuple(
+                fname for fname in fieldnames
+                if not fields[fname].is_internal())
+        if '_construct_order' in leo_cls.__dict__:
+            construct = tuple(leo_cls._construct_order)
+        else:
+            construct = construct_order(fields)
+        self.fieldnames = fieldnames
+        self.writable_fieldnames = writable
+        self.fieldnames_set = frozenset(fieldnames)
+        self.writable_fieldnames_set = frozenset(writable)
+        self.internal_fieldnames = tuple(
+            fname for fname in fieldnames
+            if fname not in self.writable_fieldnames_set)
+        # Fields without default value are mandatory for complete datas
+        self.mandatory_fieldnames_set = frozenset(
+            fname for fname in fieldnames
+            if not hasattr(fields[fname], 'default'))
+        self.writable_mandatory_fieldnames_set = \
+            self.mandatory_fieldnames_set & self.writable_fieldnames_set
+        self.fields = types.MappingProxyType(
+            {fname: fields[fname] for fname in fieldnames})
+        self.writable_fields = types.MappingProxyType(
+            {fname: fields[fname] for fname in writable})
+        self.reference_handlers = types.MappingProxyType(
+            {fname: fdh for fname, fdh in self.fields.items()
+             if fdh.is_reference()})
+        self.backref_handlers = types.MappingProxyType(
+            {fname: fdh for fname, fdh in self.reference_handlers.items()
+             if fdh.back_reference is not None})
+        self.backref_fieldnames = frozenset(self.backref_handlers)
+        hierarch = [leo_cls]
+        cur = leo_cls
+        while True:
+            cur = cur.__bases__[0]  # Multiple inheritance broken HERE
+            if cur in (LeObject, object):
+                break
+            hierarch.append(cur)
+        self.hierarch = tuple(hierarch)
+        self.child_classes = tuple(leo_cls._child_classes or ())
+        self.descendants = frozenset(self.child_classes)
+        self.uid_source = self.__uid_source(leo_cls, self.hierarch)
+        # Fields in construction order and, for each field, the fields to
+        # construct again when it is modified
+        self.construct_order = construct
+        self.construct_downstream = types.MappingProxyType(
+            construct_downstream(fields, construct))
+
+    ## @brief Returns the parent class that defines the unique id
+    # @param leo_cls LeObject child class
+    # @param hierarch tuple : leo_cls and its parents classes
+    # @return a LeObject child class or False if no UID defined
+    @staticmethod
+    def __uid_source(leo_cls, hierarch):
+        if leo_cls._uid is None or len(leo_cls._uid) == 0:
+            return False
+        prev = hierarch[0]
+        uid_handlers = set(leo_cls._fields[name] for name in leo_cls._uid)
+        for pcls in hierarch[1:]:
+            puid_handlers = set(leo_cls._fields[name] for name in pcls._uid)
+            if set(pcls._uid) != set(prev._uid) \
+                    or puid_handlers != uid_handlers:
+                break
+            prev = pcls
+        return prev
+
+
 ## @brief Represents a handled object in Lodel.
 class LeObject(object):
 
+    ## @brief Instances attributes
+    #
+    # Instances have no __dict__ (dynamic code classes declare empty
+    # __slots__) : an instance only holds its datas dict
+    # @warning setting an attribute that is not declared here raises an
+    # AttributeError
+    __slots__ = ('__datas', '__initialized', '__is_initialized',
+                 '__referenced', '__values', '__weakref__')
+
     ## @brief boolean that tells if an object is abtract or not
     _abstract = None
     ## @brief A dict that stores DataHandler instances indexed by field name
@@ -93,24 +204,67 @@ class LeObject(object):
     _rw_datasource = None
     ## @brief Store the list of child classes
     _child_classes = None
+    ## @brief Tuple of all the field names, emitted by lefactory
+    _fieldnames_all = None
+    ## @brief Tuple of the non internal field names, emitted by lefactory
+    _fieldnames_writable = None
+    ## @brief Tuple of the field names in construction order, emitted by
+    # lefactory
+    _construct_order = None
     ## @brief Name of the datasource plugin
     _datasource_name = None
+    ## @brief Compiled get_from_uid() filters indexed by class
+    _uid_filters = dict()
+    ## @brief Dynamic code classes indexed by name, set by the dynamic code
+    # (see name2class() )
+    _dynclasses = None
 
     def __new__(cls, **kwargs):
+        return cls._hydrate(kwargs)
+
+    ## @brief Instanciates a LeObject from a datasource record
+    #
+    # Values are trusted : no check is done. This is the constructor used
+    # for query results (see LeObject.get() )
+    # @note The instance is initialized if datas contain at least the uid
+    # and all the non internal fields. Datas containing internal fields too
+    # (complete datasource records) give initialized instances.
+    # @param datas dict : field values indexed by field names
+    # @return a cls instance
+    @classmethod
+    def _hydrate(cls, datas):
+        empty_datas, expected_fields = cls._hydration_table()
         self = object.__new__(cls)
         ## @brief A dict that stores fieldvalues indexed by fieldname
-        self.__datas = {fname: None for fname in self._fields}
-        ## @brief Store a list of initianilized fields when instanciation not complete else store True
-        self.__initialized = list()
-        ## @brief Datas accessor. Instance of @ref LeObjectValues
-        self.d = LeObjectValues(self.fieldnames, self.set_data, self.data)
-        for fieldname, fieldval in kwargs.items():
-            self.__datas[fieldname] = fieldval
-            self.__initialized.append(fieldname)
-        self.__is_initialized = False
-        self.__set_initialized()
+        self.__datas = dict(empty_datas)
+        self.__datas.update(datas)
+        ## @brief Store a list of initianilized fields
+        self.__initialized = list(datas)
+        self.__is_initialized = datas.keys() >= expected_fields
+        ## @brief Referenced objects indexed by reference field name (filled
+        # by prefetch or by referenced() calls), None until needed
+        self.__referenced = None
+        ## @brief LeObjectValues accessor, None until needed (see d)
+        self.__values = None
         return self
 
+    ## @brief Returns the precomputed tables used to instanciate objects
+    #
+    # Computed once per class : a dict with all field names as keys and None
+    # as values (copied by each instance, so all the instances share the same
+    # key strings) and the set of field names needed to be fully initialized
+    # @return a tuple (dict, frozenset)
+    @classmethod
+    def _hydration_table(cls):
+        try:
+            return cls.__dict__['_hydration']
+        except KeyError:
+            table = (
+                {sys.intern(fname): None for fname in cls._fields},
+                cls._metadata().writable_fieldnames_set | frozenset(cls._uid))
+            cls._hydration = table
+            return table
+
     # @note Can be considered as EmClass instance
     # @param **kwargs
     # @throw NotImplementedError when the class being instanciated is noted as abstract and then should not be instanciated.
@@ -129,7 +283,7 @@ class LeObject(object):
             self.__initialized.append(uid_name)
 
         # Processing given fields
-        allowed_fieldnames = self.fieldnames(include_ro=False)
+        allowed_fieldnames = self._metadata().writable_fieldnames_set
         err_list = dict()
         for fieldname, fieldval in kwargs.items():
             if fieldname not in allowed_fieldnames:
@@ -157,21 +311,30 @@ class LeObject(object):
     def initialized(self):
         return self.__is_initialized
 
+    ## @brief Datas accessor. Instance of @ref LeObjectValues
+    #
+    # Built on first access and kept until the next set_data() call
+    @property
+    def d(self):
+        if self.__values is None:
+            self.__values = LeObjectValues(
+                self.fieldnames, self.set_data, self.data)
+        return self.__values
+
     ## @brief Returns the uid field name
     # @return str
     @classmethod
     def uid_fieldname(cls):
         return cls._uid
 
-    ## @brief Returns a list of fieldnames
-    # @param include_ro bool : if True includes the read only field names
-    # @return list of string
+    ## @brief Returns the field names
+    # @param include_ro bool : if True includes the read only field names
+    # @return tuple of string
     @classmethod
     def fieldnames(cls, include_ro=False):
-        if not include_ro:
-            return [fname for fname in cls._fields if not cls._fields[fname].is_internal()]
-        else:
-            return list(cls._fields.keys())
+        if include_ro:
+            return cls._metadata().fieldnames
+        return cls._metadata().writable_fieldnames
 
     ## @brief Returns a name, capitalizing the first character of each word
     # @param name str
@@ -193,13 +356,34 @@ class LeObject(object):
 
     ## @brief Returns a dictionary containing the reference datahandlers
     # @param with_backref bool : if true return only references with back_references
-    # @return dict : <code>{'fieldname': datahandler, ...}</code>
+    # @return read only dict : <code>{'fieldname': datahandler, ...}</code>
     @classmethod
     def reference_handlers(cls, with_backref=True):
-        return {fname: fdh
-                for fname, fdh in cls.fields(True).items()
-                if fdh.is_reference() and
-                (not with_backref or fdh.back_reference is not None)}
+        if with_backref:
+            return cls._metadata().backref_handlers
+        return cls._metadata().reference_handlers
+
+    ## @brief Returns the fields that prevent a set based update
+    #
+    # Updating a reference with a back reference implies to update each
+    # referenced object, and constructed fields (like Concat) have to be
+    # rebuilt from each record's values. Fields constructed on every update
+    # (like DateTime now_on_update) do not need the record values.
+    # @param fnames iterable : names of the updated fields
+    # @return a tuple (bref_fields, constructed_fields) of sets : updated
+    # fields with a back reference and fields downstream of updated fields
+    @classmethod
+    def _update_dependencies(cls, fnames):
+        metadata = cls._metadata()
+        fnames = set(fnames)
+        bref_fields = fnames & metadata.backref_fieldnames
+        constructed_fields = set()
+        for fname in fnames & metadata.fieldnames_set:
+            constructed_fields.update(metadata.construct_downstream[fname])
+        constructed_fields = {
+            fname for fname in constructed_fields
+            if cls._fields[fname].construct_dependencies() is not None}
+        return (bref_fields, constructed_fields)
 
     ## @brief Returns a LeObject child class from a name
     # @warning This method has to be called from dynamically generated LeObjects
@@ -211,6 +395,11 @@ class LeObject(object):
     def name2class(cls, leobject_name):
         if cls.__module__ == 'lodel.leapi.leobject':
             raise NotImplementedError("Abstract method")
+        if cls._dynclasses is not None:
+            try:
+                return cls._dynclasses[leobject_name]
+            except (KeyError, TypeError):
+                raise LeApiError("No LeObject named '%s'" % leobject_name)
         mod = importlib.import_module(cls.__module__)
         try:
             return getattr(mod, leobject_name)
@@ -236,56 +425,52 @@ class LeObject(object):
                                                            cls.__name__))
     ## @brief Returns the fields' datahandlers as a dictionary
     # @param include_ro bool : if True, includes the read-only fields (default value : False)
-    # @return dict
+    # @return read only dict
     @classmethod
     def fields(cls, include_ro=False):
         if include_ro:
-            return copy.copy(cls._fields)
-        else:
-            return {fname: cls._fields[fname] for fname in cls._fields\
-                    if not cls._fields[fname].is_internal()}
+            return cls._metadata().fields
+        return cls._metadata().writable_fields
 
-    ## @brief Return the list of parents classes
+    ## @brief Return the parents classes
     #
-    # @note the first item of the list is the current class, the second is its parent etc...
+    # @note the first item of the tuple is the current class, the second is its parent etc...
     # @warning multiple inheritance broken by this method
-    # @return a list of LeObject child classes
+    # @return a tuple of LeObject child classes
     # @todo multiple parent capabilities implementation
     @classmethod
     def hierarch(cls):
-        res = [cls]
-        cur = cls
-        while True:
-            cur = cur.__bases__[0]  # Multiple inheritance broken HERE
-            if cur in (LeObject, object):
-                break
-            else:
-                res.append(cur)
-        return res
+        return cls._metadata().hierarch
 
     ## @brief Returns a tuple of child classes
     # @return tuple
     @classmethod
     def child_classes(cls):
-        return copy.copy(cls._child_classes)
+        return cls._metadata().child_classes
+
+    ## @brief Returns the set of child classes (recursively)
+    # @return frozenset
+    @classmethod
+    def descendants(cls):
+        return cls._metadata().descendants
 
     ## @brief Returns the parent class that defines the unique id
     #
     # @return a LeObject child class or false if no UID defined
     @classmethod
     def uid_source(cls):
-        if cls._uid is None or len(cls._uid) == 0:
-            return False
-        hierarch = cls.hierarch()
-        prev = hierarch[0]
-        uid_handlers = set(cls._fields[name] for name in cls._uid)
-        for pcls in cls.hierarch()[1:]:
-            puid_handlers = set(cls._fields[name] for name in pcls._uid)
-            if set(pcls._uid) != set(prev._uid) \
-                    or puid_handlers != uid_handlers:
-                break
-            prev = pcls
-        return prev
+        return cls._metadata().uid_source
+
+    ## @brief Returns the class metadata tables
+    #
+    # Built once per class, see @ref LeObjectMetadata
+    # @return a LeObjectMetadata instance
+    @classmethod
+    def _metadata(cls):
+        try:
+            return cls.__dict__['_metadata_tables']
+        except KeyError:
+            return cls._set__metadata()
 
     ## @brief Initialise both datasources (ro and rw)
     #
@@ -339,6 +524,40 @@ class LeObject(object):
                 "The field %s is not initialized yet (and have no value)" % field_name)
         return self.__datas[field_name]
 
+    ## @brief Returns the objects referenced by a reference field
+    #
+    # Objects attached by a prefetch (see LeObject.get()) are returned
+    # without querying the datasource, else they are fetched using the
+    # field datahandler get_referenced() method and kept for next calls.
+    # @param fname str : reference field's name
+    # @return a LeObject child class instance for single references, a list
+    # of instances for multiple references, None if the field is empty
+    # @throw NameError if fname is not an existing field name
+    # @throw LeApiError if fname is not a reference field
+    def referenced(self, fname):
+        if self.__referenced is None:
+            self.__referenced = dict()
+        elif fname in self.__referenced:
+            return self.__referenced[fname]
+        fdh = self.data_handler(fname)
+        if not fdh.is_reference():
+            raise LeApiError("The field %s of %s is not a reference" % (
+                fname, self.__class__.__name__))
+        value = self.data(fname)
+        if value is None:
+            return None
+        res = fdh.get_referenced(value)
+        self.__referenced[fname] = res
+        return res
+
+    ## @brief Attaches referenced objects to the instance
+    # @param fname str : reference field's name
+    # @param referenced LeObject|list : referenced object(s)
+    def _set_referenced(self, fname, referenced):
+        if self.__referenced is None:
+            self.__referenced = dict()
+        self.__referenced[fname] = referenced
+
     ## @brief Returns a dictionary containing all the fields' values
     # @return dict
     def datas(self, internal=False):
@@ -353,19 +572,22 @@ class LeObject(object):
     # @throw AttributeError if the field is not writtable
     # @throw LeApiErrors if the data check generates an error
     def set_data(self, fname, fval):
-        if fname not in self.fieldnames(include_ro=False):
-            if fname not in self._fields.keys():
+        if fname not in self._metadata().writable_fieldnames_set:
+            if fname not in self._fields:
                 raise NameError("No such field in %s : %s" % (self.__class__.__name__, fname))
             else:
                 raise AttributeError("The field %s is read only" % fname)
         self.__datas[fname] = fval
+        self.__values = None
+        if self.__referenced is not None:
+            self.__referenced.pop(fname, None)
         if not self.initialized and fname not in self.__initialized:
             # Add field to initialized fields list
             self.__initialized.append(fname)
             self.__set_initialized()
         if self.initialized:
-            # Running full value check
-            ret = self.__check_modified_values()
+            # Running value check and construction of the dependent fields
+            ret = self.__check_modified_values(fname)
             if ret is None:
                 return self.__datas[fname]
             else:
@@ -387,43 +609,47 @@ class LeObject(object):
     # Checks the list of initialized fields and sets __initialized at True if all fields initialized
     def __set_initialized(self):
         if isinstance(self.__initialized, list):
-            expected_fields = self.fieldnames(include_ro=False) + self._uid
-            if set(expected_fields) == set(self.__initialized):
+            expected_fields = self._hydration_table()[1]
+            if expected_fields.issubset(self.__initialized):
                 self.__is_initialized = True
 
     ## @brief Designed to be called when datas are modified
     #
     # Makes different checks on the LeObject given it's state (fully initialized or not)
+    #
+    # When the object is initialized only the modified field is checked and
+    # only the fields downstream of it are constructed again (see
+    # LeObjectMetadata.construct_downstream )
+    # @param fname str|None : the modified field name
     # @return None if checks succeded else return an exception list
-    def __check_modified_values(self):
+    def __check_modified_values(self, fname=None):
         err_list = dict()
-        if self.__initialized is True:
+        if self.__is_initialized and fname is not None:
             # Data value check
-            for fname in self.fieldnames(include_ro=False):
-                val, err = self._fields[fname].check_data_value(self.__datas[fname])
-                if err is not None:
-                    err_list[fname] = err
-                else:
-                    self.__datas[fname] = val
-            # Data construction
+            val, err = self._fields[fname].check_data_value(
+                self.__datas[fname])
+            if err is not None:
+                err_list[fname] = err
+            else:
+                self.__datas[fname] = val
+            # Construction of the fields downstream of the modified one
+            downstream = self._metadata().construct_downstream[fname]
             if len(err_list) == 0:
-                for fname in self.fieldnames(include_ro=True):
+                for dname in downstream:
                     try:
-                        field = self._fields[fname]
-                        self.__datas[fname] = field.construct_data(self,
-                                                                   fname,
-                                                                   self.__datas,
-                                                                   self.__datas[fname]
-                                                                   )
+                        field = self._fields[dname]
+                        self.__datas[dname] = field.construct_data(
+                            self, dname, self.__datas, self.__datas[dname])
                     except Exception as exp:
-                        err_list[fname] = exp
+                        err_list[dname] = exp
             # Datas consistency check
             if len(err_list) == 0:
-                for fname in self.fieldnames(include_ro=True):
-                    field = self._fields[fname]
-                    ret = field.check_data_consistency(self, fname, self.__datas)
+                for dname in downstream:
+                    field = self._fields[dname]
+                    ret = field.check_data_consistency(
+                        self, dname, self.__datas)
                     if isinstance(ret, Exception):
-                        err_list[fname] = ret
+                        err_list[dname] = ret
         else:
             # Data value check for initialized datas
             for fname in self.__initialized:
@@ -448,6 +674,19 @@ class LeObject(object):
     @classmethod
     def _set__fields(cls, field_list):
         cls._fields = field_list
+        for name in ('_hydration', '_metadata_tables'):
+            if name in cls.__dict__:
+                delattr(cls, name)
+
+    ## @brief Builds the class metadata tables
+    #
+    # Called in the generated dynamic code once all the classes fields and
+    # child classes are set
+    # @return a LeObjectMetadata instance
+    @classmethod
+    def _set__metadata(cls):
+        cls._metadata_tables = LeObjectMetadata(cls)
+        return cls._metadata_tables
 
     ## @brief Checks if the data is valid for this type
     # @param datas dict : key == field name value are field values
@@ -459,14 +698,9 @@ class LeObject(object):
     @classmethod
     def check_datas_value(cls, datas, complete=False, allow_internal=True):
         err_l = dict()  # Error storing
-        correct = set()  # valid fields name
-        mandatory = set()  # mandatory fields name
-        for fname, datahandler in cls._fields.items():
-            if allow_internal or not datahandler.is_internal():
-                correct.add(fname)
-                if complete and not hasattr(datahandler, 'default'):
-                    mandatory.add(fname)
-        provided = set(datas.keys())
+        # valid and mandatory fields name
+        correct, mandatory = cls._check_fieldsets(complete, allow_internal)
+        provided = datas.keys()
         # searching for unknow fields
         for u_f in provided - correct:
             # Here we can check if the field is invalid or rejected because
@@ -488,6 +722,66 @@ class LeObject(object):
             raise LeApiDataCheckErrors("Error while checking datas", err_l)
         return checked_datas
 
+    ## @brief Checks a list of data dicts
+    #
+    # Bulk version of check_datas_value() designed for imports : the fields
+    # sets are computed once and values are checked column by column (see
+    # DataHandler.check_data_values() ).
+    # @param rows list : list of dict (key == field name, value == field
+    # value)
+    # @param complete bool : if True expects that values are provided for all non internal fields
+    # @param allow_internal bool : if True does not raise an error if a field is internal
+    # @return a tuple (checked, errors) : checked is the list of checked
+    # datas (None for invalid rows) and errors a dict containing, for each
+    # invalid row index, a dict of errors indexed by field name
+    @classmethod
+    def check_datas_values(cls, rows, complete=False, allow_internal=True):
+        correct, mandatory = cls._check_fieldsets(complete, allow_internal)
+        errors = dict()
+        # Values to check by field name : (rows indexes, values)
+        columns = dict()
+        for i, datas in enumerate(rows):
+            provided = datas.keys()
+            for u_f in provided - correct:
+                errors.setdefault(i, dict())[u_f] = AttributeError(
+                    "Unknown or unauthorized field '%s'" % u_f)
+            for missing in mandatory - provided:
+                errors.setdefault(i, dict())[missing] = AttributeError(
+                    "The data for field '%s' is missing" % missing)
+            for name, value in datas.items():
+                if name in correct:
+                    if name not in columns:
+                        columns[name] = (list(), list())
+                    columns[name][0].append(i)
+                    columns[name][1].append(value)
+        checked = [dict() for _ in rows]
+        for name, (indexes, values) in columns.items():
+            results = cls._fields[name].check_data_values(values)
+            for i, (value, err) in zip(indexes, results):
+                checked[i][name] = value
+                if err:
+                    errors.setdefault(i, dict())[name] = err
+        for i in errors:
+            checked[i] = None
+        return checked, errors
+
+    ## @brief Returns the fields sets used to check datas
+    # @param complete bool : if True the non internal fields without default
+    # value are mandatory
+    # @param allow_internal bool : if True internal fields are allowed
+    # @return a tuple (allowed field names, mandatory field names) of
+    # frozensets
+    @classmethod
+    def _check_fieldsets(cls, complete, allow_internal):
+        meta = cls._metadata()
+        if allow_internal:
+            correct = meta.fieldnames_set
+            mandatory = meta.mandatory_fieldnames_set
+        else:
+            correct = meta.writable_fieldnames_set
+            mandatory = meta.writable_mandatory_fieldnames_set
+        return correct, mandatory if complete else frozenset()
+
     ## @brief Checks and prepares all the data
     #
     # @warning when complete = False we are not able to make construct_datas() and _check_data_consistency()
@@ -518,6 +812,11 @@ construction and consitency when datas are not complete\n")
     @classmethod
     def _construct_datas(cls, datas):
         constructor = DatasConstructor(cls, datas, cls._fields)
+        # Constructing in dependencies order avoids recursive constructions
+        for fname in cls._metadata().construct_order:
+            ftype = cls._fields[fname]
+            if not ftype.is_internal() or ftype.internal != 'autosql':
+                constructor[fname]
         ret = {
             fname: constructor[fname]
             for fname, ftype in cls._fields.items()
@@ -553,18 +852,46 @@ construction and consitency when datas are not complete\n")
         for fname, dh in cls._fields.items():
             ret = dh.make_consistency(fname, datas, type_query)
 
+    ## @brief Executes a write query or queues it in the opened LeSession
+    # @param query LeQuery : an insert, update or delete query
+    # @param *data : the query data (none for a delete query)
+    # @return the query result or None if the query is queued
+    @staticmethod
+    def _execute_write(query, *data):
+        session = LeSession.current()
+        if session is None:
+            return query.execute(*data)
+        session.add(query, *data)
+        return None
+
     ## @brief Adds a new instance of LeObject
+    #
+    # If a LeSession is opened the insertion is queued and the allocated uid
+    # is returned
     # @param datas dict : LeObject's data
     # @return a new uid in case of success, False otherwise
     @classmethod
     def insert(cls, datas):
         query = LeInsertQuery(cls)
+        session = LeSession.current()
+        if session is not None:
+            datas = session.add(query, datas)
+            return datas[cls.uid_fieldname()[0]]
         return query.execute(datas)
 
+    ## @brief Adds several new instances of LeObject in one batch
+    # @param datas_list list : list of LeObject's data dict
+    # @return the list of new uids
+    # @throw LeApiDataCheckErrors if a record is invalid (nothing is inserted)
+    @classmethod
+    def insert_many(cls, datas_list):
+        query = LeInsertQuery(cls)
+        return query.execute_multi(datas_list)
+
     ## @brief Update an instance of LeObject
     #
     # @param datas : list of new datas
-    # @return LeObject
+    # @return LeObject (None if the update is queued in a LeSession)
     def update(self, datas=None):
         datas = self.datas(internal=False) if datas is None else datas
         uids = self._uid
@@ -577,7 +904,7 @@ construction and consitency when datas are not complete\n")
             raise err
 
         try:
-            result = query.execute(datas)
+            result = self._execute_write(query, datas)
         except Exception as err:
             raise err
 
@@ -585,7 +912,8 @@ construction and consitency when datas are not complete\n")
 
     ## @brief Delete an instance of LeObject
     #
-    # @return 1 if the objet has been deleted
+    # @return 1 if the objet has been deleted (None if the deletion is
+    # queued in a LeSession)
     def delete(self):
         uids = self._uid
         query_filter = list()
@@ -594,13 +922,14 @@ construction and consitency when datas are not complete\n")
 
         query = LeDeleteQuery(self.__class__, query_filter)
 
-        result = query.execute()
+        result = self._execute_write(query)
 
         return result
 
     ## @brief Deletes instances of LeObject
     # @param query_filters list
-    # @return the number of deleted items
+    # @return the number of deleted items (None if the deletion is queued in
+    # a LeSession)
     @classmethod
     def delete_bundle(cls, query_filters):
         deleted = 0
@@ -609,6 +938,8 @@ construction and consitency when datas are not complete\n")
         except Exception as err:
             raise err
 
+        if LeSession.current() is not None:
+            return cls._execute_write(query)
         try:
             result = query.execute()
         except Exception as err:
@@ -626,48 +957,319 @@ construction and consitency when datas are not complete\n")
     # @param group list : A list of field names or tuple (FIELDNAME,[ASC | DESC])
     # @param limit int : The maximum number of returned results
     # @param offset int : offset (default value : 0)
+    # @param after tuple|str|None : keyset pagination, sort key of the last
+    # object of the previous page or continuation token (see
+    # LeGetQuery.set_after() and LeObject.get_page())
+    # @param prefetch list|None : reference field names whose referenced
+    # objects are fetched with one query per linked class for the whole
+    # result set (see LeObject.referenced())
     # @return a list of items (lists of (fieldname, fieldvalue))
+    # @note When an identity map is opened and no field_list is given, the
+    # fetched objects are stored in it (see @ref lodel.leapi.identity_map)
     @classmethod
-    def get(cls, query_filters, field_list=None, order=None, group=None, limit=None, offset=0):
-        if field_list is not None:
-            for uid in [uidname
-                        for uidname in cls.uid_fieldname()
-                        if uidname not in field_list]:
-                field_list.append(uid)
-            if CLASS_ID_FIELDNAME not in field_list:
-                field_list.append(CLASS_ID_FIELDNAME)
+    def get(cls, query_filters, field_list=None, order=None, group=None, limit=None, offset=0, after=None, prefetch=None):
+        imap = LeIdentityMap.current() if field_list is None else None
+        field_list = cls._get_field_list(field_list)
         try:
             query = LeGetQuery(
                 cls, query_filters=query_filters, field_list=field_list,
-                order=order, group=group, limit=limit, offset=offset)
+                order=order, group=group, limit=limit, offset=offset,
+                after=after, prefetch=prefetch)
         except ValueError as err:
             raise err
 
+        # The profile (if any) is ended after the hydration
+        profile_owner = query._profile_begin()
         try:
             result = query.execute()
-        except Exception as err:
-            raise err
 
-        objects = list()
-        for res in result:
-            res_cls = cls.name2class(res[CLASS_ID_FIELDNAME])
-            inst = res_cls.__new__(res_cls, **res)
-            objects.append(inst)
+            objects = list()
+            with query._stage('hydration'):
+                for res in result:
+                    res_cls = cls.name2class(res[CLASS_ID_FIELDNAME])
+                    inst = res_cls._hydrate(res)
+                    objects.append(inst)
+                    if imap is not None:
+                        imap.add(inst)
 
+            if prefetch is not None and len(objects) > 0:
+                with query._stage('prefetch'):
+                    cls._prefetch_references(objects, prefetch)
+        finally:
+            if profile_owner:
+                query._profile_end()
         return objects
 
+    ## @brief Fetches and attaches referenced objects to a list of instances
+    #
+    # For each reference field the uids referenced by all the instances are
+    # gathered and resolved with one 'in' query per linked class. Objects
+    # already stored in the opened identity map are not fetched again.
+    # @param objects list : LeObject child classes instances
+    # @param prefetch list : reference field names
+    # @return None, objects are modified (see LeObject.referenced())
+    @classmethod
+    def _prefetch_references(cls, objects, prefetch):
+        for fname in prefetch:
+            fdh = cls.field(fname)
+            single = fdh.is_singlereference()
+            values = dict()  # object -> referenced uid(s)
+            uids = set()
+            for obj in objects:
+                value = obj.data(fname)
+                if value is None:
+                    continue
+                values[obj] = value
+                uids |= set([value] if single else value)
+            # Resolving uids, one query by linked class
+            found = dict()
+            left = uids
+            imap = LeIdentityMap.current()
+            if imap is not None:
+                for uid in uids:
+                    for leo_cls in fdh.linked_classes:
+                        leo = imap.lookup(leo_cls, uid)
+                        if leo is not None:
+                            found[uid] = leo
+                            break
+                left = left - set(found.keys())
+            for leo_cls in fdh.linked_classes:
+                if len(left) == 0:
+                    break
+                uidname = leo_cls.uid_fieldname()[0]  # MULTIPLE UID BROKEN HERE
+                for leo in leo_cls.get([(uidname, 'in', sorted(left))]):
+                    found[leo.uid()] = leo
+                left = left - set(found.keys())
+            if len(left) > 0:
+                logger.warning("Prefetch of %s.%s : following uids were not \
+found : %s" % (cls.__name__, fname, ','.join(str(uid) for uid in left)))
+            # Attaching results, objects with missing references are not
+            # modified and will fetch them by themselves
+            for obj, value in values.items():
+                if single:
+                    if value in found:
+                        obj._set_referenced(fname, found[value])
+                elif all(uid in found for uid in value):
+                    obj._set_referenced(fname, [found[uid] for uid in value])
+
+    ## @brief Gets a page of instances using keyset pagination
+    #
+    # Each page costs the same whatever its position, unlike offset based
+    # pagination. Usage :
+    #<pre>objects, token = Person.get_page(None, 100)
+    #while token is not None:
+    #    objects, token = Person.get_page(None, 100, after = token)</pre>
+    # @param query_filters : see LeObject.get()
+    # @param page_size int : maximum number of objects in the page
+    # @param after str|None : continuation token returned with the previous
+    # page (None for the first page)
+    # @param order list : A list of field names or tuple (FIELDNAME,[ASC | DESC])
+    # @param field_list list|None : see LeObject.get()
+    # @return a tuple (objects, token) with token the continuation token of
+    # the next page or None if this page is the last one
+    @classmethod
+    def get_page(cls, query_filters, page_size, after=None, order=None,
+                 field_list=None):
+        keyset_order = LeGetQuery.keyset_order(cls, order)
+        if field_list is not None:
+            # sort keys are needed to forge the continuation token
+            field_list = list(field_list) + [
+                fname for fname, _ in keyset_order if fname not in field_list]
+        objects = cls.get(
+            query_filters, field_list=field_list, order=order,
+            limit=page_size, after=() if after is None else after)
+        if len(objects) < page_size:
+            return (objects, None)
+        return (objects, LeGetQuery.continuation_token(
+            keyset_order, objects[-1]))
+
+    ## @brief Returns the compiled filter used by get_from_uid()
+    # @return a LeCompiledFilters instance with an 'uid' parameter
+    @classmethod
+    def _uid_filter(cls):
+        if cls not in LeObject._uid_filters:
+            uidname = cls.uid_fieldname()[0]  # Brokes composed UID
+            LeObject._uid_filters[cls] = LeCompiledFilters(
+                cls, [LeQueryFilter(uidname, '=', LeQueryParam('uid'))])
+        return LeObject._uid_filters[cls]
+
+    ## @brief Gets instances of LeObject as an iterator
+    #
+    # Same as LeObject.get() except that objects are fetched by batches and
+    # instanciated lazily while iterating. Designed for exports or reindexing
+    # on big collections.
+    # @param query_filters dict : (filters, relational filters), with filters is a list of tuples : (FIELD, OPERATOR, VALUE) )
+    # @param field_list list|None : list of string representing fields see
+    # @ref leobject_filters
+    # @param order list : A list of field names or tuple (FIELDNAME,[ASC | DESC])
+    # @param group list : A list of field names or tuple (FIELDNAME,[ASC | DESC])
+    # @param limit int : The maximum number of returned results
+    # @param offset int : offset (default value : 0)
+    # @param batch_size int|None : number of records fetched by datasource round trip
+    # @return a generator of LeObject child classes instances
+    @classmethod
+    def iter_get(cls, query_filters, field_list=None, order=None, group=None,
+                 limit=None, offset=0, batch_size=None, after=None):
+        field_list = cls._get_field_list(field_list)
+        query = LeGetQuery(
+            cls, query_filters=query_filters, field_list=field_list,
+            order=order, group=group, limit=limit, offset=offset,
+            after=after)
+        result = query.execute_iter(batch_size=batch_size)
+
+        # The query is executed now, only the instanciation is lazy
+        def hydrate(result):
+            for res in result:
+                res_cls = cls.name2class(res[CLASS_ID_FIELDNAME])
+                yield res_cls._hydrate(res)
+        return hydrate(result)
+
+    ## @brief Gets field values without instanciating LeObject
+    #
+    # Records are returned as given by the datasource : no LeObject is
+    # instanciated and values are not checked. Designed for callers that only
+    # need a few fields (uid, title...) of many objects.
+    # @param query_filters : see LeObject.get()
+    # @param field_list list|None : the fields to fetch (None means all
+    # fields)
+    # @param order list : A list of field names or tuple (FIELDNAME,[ASC | DESC])
+    # @param group list : A list of field names or tuple (FIELDNAME,[ASC | DESC])
+    # @param limit int : The maximum number of returned results
+    # @param offset int : offset (default value : 0)
+    # @param after tuple|str|None : keyset pagination (see LeObject.get() )
+    # @param iterator bool : if True records are streamed from the
+    # datasource (see LeGetQuery.execute_iter() )
+    # @param batch_size int|None : number of records fetched by datasource
+    # round trip (only used with iterator)
+    # @return a list (or an iterator) of dict <code>{fieldname: value}</code>
+    @classmethod
+    def values(cls, query_filters, field_list=None, order=None, group=None,
+               limit=None, offset=0, after=None, iterator=False,
+               batch_size=None):
+        query = LeGetQuery(
+            cls, query_filters=query_filters,
+            field_list=None if field_list is None else list(field_list),
+            order=order, group=group, limit=limit, offset=offset,
+            after=after)
+        if iterator:
+            return query.execute_iter(batch_size=batch_size)
+        return query.execute()
+
+    ## @brief Gets field values as tuples without instanciating LeObject
+    #
+    # Same as LeObject.values() except that each record is a tuple of values
+    # in field_list order (missing values are None)
+    # @param query_filters : see LeObject.get()
+    # @param field_list list : the fields to fetch
+    # @param flat bool : if True and only one field is fetched, returns the
+    # values instead of 1-tuples
+    # @param **kwargs : see LeObject.values()
+    # @return a list (or an iterator) of tuples (or values if flat)
+    # @throw ValueError if flat is True and more than one field is asked
+    @classmethod
+    def values_list(cls, query_filters, field_list, flat=False, **kwargs):
+        field_list = list(field_list)
+        if flat and len(field_list) != 1:
+            raise ValueError(
+                "flat is only allowed when a single field is asked")
+        records = cls.values(query_filters, field_list, **kwargs)
+        if flat:
+            fname = field_list[0]
+            res = (record.get(fname) for record in records)
+        else:
+            res = (tuple(record.get(fname) for fname in field_list)
+                   for record in records)
+        if kwargs.get('iterator', False):
+            return res
+        return list(res)
+
+    ## @brief Completes a get field list with mandatory fields
+    #
+    # The uid fields and the class identifier field are needed to instanciate
+    # results
+    # @param field_list list|None
+    # @return the completed field_list (or None)
+    @classmethod
+    def _get_field_list(cls, field_list):
+        if field_list is not None:
+            for uid in [uidname
+                        for uidname in cls.uid_fieldname()
+                        if uidname not in field_list]:
+                field_list.append(uid)
+            if CLASS_ID_FIELDNAME not in field_list:
+                field_list.append(CLASS_ID_FIELDNAME)
+        return field_list
+
+    ## @brief Counts instances of LeObject matching given filters
+    #
+    # The count is done by the datasource, no instance is fetched
+    # @param query_filters list : see @ref leobject_filters
+    # @return an integer
+    @classmethod
+    def count(cls, query_filters):
+        query = LeCountQuery(cls, query_filters)
+        return query.execute()
+
+    ## @brief Computes metrics on groups of instances
+    #
+    # Groups and metrics are computed by the datasource, no instance is
+    # fetched. Example, the number of texts and their last update date by
+    # language :
+    #<pre>Text.aggregate(None, group_by = ['language'],
+    #    metrics = {'n': 'count', 'last': ('max', 'date_update')},
+    #    order = [('n', 'DESC')])</pre>
+    # @param query_filters list : see @ref leobject_filters
+    # @param group_by list|None : names of the group fields
+    # @param metrics dict|None : metrics indexed by name (see
+    # LeAggregateQuery.__init__() )
+    # @param order list|None : A list of group field or metric names or tuple
+    # (NAME,[ASC | DESC])
+    # @param limit int|None : The maximum number of returned groups
+    # @param offset int : offset (default value : 0)
+    # @return a list of dict with group fields and metrics values
+    @classmethod
+    def aggregate(cls, query_filters, group_by=None, metrics=None, order=None,
+                  limit=None, offset=0):
+        query = LeAggregateQuery(
+            cls, query_filters, group_by=group_by, metrics=metrics,
+            order=order, limit=limit, offset=offset)
+        return query.execute()
+
+    ## @brief Checks if at least one instance of LeObject matches given filters
+    # @param query_filters list : see @ref leobject_filters
+    # @return bool
+    @classmethod
+    def exists(cls, query_filters):
+        query = LeCountQuery(cls, query_filters, limit=1)
+        return query.execute() > 0
+
     ## @brief Retrieves an object given an UID
     # @param uid str : Unique ID of the searched LeObject
+    # @param prefetch list|None : reference field names whose referenced
+    # objects are fetched too (see LeObject.get() )
     # @return LeObject
     # @throw LodelFatalError if the class does not have such a UID defined or if duplicates are found
+    # @note When an identity map is opened, an object already fetched during
+    # the unit of work is returned without querying the datasource (see
+    # @ref lodel.leapi.identity_map), its references are prefetched if
+    # needed
     #@todo broken multiple UID
     @classmethod
-    def get_from_uid(cls, uid):
+    def get_from_uid(cls, uid, prefetch=None):
         if cls.uid_fieldname() is None:
             raise LodelFatalError(
                 "No uid defined for class %s" % cls.__name__)
-        uidname = cls.uid_fieldname()[0]  # Brokes composed UID
-        res = cls.get([(uidname, '=', uid)])
+        imap = LeIdentityMap.current()
+        if imap is not None:
+            uid_value, err = cls.data_handler(
+                cls.uid_fieldname()[0]).check_data_value(uid)
+            if err is None:
+                res = imap.lookup(cls, uid_value)
+                if res is not None:
+                    if prefetch is not None:
+                        cls._prefetch_references([res], prefetch)
+                    return res
+        res = cls.get(cls._uid_filter().bind(uid=uid), prefetch=prefetch)
 
         # dedoublonnage vu que query ou la datasource est bugué
         if len(res) > 1:
@@ -23,6 +23,14 @@ import re
 import copy
 import inspect
 import warnings
+import json
+import base64
+import datetime
+import threading
+import time
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from lodel.context import LodelContext
 LodelContext.expose_modules(globals(), {
@@ -30,17 +38,117 @@ LodelContext.expose_modules(globals(), {
                                'LeApiDataCheckError', 'LeApiDataCheckErrors', 'LeApiQueryError',
                                'LeApiQueryErrors'],
     'lodel.plugin.hooks': ['LodelHook'],
+    'lodel.leapi.identity_map': ['LeIdentityMap'],
     'lodel.logger': ['logger']})
 
 # @todo check data when running query
 
 
+## @brief Execution profile of a query
+#
+# When profiling is enabled (see LeQuery.set_profiling() ) each query
+# execution records the wall time spent in each stage :
+#- check : data checks
+#- prepare : data preparation
+#- subqueries : queries on other datasources (see LeFilteredQuery)
+#- pre_hooks / post_hooks : hooks calls
+#- datasource : the datasource call
+#- hydration : LeObject instanciation (LeObject.get() only)
+#
+# Datasources can attach informations about the request they really sent
+# (for example the final filter and projection) using
+# LeQueryProfile.annotate()
+class LeQueryProfile(object):
+
+    ## @brief Stores the profile of the running datasource call by thread
+    _local = threading.local()
+
+    ##
+    # @param query LeQuery : the profiled query
+    def __init__(self, query):
+        self.query = repr(query)
+        ## @brief Wall time in seconds indexed by stage name
+        self.stages = OrderedDict()
+        ## @brief Number of returned (or affected) records when known
+        self.rows = None
+        ## @brief List of dict given by datasources (see annotate())
+        self.datasource = list()
+        ## @brief Total wall time in seconds
+        self.total = None
+        self.__start = time.perf_counter()
+
+    ## @brief Context manager measuring a stage
+    # @param name str : stage name, durations of a stage executed more than
+    # once are summed
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        prev_profile = getattr(self._local, 'profile', None)
+        self._local.profile = self
+        try:
+            yield self
+        finally:
+            self._local.profile = prev_profile
+            self.stages[name] = self.stages.get(name, 0) + \
+                time.perf_counter() - start
+
+    ## @brief Ends the profile
+    def finish(self):
+        self.total = time.perf_counter() - self.__start
+
+    ## @brief Adds informations about the running datasource call
+    #
+    # Does nothing if no profiled query is running
+    # @param **infos : informations to attach to the profile
+    @classmethod
+    def annotate(cls, **infos):
+        profile = getattr(cls._local, 'profile', None)
+        if profile is not None:
+            profile.datasource.append(infos)
+
+    ## @return a dict representation of the profile
+    def as_dict(self):
+        return {'query': self.query,
+                'stages': dict(self.stages),
+                'rows': self.rows,
+                'datasource': list(self.datasource),
+                'total': self.total}
+
+    def __repr__(self):
+        stages = ' '.join(
+            '%s=%.6fs' % (name, duration)
+            for name, duration in self.stages.items())
+        return "<LeQueryProfile %s total=%s rows=%s %s>" % (
+            self.query, 'running' if self.total is None else
+            '%.6fs' % self.total, self.rows, stages)
+
+
+## @brief No-op context manager used as stage when profiling is disabled
+class _LeQueryNoStage(object):
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
 class LeQuery(object):
 
     ## @brief Hookname prefix
     _hook_prefix = None
     ## @brief arguments for the LeObject.check_data_value()
     _data_check_args = {'complete': False, 'allow_internal': False}
+    ## @brief If True the opened identity map is cleared after the query
+    # execution (see @ref lodel.leapi.identity_map)
+    _invalidates_identity_map = False
+    ## @brief If True queries executions are profiled (see
+    # LeQuery.set_profiling() )
+    _profiling = False
+    ## @brief Name of the hook called with each execution profile as payload
+    profile_hook_name = 'leapi_query_profile'
+    ## @brief Shared no-op stage context
+    _no_stage = _LeQueryNoStage()
 
     ## @brief Abstract constructor
     # @param target_class LeObject : class of object the query is about
@@ -55,6 +163,10 @@ class LeQuery(object):
         self._target_class = target_class
         self._ro_datasource = target_class._ro_datasource
         self._rw_datasource = target_class._rw_datasource
+        ## @brief Profile of the last execution (None if profiling disabled)
+        self.last_profile = None
+        ## @brief Profile of the running execution
+        self._profile = None
 
     ## @brief Executes a query and returns the result
     #@param **data
@@ -62,22 +174,149 @@ class LeQuery(object):
     #@see LeQuery._query()
     #@todo check that the check_datas_value is not duplicated/useless
     def execute(self, data):
-        if data is not None:
-            self._target_class.check_datas_value(
-                data,
-                **self._data_check_args)
-            self._target_class.prepare_datas(data)  # not yet implemented
-        if self._hook_prefix is None:
-            raise NotImplementedError("Abstract method")
-        LodelHook.call_hook(self._hook_prefix + 'pre',
-                            self._target_class,
-                            data)
-        ret = self._query(data=data)
-        ret = LodelHook.call_hook(self._hook_prefix + 'post',
-                                  self._target_class,
-                                  ret)
+        profile_owner = self._profile_begin()
+        try:
+            if data is not None:
+                with self._stage('check'):
+                    data = self._check_data(data)
+                with self._stage('prepare'):
+                    self._target_class.prepare_datas(data)  # not yet implemented
+            if self._hook_prefix is None:
+                raise NotImplementedError("Abstract method")
+            with self._stage('pre_hooks'):
+                LodelHook.call_hook(self._hook_prefix + 'pre',
+                                    self._target_class,
+                                    data)
+            try:
+                with self._stage('datasource'):
+                    ret = self._datasource_query(data)
+            finally:
+                if self._invalidates_identity_map:
+                    LeIdentityMap.invalidate()
+            if self._profile is not None:
+                self._profile.rows = self._result_rows(ret)
+            with self._stage('post_hooks'):
+                ret = LodelHook.call_hook(self._hook_prefix + 'post',
+                                          self._target_class,
+                                          ret)
+        finally:
+            if profile_owner:
+                self._profile_end()
         return ret
 
+    ## @brief Calls _query(), the datasource call of the query
+    # @param data * : query data
+    # @return _query() result
+    def _datasource_query(self, data):
+        return self._query(data=data)
+
+    ## @brief Checks the data of a write query queued in a LeSession
+    # (see @ref lodel.leapi.session)
+    # @param data * : query data
+    # @return the data to give to _bulk_ops()
+    def _bulk_prepare(self, data):
+        if data is not None:
+            data = self._check_data(data)
+        return data
+
+    ## @brief Checks the query data
+    # @param data * : query data (not None)
+    # @return the data given to the datasource query, unchanged by default
+    # @throw LeApiDataCheckErrors if data are invalid
+    def _check_data(self, data):
+        self._target_class.check_datas_value(data, **self._data_check_args)
+        return data
+
+    ## @brief Tells if _bulk_ops() reads records
+    #
+    # If True the operations queued before the query in a LeSession are
+    # written before calling _bulk_ops()
+    # @param data * : query data as returned by _bulk_prepare()
+    # @return bool
+    def _bulk_reads(self, data):
+        return False
+
+    ## @brief Returns the datasource operations implementing a write query
+    #
+    # Operations are tuples (METHOD, TARGET, *ARGS) as expected by
+    # AbstractDatasource.bulk_write()
+    # @param data * : query data as returned by _bulk_prepare()
+    # @return a list of operations
+    def _bulk_ops(self, data):
+        raise NotImplementedError("Abstract method")
+
+    ## @brief Builds the query result from the results of its operations
+    # @param results list : the results of the operations returned by
+    # _bulk_ops()
+    # @return the query result
+    def _bulk_result(self, results):
+        return results[0]
+
+    ## @brief Calls _bulk_ops(), used by LeSession as _datasource_query() is
+    # used by execute()
+    # @param data * : query data as returned by _bulk_prepare()
+    # @return a list of operations
+    def _datasource_bulk_ops(self, data):
+        return self._bulk_ops(data)
+
+    ## @brief Calls _bulk_result()
+    # @param results list : the results of the operations returned by
+    # _datasource_bulk_ops()
+    # @return the query result
+    def _datasource_bulk_result(self, results):
+        return self._bulk_result(results)
+
+    ## @brief Enables or disables queries profiling
+    #
+    # When enabled, the profile of each query execution is available in the
+    # LeQuery.last_profile attribute and is given as payload to the
+    # @ref LeQuery.profile_hook_name hook.
+    # @param enabled bool
+    @classmethod
+    def set_profiling(cls, enabled):
+        LeQuery._profiling = bool(enabled)
+
+    ## @brief Starts the profile of an execution if profiling is enabled
+    # @return True if the caller started the profile and has to call
+    # _profile_end(), else False (profiling disabled or profile already
+    # started by a caller)
+    def _profile_begin(self):
+        if not LeQuery._profiling or self._profile is not None:
+            return False
+        self._profile = LeQueryProfile(self)
+        return True
+
+    ## @brief Ends the running profile and calls the profile hook
+    #
+    # Called even if the execution failed
+    def _profile_end(self):
+        profile = self._profile
+        self._profile = None
+        profile.finish()
+        self.last_profile = profile
+        LodelHook.call_hook(self.profile_hook_name, self, profile)
+
+    ## @brief Returns a context manager measuring a stage of the execution
+    # @param name str : stage name
+    def _stage(self, name):
+        if self._profile is None:
+            return self._no_stage
+        return self._profile.stage(name)
+
+    ## @brief Returns the number of records returned by _query()
+    # @param ret * : _query() result
+    # @return an integer or None if unknown
+    def _result_rows(self, ret):
+        return len(ret) if isinstance(ret, list) else None
+
+    ## @brief Explains the query
+    # @return a dict with the query infos (see dump_infos()) and the last
+    # execution profile (None if profiling was disabled)
+    def explain(self):
+        return {'query': self.dump_infos(),
+                'profile': None if self.last_profile is None
+                else self.last_profile.as_dict()}
+
     ## @brief Child classes implement this method to execute the query
     #@param **data
     #@return query result
@@ -94,6 +333,119 @@ class LeQuery(object):
             classname=self.__class__.__name__,
             target_class=self._target_class)
 
+## @brief Placeholder for a filter value given when binding
+# LeCompiledFilters
+class LeQueryParam(object):
+
+    ## @brief Instanciates a query parameter
+    # @param name str : parameter name (as expected by
+    # LeCompiledFilters.bind() keyword arguments)
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "<LeQueryParam %s>" % self.name
+
+
+## @brief Structured query filter : a FIELD OPERATOR VALUE node
+#
+# Allows to build filters without string parsing. VALUE can be a
+# LeQueryParam to build reusable LeCompiledFilters.
+class LeQueryFilter(object):
+
+    ## @brief Instanciates a filter node
+    # @param field str : field name (FIELDNAME[.REF_FIELD])
+    # @param operator str : one of LeFilteredQuery._query_operators (spaces
+    # stripped)
+    # @param value mixed|LeQueryParam : the filter value
+    def __init__(self, field, operator, value):
+        self.field = field
+        self.operator = operator.strip()
+        self.value = value
+
+    ## @brief Compiles the filter against a target class
+    # @param target_class LeObject : class of object the filter is about
+    # @return a LeCompiledFilters instance
+    def compile(self, target_class):
+        return LeCompiledFilters(target_class, [self])
+
+    def __repr__(self):
+        return "<LeQueryFilter %s %s %r>" % (
+            self.field, self.operator, self.value)
+
+
+## @brief Query filters prepared once against a target class
+#
+# Compiled filters can be given as query_filters to any LeFilteredQuery
+# child class (and to LeObject.get()), filters preparation is then skipped.
+# Values given as LeQueryParam have to be bound before use :
+#<pre>uid_filter = LeCompiledFilters(Person,
+#   [LeQueryFilter('lodel_id', '=', LeQueryParam('uid'))])
+#Person.get(uid_filter.bind(uid = 42))</pre>
+class LeCompiledFilters(object):
+
+    ## @brief Prepares filters
+    # @param target_class LeObject : class of object the filters are about
+    # @param query_filters list : list of str, tuple or LeQueryFilter
+    # @throw LeApiDataCheckErrors if a filter is invalid
+    def __init__(self, target_class, query_filters):
+        if isinstance(query_filters, (str, LeQueryFilter)):
+            query_filters = [query_filters]
+        self._target_class = target_class
+        self._std_filters, self._rel_filters = \
+            LeFilteredQuery._prepare_filters(target_class, query_filters)
+        ## @brief Names of the parameters waiting to be bound
+        self.params = {
+            value.name for _, _, value in self._std_filters + self._rel_filters
+            if isinstance(value, LeQueryParam)}
+
+    ## @brief Returns new compiled filters with parameters values set
+    # @param **params : values for each LeQueryParam
+    # @return a LeCompiledFilters instance
+    # @throw LeApiQueryError if a parameter is missing
+    def bind(self, **params):
+        missing = self.params - set(params.keys())
+        if len(missing) > 0:
+            raise LeApiQueryError("Missing values for query parameters : %s"
+                                  % ', '.join(sorted(missing)))
+        res = copy.copy(self)
+        res._std_filters = list()
+        for field, operator, value in self._std_filters:
+            if isinstance(value, LeQueryParam):
+                value = params[value.name]
+                checked, error = self._target_class.field(
+                    field).check_data_value(value)
+                if not isinstance(error, Exception):
+                    value = checked
+            res._std_filters.append((field, operator, value))
+        res._rel_filters = [
+            (rfield, operator, params[value.name]
+                if isinstance(value, LeQueryParam) else value)
+            for rfield, operator, value in self._rel_filters]
+        res.params = set()
+        return res
+
+    ## @brief Returns prepared filters
+    # @param target_class LeObject : the class of the query using the filters
+    # @return a tuple(std_filters, relational_filters) (copies)
+    # @throw LeApiQueryError if filters were compiled for another class or if
+    # parameters are not bound
+    def prepared_filters(self, target_class):
+        if target_class is not self._target_class:
+            raise LeApiQueryError("Filters compiled for %s can't be used in \
+a query on %s" % (self._target_class.__name__, target_class.__name__))
+        if len(self.params) > 0:
+            raise LeApiQueryError("Unbound query parameters : %s"
+                                  % ', '.join(sorted(self.params)))
+        return (list(self._std_filters), list(self._rel_filters))
+
+    def __repr__(self):
+        return "<LeCompiledFilters target=%s filters=%s params=%s>" % (
+            self._target_class.__name__,
+            (self._std_filters, self._rel_filters),
+            sorted(self.params))
+
+
 ## @brief Abstract class handling query with filters
 
 
@@ -114,6 +466,19 @@ class LeFilteredQuery(LeQuery):
     ## @brief Regular expression to process filters
     _query_re = None
 
+    ## @brief LRU cache of prepared string filters
+    #
+    # Keys are tuple(target_class, filter_string), values are returned by
+    # LeFilteredQuery._prepare_filter()
+    _filters_cache = OrderedDict()
+    ## @brief Maximum number of entries in the prepared filters cache
+    _filters_cache_size = 1024
+    ## @brief Lock protecting the prepared filters cache
+    _filters_cache_lock = threading.Lock()
+    ## @brief Number of threads running subqueries concurrently (1 means
+    # sequential execution, see LeFilteredQuery.set_subqueries_workers() )
+    _subqueries_workers = 1
+
     ## @brief Abtract constructor for queries with filter
     #@param target_class LeObject : class of object the query is about
     #@param query_filters list : with a tuple (only one filter) or a list of
@@ -128,6 +493,12 @@ class LeFilteredQuery(LeQuery):
         #
         # Subqueries are tuple(target_class_ref_field, LeGetQuery)
         self.subqueries = None
+        ## @brief Index of the relational filter of each subquery (a filter
+        # gives one subquery per linked class)
+        self._subqueries_filters_ids = None
+        ## @brief True when a subquery result makes the query match nothing
+        # (set at execution)
+        self._no_match = False
         query_filters = [] if query_filters is None else query_filters
         self.set_query_filter(query_filters)
 
@@ -135,28 +506,151 @@ class LeFilteredQuery(LeQuery):
     #
     # This method takes care to execute subqueries before calling super execute
     def execute(self, data=None):
+        profile_owner = self._profile_begin()
         # copy originals filters
-        orig_filters = copy.copy(self._query_filter)
-        std_filters, rel_filters = self._query_filter
-
-        for rfield, subq in self.subqueries:
-            subq_res = subq.execute()
-            std_filters.append(
-                (rfield, ' in ', subq_res))
-        self._query_filter = (std_filters, rel_filters)
+        orig_filters = self._query_filter
         try:
-
-            filters, rel_filters = self._query_filter
+            with self._stage('subqueries'):
+                self._query_filter = self._subqueries_filters()
             res = super().execute(data)
-        except Exception as e:
+        finally:
             # restoring filters even if an exception is raised
-            self.__query_filter = orig_filters
-
-            raise e  # reraise
-        # restoring filters
-        self._query_filter = orig_filters
+            self._query_filter = orig_filters
+            self._no_match = False
+            if profile_owner:
+                self._profile_end()
         return res
 
+    ## @brief Calls _query() unless subqueries make the query match nothing
+    # @param data * : query data
+    # @return _query() result or _empty_result()
+    def _datasource_query(self, data):
+        if self._no_match:
+            return self._empty_result()
+        return super()._datasource_query(data)
+
+    ## @brief Subqueries read records : the operations queued before the
+    # query in a LeSession are written first
+    def _bulk_reads(self, data):
+        return len(self.subqueries) > 0 or super()._bulk_reads(data)
+
+    ## @brief Runs the subqueries then calls _bulk_ops() unless subqueries
+    # make the query match nothing
+    # @param data * : query data as returned by _bulk_prepare()
+    # @return a list of operations
+    def _datasource_bulk_ops(self, data):
+        orig_filters = self._query_filter
+        self._no_match = False
+        try:
+            self._query_filter = self._subqueries_filters()
+            if self._no_match:
+                return []
+            return super()._datasource_bulk_ops(data)
+        finally:
+            self._query_filter = orig_filters
+
+    def _datasource_bulk_result(self, results):
+        try:
+            if self._no_match:
+                return self._empty_result()
+            return super()._datasource_bulk_result(results)
+        finally:
+            self._no_match = False
+
+    ## @brief Returns the result of a query matching nothing
+    # @return 0 (the number of affected or counted records)
+    def _empty_result(self):
+        return 0
+
+    ## @brief Sets the number of threads running subqueries
+    #
+    # Subqueries (relational filters on classes stored in another datasource)
+    # are run sequentially when workers is 1, else concurrently in a
+    # thread pool. This value is set at bootstrap from the
+    # lodel2.subqueries_workers setting.
+    # @param workers int : number of threads (>= 1)
+    # @throw ValueError if workers is not a positive integer
+    @classmethod
+    def set_subqueries_workers(cls, workers):
+        try:
+            workers = int(workers)
+            if workers <= 0:
+                raise ValueError()
+        except (ValueError, TypeError):
+            msg = "workers argument expected to be an integer > 0 but got %s"
+            raise ValueError(msg % repr(workers))
+        LeFilteredQuery._subqueries_workers = workers
+
+    ## @brief Returns the number of records returned or affected by _query()
+    # @param ret list|int : _query() result
+    # @return an integer or None if unknown
+    def _result_rows(self, ret):
+        if isinstance(ret, int) and not isinstance(ret, bool):
+            return ret
+        return super()._result_rows(ret)
+
+    ## @brief Executes subqueries and returns the resulting query filter
+    #
+    # The uids returned by the subqueries of a relational filter (one by
+    # linked class) are unioned. The uids of the different relational
+    # filters on a reference field are intersected and appended to a copy of
+    # the standard filters as an 'in' filter. If a relational filter or an
+    # intersection matches nothing the query cannot match anything : the
+    # _no_match flag is set and the datasource is not called.
+    #@return a tuple(std_filters, relational_filters)
+    def _subqueries_filters(self):
+        std_filters, rel_filters = self._query_filter
+        std_filters = list(std_filters)
+        if len(self.subqueries) == 0:
+            return (std_filters, rel_filters)
+        # Number of subqueries not executed yet by relational filter
+        left = dict()
+        for filter_id in self._subqueries_filters_ids:
+            left[filter_id] = left.get(filter_id, 0) + 1
+        # (reference field, uids) indexed by relational filter
+        filters_uids = OrderedDict()
+        for (rfield, subq), filter_id, subq_res in zip(
+                self.subqueries, self._subqueries_filters_ids,
+                self._execute_subqueries()):
+            uid_name = subq._target_class.uid_fieldname()[0]
+            if filter_id not in filters_uids:
+                filters_uids[filter_id] = (rfield, OrderedDict())
+            uids = filters_uids[filter_id][1]
+            for row in subq_res:
+                uids[row[uid_name]] = None
+            left[filter_id] -= 1
+            if left[filter_id] == 0 and len(uids) == 0:
+                # No need to wait for the others subqueries results
+                self._no_match = True
+                break
+        # Referenced uids indexed by reference field
+        ref_uids = OrderedDict()
+        for rfield, uids in filters_uids.values():
+            uids = list(uids)
+            if rfield in ref_uids:
+                uids_set = set(uids)
+                uids = [uid for uid in ref_uids[rfield] if uid in uids_set]
+                if len(uids) == 0:
+                    self._no_match = True
+            ref_uids[rfield] = uids
+        for rfield, uids in ref_uids.items():
+            std_filters.append((rfield, 'in', uids))
+        return (std_filters, rel_filters)
+
+    ## @brief Executes the subqueries
+    #
+    # Subqueries are run in a thread pool if more than one worker is
+    # configured (see LeFilteredQuery.set_subqueries_workers() )
+    #@return an iterator on the subqueries results, in self.subqueries order
+    def _execute_subqueries(self):
+        workers = min(self._subqueries_workers, len(self.subqueries))
+        if workers <= 1:
+            return (subq.execute() for _, subq in self.subqueries)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(subq.execute)
+                       for _, subq in self.subqueries]
+            return [future.result() for future in futures]
+
     ## @brief Add filter(s) to the query
     #
     # This method is also able to slice query if different datasources are
@@ -166,10 +660,15 @@ class LeFilteredQuery(LeQuery):
     #@see LeFilteredQuery._prepare_filters()
     #@warning Does not support multiple UID
     def set_query_filter(self, query_filter):
-        if isinstance(query_filter, str):
+        if isinstance(query_filter, (str, LeQueryFilter)):
             query_filter = [query_filter]
         # Query filter preparation
-        filters_orig, rel_filters = self._prepare_filters(query_filter)
+        if isinstance(query_filter, LeCompiledFilters):
+            filters_orig, rel_filters = query_filter.prepared_filters(
+                self._target_class)
+        else:
+            filters_orig, rel_filters = self._prepare_filters(
+                self._target_class, query_filter)
         # Here we know that each relational filter concerns only one datasource
         # thank's to _prepare_relational_fields
 
@@ -180,10 +679,12 @@ class LeFilteredQuery(LeQuery):
         for rfilter in rel_filters:
             (rfield, ref_dict), op, value = rfilter
             # rfield : the field in self._target_class
-            tmp_rel_filter = dict()  # designed to store rel_field of same DS
+            # prepared filters may be shared (cache or compiled filters), so
+            # ref_dict is copied before being modified
+            ref_dict = copy.copy(ref_dict)
             # First step : simplification
             # Trying to delete relational filters done on referenced class uid
-            for tclass, tfield in copy.copy(ref_dict).items():
+            for tclass, tfield in list(ref_dict.items()):
                 # tclass : referenced target class
                 # tfield : referenced field from target class
                 #
@@ -215,32 +716,38 @@ class LeFilteredQuery(LeQuery):
                     ((rfield, ref_dict), op, value))
         # deduplication of std filters
         filters_cp = set()
-        if not isinstance(filters_orig, set):
-            for i, cfilt in enumerate(filters_orig):
-                a, b, c = cfilt
-                if isinstance(c, list):  # list are not hashable
-                    newc = tuple(c)
-                else:
-                    newc = c
-                old_len = len(filters_cp)
-                filters_cp |= set((a, b, newc))
-                if len(filters_cp) == old_len:
-                    del(filters_orig[i])
+        filters_dedup = list()
+        for cfilt in filters_orig:
+            a, b, c = cfilt
+            if isinstance(c, list):  # list are not hashable
+                c = tuple(c)
+            try:
+                if (a, b, c) in filters_cp:
+                    continue
+                filters_cp.add((a, b, c))
+            except TypeError:
+                pass  # unhashable value, no deduplication
+            filters_dedup.append(cfilt)
+        filters_orig = filters_dedup
         # Sets _query_filter attribute of self query
         self._query_filter = (filters_orig, result_rel_filters)
 
         # Sub queries creation
         subq = list()
-        for ds, rfilters in other_ds_filters.items():
-            for rfilter in rfilters:
-                (rfield, ref_dict), op, value = rfilter
-                for tclass, tfield in ref_dict.items():
-                    query = LeGetQuery(
-                        target_class=tclass,
-                        query_filters=[(tfield, op, value)],
-                        field_list=[tfield])
-                    subq.append((rfield, query))
+        filters_ids = list()
+        rfilters = [rfilter for ds_rfilters in other_ds_filters.values()
+                    for rfilter in ds_rfilters]
+        for filter_id, rfilter in enumerate(rfilters):
+            (rfield, ref_dict), op, value = rfilter
+            for tclass, tfield in ref_dict.items():
+                query = LeGetQuery(
+                    target_class=tclass,
+                    query_filters=[(tfield, op, value)],
+                    field_list=[tclass.uid_fieldname()[0]])
+                subq.append((rfield, query))
+                filters_ids.append(filter_id)
         self.subqueries = subq
+        self._subqueries_filters_ids = filters_ids
 
     # @return informations
     def dump_infos(self):
@@ -290,97 +797,140 @@ class LeFilteredQuery(LeQuery):
     # REF_FIELD is indicated the comparison will be done on identifier.
     #
     #@param cls
-    #@param filters_l list : This list of str or tuple (or both)
+    #@param target_class LeObject : class of object the filters are about
+    #@param filters_l list : This list of str, tuple or LeQueryFilter
     #@return a tuple(FILTERS, RELATIONNAL_FILTERS
     #@todo move this doc in another place (a dedicated page ?)
     #@warning Does not support multiple UID for an EmClass
-    def _prepare_filters(self, filters_l):
-        filters = list()
+    @classmethod
+    def _prepare_filters(cls, target_class, filters_l):
         res_filters = list()
         rel_filters = list()
         err_l = dict()
-        # Splitting in tuple if necessary
         for i, fil in enumerate(filters_l):
-            if len(fil) == 3 and not isinstance(fil, str):
-                filters.append(tuple(fil))
-            else:
-                try:
-                    filters.append(self.split_filter(fil))
-                except ValueError as e:
-                    err_l["filter %d" % i] = e
-
-        for field, operator, value in filters:
-            err_key = "%s %s %s" % (field, operator, value)  # to push in err_l
-            # Splitting field name to be able to detect a relational field
-            field_spl = field.split('.')
-            if len(field_spl) == 2:
-                field, ref_field = field_spl
-            elif len(field_spl) == 1:
-                ref_field = None
-            else:
-                err_l[field] = NameError("'%s' is not a valid relational \
-field name" % field)
-                continue
-            # Checking field against target_class
-            ret = self._check_field(self._target_class, field)
-            if isinstance(ret, Exception):
-                err_l[field] = ret
+            try:
+                if isinstance(fil, LeQueryFilter):
+                    relational, prepared = cls._prepare_filter(
+                        target_class, fil.field, fil.operator, fil.value)
+                elif len(fil) == 3 and not isinstance(fil, str):
+                    relational, prepared = cls._prepare_filter(
+                        target_class, *fil)
+                else:
+                    relational, prepared = cls._prepare_string_filter(
+                        target_class, fil)
+            except ValueError as e:
+                err_l["filter %d" % i] = e
                 continue
-            field_datahandler = self._target_class.field(field)
-            if isinstance(field_datahandler, Exception):
-                err_l[field] = field_datahandler
+            except LeApiDataCheckErrors as e:
+                err_l.update(e._exceptions)
                 continue
-            if ref_field is not None and not field_datahandler.is_reference():
-                # inconsistency
-                err_l[field] = NameError("The field '%s' in %s is not \
-a relational field, but %s.%s was present in the filter"
-                                         % (field,
-                                            self._target_class.__name__,
-                                            field,
-                                            ref_field))
-            if field_datahandler.is_reference():
-                # Relationnal field
-                if ref_field is None:
-                    # ref_field default value
-                    #
-                    #   !!! WARNING !!!
-                    # This piece of code does not supports multiple UID for an
-                    # emclass
-                    #
-                    ref_uid = [
-                        lc._uid[0] for lc in field_datahandler.linked_classes]
-
-                    if len(set(ref_uid)) == 1:
-                        ref_field = ref_uid[0]
-                    else:
-                        if len(ref_uid) > 1:
-                            msg = "The referenced classes are identified by \
-fields with different names. Unable to determine which field to use for the \
-reference"
-                        else:
-                            msg = "Unknow error when trying to determine which \
-field to use for the relational filter"
-                        err_l[err_key] = RuntimeError(msg)
-                        continue
-                # Prepares relational field
-                ret = self._prepare_relational_fields(field, ref_field)
-                if isinstance(ret, Exception):
-                    err_l[err_key] = ret
-                    continue
-                else:
-                    rel_filters.append((ret, operator, value))
+            if relational:
+                rel_filters.append(prepared)
             else:
-                value_orig = value
-                value, error = field_datahandler.check_data_value(value)
-                if isinstance(error, Exception):
-                    value = value_orig
-                res_filters.append((field, operator, value))
+                res_filters.append(prepared)
         if len(err_l) > 0:
             raise LeApiDataCheckErrors(
                 "Error while preparing filters : ",
                 err_l)
         return (res_filters, rel_filters)
 
+    ## @brief Splits and prepares a string filter, using a LRU cache
+    #
+    # The cache is keyed by (target class, filter string), so the same
+    # filter string is parsed and checked only once per target class.
+    #@param target_class LeObject : class of object the filter is about
+    #@param query_filter str : "FIELD OPERATOR VALUE" filter string
+    #@return a tuple(relational, prepared_filter) see
+    #LeFilteredQuery._prepare_filter()
+    #@throw ValueError if the filter string is invalid
+    #@throw LeApiDataCheckErrors if the filter is invalid for target_class
+    @classmethod
+    def _prepare_string_filter(cls, target_class, query_filter):
+        key = (target_class, query_filter)
+        with cls._filters_cache_lock:
+            if key in cls._filters_cache:
+                cls._filters_cache.move_to_end(key)
+                return cls._filters_cache[key]
+        res = cls._prepare_filter(target_class, *cls.split_filter(query_filter))
+        with cls._filters_cache_lock:
+            cls._filters_cache[key] = res
+            while len(cls._filters_cache) > cls._filters_cache_size:
+                cls._filters_cache.popitem(last=False)
+        return res
+
+    ## @brief Prepares a single filter
+    #@param target_class LeObject : class of object the filter is about
+    #@param field str : field name (FIELDNAME[.REF_FIELD])
+    #@param operator str : filter operator
+    #@param value mixed : filter value
+    #@return a tuple(relational, prepared_filter) with relational a boolean
+    # telling if prepared_filter is a relational filter
+    #@throw LeApiDataCheckErrors if the filter is invalid
+    @classmethod
+    def _prepare_filter(cls, target_class, field, operator, value):
+        err_key = "%s %s %s" % (field, operator, value)  # to push in err_l
+        # Splitting field name to be able to detect a relational field
+        field_spl = field.split('.')
+        if len(field_spl) == 2:
+            field, ref_field = field_spl
+        elif len(field_spl) == 1:
+            ref_field = None
+        else:
+            raise LeApiDataCheckErrors(
+                "Error while preparing filters : ",
+                {field: NameError("'%s' is not a valid relational field \
+name" % field)})
+        # Checking field against target_class
+        ret = cls._check_field(target_class, field)
+        if isinstance(ret, Exception):
+            raise LeApiDataCheckErrors(
+                "Error while preparing filters : ", {field: ret})
+        field_datahandler = target_class.field(field)
+        if ref_field is not None and not field_datahandler.is_reference():
+            # inconsistency
+            raise LeApiDataCheckErrors(
+                "Error while preparing filters : ",
+                {field: NameError("The field '%s' in %s is not a relational \
+field, but %s.%s was present in the filter" % (
+                    field, target_class.__name__, field, ref_field))})
+        if field_datahandler.is_reference():
+            # Relationnal field
+            if ref_field is None:
+                # ref_field default value
+                #
+                #   !!! WARNING !!!
+                # This piece of code does not supports multiple UID for an
+                # emclass
+                #
+                ref_uid = [
+                    lc._uid[0] for lc in field_datahandler.linked_classes]
+
+                if len(set(ref_uid)) == 1:
+                    ref_field = ref_uid[0]
+                else:
+                    if len(ref_uid) > 1:
+                        msg = "The referenced classes are identified by \
+fields with different names. Unable to determine which field to use for the \
+reference"
+                    else:
+                        msg = "Unknow error when trying to determine which \
+field to use for the relational filter"
+                    raise LeApiDataCheckErrors(
+                        "Error while preparing filters : ",
+                        {err_key: RuntimeError(msg)})
+            # Prepares relational field
+            ret = cls._prepare_relational_fields(
+                target_class, field, ref_field)
+            if isinstance(ret, Exception):
+                raise LeApiDataCheckErrors(
+                    "Error while preparing filters : ", {err_key: ret})
+            return (True, (ret, operator, value))
+        value_orig = value
+        value, error = field_datahandler.check_data_value(value)
+        if isinstance(error, Exception):
+            value = value_orig
+        return (False, (field, operator, value))
+
     ## @brief Checks and splits a query filter
     # @note The query_filter format is "FIELD OPERATOR VALUE"
     # @param query_filter str : A query_filter string
@@ -461,12 +1011,15 @@ field to use for the relational filter"
     #       [ 1,2,3,5 ])</pre>
     #@todo move the documentation to another place
     #
+    #@param target_class LeObject : class of object the filter is about
     #@param fieldname str : The relational field name
     #@param ref_field str|None : The referenced field name (if None uses
     # uniq identifiers as referenced field
     #@return a well formed relational filter tuple or an Exception instance
-    def _prepare_relational_fields(self, fieldname, ref_field=None):
-        datahandler = self._target_class.field(fieldname)
+    @classmethod
+    def _prepare_relational_fields(cls, target_class, fieldname,
+                                   ref_field=None):
+        datahandler = target_class.field(fieldname)
         # now we are going to fetch the referenced class to see if the
         # reference field is valid
         ref_classes = datahandler.linked_classes
@@ -500,6 +1053,7 @@ the relational filter %s"
 class LeInsertQuery(LeQuery):
     _hook_prefix = 'leapi_insert_'
     _data_check_args = {'complete': True, 'allow_internal': False}
+    _invalidates_identity_map = True
 
     def __init__(self, target_class):
         if target_class.is_abstract():
@@ -513,29 +1067,88 @@ abstract LeObject : %s" % target_class)
         data = self._target_class.prepare_datas(data, True, False)
         id_inserted = self._rw_datasource.insert(self._target_class, data)
         return id_inserted
-    """
-    ## @brief Implements an insert query operation, with multiple insertions
-    # @param data : list of **data to be inserted
-    def _query(self, data):
-        nb_inserted = self._datasource.insert_multi(
-            self._target_class,data_list)
-        if nb_inserted < 0:
-            raise LeApiQueryError("Multiple insertions error")
-        return nb_inserted
-    """
+
+    ## @brief Checks and constructs the data, the new uid is allocated
+    # @param data dict : data to be inserted
+    # @return the prepared data
+    def _bulk_prepare(self, data):
+        return self._target_class.prepare_datas(data, True, False)
+
+    def _bulk_ops(self, data):
+        return [('insert', self._target_class, data)]
+
+    ## @brief Implements an insert query operation, with multiple insertions
+    #
+    # Datas are checked once, UIDs are reserved in a single datasource call
+    # and all the records are sent to the datasource in one batch.
+    # @param datas_list list : list of dict of data to be inserted
+    # @return a list of inserted uids
+    # @throw LeApiDataCheckErrors if some records are invalid (no record is
+    # inserted)
+    def _query_multi(self, datas_list):
+        target = self._target_class
+        with self._stage('check'):
+            checked_list, errors = target.check_datas_values(
+                datas_list, **self._data_check_args)
+        err_l = {
+            'row %d' % i: LeApiDataCheckErrors(
+                "Error while checking datas", errors[i])
+            for i in sorted(errors)}
+        if len(err_l) > 0:
+            raise LeApiDataCheckErrors(
+                "Error while checking datas for multiple insert", err_l)
+        uid_name = target.uid_fieldname()[0]  # MULTIPLE UID BROKEN HERE
+        with self._stage('prepare'):
+            uids = self._rw_datasource.reserve_ids(target, len(checked_list))
+            prepared_list = list()
+            for uid, data in zip(uids, checked_list):
+                data[uid_name] = uid
+                data = target._construct_datas(data)
+                target._check_datas_consistency(data)
+                prepared_list.append(data)
+        with self._stage('datasource'):
+            return self._rw_datasource.insert_multi(target, prepared_list)
 
     #  @brief Executes the insert query
     def execute(self, data):
         return super().execute(data=data)
 
+    ## @brief Executes a multiple insert query
+    # @param datas_list list : list of dict of data to be inserted
+    # @return a list of inserted uids
+    def execute_multi(self, datas_list):
+        datas_list = list(datas_list)
+        profile_owner = self._profile_begin()
+        try:
+            with self._stage('pre_hooks'):
+                LodelHook.call_hook(self._hook_prefix + 'multi_pre',
+                                    self._target_class,
+                                    datas_list)
+            try:
+                ret = self._query_multi(datas_list)
+            finally:
+                LeIdentityMap.invalidate()
+            if self._profile is not None:
+                self._profile.rows = len(ret)
+            with self._stage('post_hooks'):
+                ret = LodelHook.call_hook(self._hook_prefix + 'multi_post',
+                                          self._target_class,
+                                          ret)
+        finally:
+            if profile_owner:
+                self._profile_end()
+        return ret
+
 
 ## @brief A query to update data for a given object
 #
-#@todo Change behavior, Huge optimization problem when updating using filters
-# and not instance. We have to run a GET and then one update by fetched object...
+#@note When updating using filters and not instance, a GET and one update by
+# fetched object are only needed for back references and constructed fields,
+# other fields are updated with a single set based update
 class LeUpdateQuery(LeFilteredQuery):
     _hook_prefix = 'leapi_update_'
     _data_check_args = {'complete': False, 'allow_internal': False}
+    _invalidates_identity_map = True
 
     ## @brief Instanciates an update query
     #
@@ -566,13 +1179,49 @@ target to LeUpdateQuery constructor"
 
         super().__init__(target_class, query_filters)
 
+    ## @brief Checks the data to update
+    # @return the checked values : _bulk_ops() does not check them again
+    def _check_data(self, data):
+        return self._target_class.check_datas_value(
+            data, **self._data_check_args)
+
     ## @brief Implements an update query
+    #
+    # When updating with filters, the fields that do not need a per record
+    # treatment are updated in one set based datasource call. Only the
+    # updated references having a back reference and the fields constructed
+    # from updated fields are handled record by record.
     #@param data dict : data to be updated
     #@return the number of updated items
     #@todo change stategy for instance update. Data should be allowed
     # for execute method (and query)
     def _query(self, data):
+        ops = self._bulk_ops(data)
+        return self._bulk_result(
+            [getattr(self._rw_datasource, op[0])(*op[1:]) for op in ops])
+
+    ## @brief Per record treatment is needed when updating with filters
+    # back references or fields constructed from updated fields
+    def _bulk_reads(self, data):
+        if super()._bulk_reads(data):
+            return True
+        if self.__leobject_instance_datas is not None:
+            return False
+        bref_fields, constructed_fields = \
+            self._target_class._update_dependencies(data.keys())
+        return len(bref_fields) > 0 or len(constructed_fields) > 0
+
+    ## @brief Returns the update operations
+    #
+    # With filters, the records are fetched (before the set based update
+    # modifies the records matching the filters) if a per record update
+    # is needed.
+    # @param data dict : checked data (see _check_data() )
+    # @see LeQuery._bulk_ops()
+    def _bulk_ops(self, data):
         uid_name = self._target_class._uid[0]
+        ## @brief Number of updated records when there is no set based update
+        self.__rows_count = None
         if self.__leobject_instance_datas is not None:
             # Instance update
             # Building query_filter
@@ -580,26 +1229,54 @@ target to LeUpdateQuery constructor"
                 uid_name,
                 '=',
                 str(self.__leobject_instance_datas[uid_name]))]
-            res = self._rw_datasource.update(
-                self._target_class, filters, [],
-                self.__leobject_instance_datas)
+            return [('update', self._target_class, filters, [],
+                     self.__leobject_instance_datas)]
+        target = self._target_class
+        std_filters, rel_filters = self._query_filter
+        bref_fields, constructed_fields = target._update_dependencies(
+            data.keys())
+        rows = None
+        if len(bref_fields) > 0 or len(constructed_fields) > 0:
+            # Fetching data before the set based update modifies the
+            # records matching the filters
+            rows = self._ro_datasource.select(
+                target, target.fieldnames(True), std_filters,
+                rel_filters)
+        set_data = {fname: value for fname, value in data.items()
+                    if fname not in bref_fields}
+        auto_fields = {fname for fname, fdh in target._fields.items()
+                       if getattr(fdh, 'now_on_update', False)}
+        ops = list()
+        if len(set_data) > 0:
+            for fname in auto_fields:
+                set_data[fname] = target._fields[fname].construct_data(
+                    target, fname, set_data, None)
+            ops.append(
+                ('update_many', target, std_filters, rel_filters, set_data))
         else:
-            # Update by filters, we have to fetch data before updating
-            res = self._ro_datasource.select(
-                self._target_class, self._target_class.fieldnames(True),
-                self._query_filter[0],
-                self._query_filter[1])
-            # Checking and constructing data
-            upd_data = dict()
-            for res_data in res:
-                res_data.update(data)
-                res_data = self._target_class.prepare_datas(
-                    res_data, True, True)
-                filters = [(uid_name, '=', res_data[uid_name])]
-                res = self._rw_datasource.update(
-                    self._target_class, filters, [],
-                    res_data)
-        return res
+            self.__rows_count = 0 if rows is None else len(rows)
+        if rows is not None:
+            # Per record update of the fields that need it. The datasource
+            # updates the back references from the differences between the
+            # stored record and the given data : every field having a back
+            # reference is given, missing ones would be seen as emptied
+            row_fields = bref_fields | constructed_fields | \
+                set(target.reference_handlers(True))
+            if len(set_data) == 0:
+                row_fields |= auto_fields
+            for row in rows:
+                row.update(data)
+                row = target.prepare_datas(row, True, True)
+                ops.append((
+                    'update', target, [(uid_name, '=', row[uid_name])], [],
+                    {fname: row[fname] for fname in row_fields}))
+        return ops
+
+    ## @return the number of updated records
+    def _bulk_result(self, results):
+        if self.__rows_count is not None:
+            return self.__rows_count
+        return results[0]
 
     #  @brief Execute the update query
     def execute(self, data=None):
@@ -615,6 +1292,7 @@ query on a class with filters")
 ## @brief A query to delete an object
 class LeDeleteQuery(LeFilteredQuery):
     _hook_prefix = 'leapi_delete_'
+    _invalidates_identity_map = True
 
     def __init__(self, target_class, query_filter):
         super().__init__(target_class, query_filter)
@@ -633,6 +1311,220 @@ class LeDeleteQuery(LeFilteredQuery):
             self._target_class, filters, rel_filters)
         return nb_deleted
 
+    def _bulk_ops(self, data=None):
+        filters, rel_filters = self._query_filter
+        return [('delete', self._target_class, filters, rel_filters)]
+
+
+## @brief A query to count objects matching filters
+#
+# The count is computed by the datasource : no object is fetched nor
+# instanciated
+class LeCountQuery(LeFilteredQuery):
+    _hook_prefix = 'leapi_count_'
+
+    ## @brief Instanciates a new count query
+    #@param target_class LeObject : class of object the query is about
+    #@param query_filters list : list of query filters
+    #@param limit int|None : if given stop counting when limit is reached
+    # (usefull for existence tests)
+    def __init__(self, target_class, query_filters, limit=None):
+        super().__init__(target_class, query_filters)
+        ## @brief Maximum value to count to
+        self._limit = None
+        if limit is not None:
+            try:
+                self._limit = int(limit)
+                if self._limit <= 0:
+                    raise ValueError()
+            except ValueError:
+                msg = "limit argument expected to be an interger > 0"
+                raise ValueError(msg)
+
+    ## @brief Executes the count query
+    def execute(self, data=None):
+        return super().execute()
+
+    ## @brief Implements count query operations
+    #@return an integer
+    def _query(self, data=None):
+        return self._ro_datasource.count(
+            target=self._target_class,
+            filters=self._query_filter[0],
+            relational_filters=self._query_filter[1],
+            limit=self._limit)
+
+    ## @brief Returns a dict with query infos
+    # @return a dict
+    def dump_infos(self):
+        ret = super().dump_infos()
+        ret['limit'] = self._limit
+        return ret
+
+
+## @brief A query computing metrics on groups of objects
+#
+# Groups and metrics are computed by the datasource (see
+# AbstractDatasource.aggregate() ), no object is fetched nor instanciated.
+# Results are dict with the group fields values and the metrics values :
+#<pre>LeAggregateQuery(Text, [], group_by = ['language'],
+#    metrics = {'n': 'count'}).execute()
+#[{'language': 'fr', 'n': 42}, {'language': 'en', 'n': 12}]</pre>
+#
+# A multiple reference group field is unwinded : a record referencing 3
+# objects is counted in 3 groups.
+class LeAggregateQuery(LeFilteredQuery):
+    _hook_prefix = 'leapi_aggregate_'
+
+    ## @brief Allowed metrics operators
+    metrics_operators = ('count', 'sum', 'avg', 'min', 'max')
+
+    ## @brief Instanciates a new aggregate query
+    #@param target_class LeObject : class of object the query is about
+    #@param query_filters list : list of query filters
+    #@param group_by list|None : names of the fields the records are grouped
+    # by (None or empty list means one group)
+    #@param metrics dict|None : metrics indexed by name. A metric is 'count'
+    # or a tuple (OPERATOR, FIELDNAME) with OPERATOR in
+    # LeAggregateQuery.metrics_operators
+    #@param order list|None : A list of group field or metric names or tuple
+    # (NAME,[ASC | DESC])
+    #@param limit int|None : The maximum number of returned groups
+    #@param offset int : offset
+    #@throw LeApiQueryErrors if a field or a metric is invalid
+    #@throw ValueError if order, limit or offset are invalid
+    def __init__(self, target_class, query_filters, group_by=None,
+                 metrics=None, order=None, limit=None, offset=0):
+        super().__init__(target_class, query_filters)
+        ## @brief Group fields names
+        self._group_by = list()
+        ## @brief Metrics (OPERATOR, FIELDNAME|None) indexed by name
+        self._metrics = OrderedDict()
+        ## @brief List of tuple (NAME, ASC|DESC)
+        self._order = None
+        ## @brief Maximum number of groups
+        self._limit = None
+        ## @brief Number of skipped groups
+        self._offset = 0
+        self.set_aggregation(group_by, metrics)
+        if order is not None:
+            self.set_order(order)
+        if limit is not None:
+            try:
+                self._limit = int(limit)
+                if self._limit <= 0:
+                    raise ValueError()
+            except ValueError:
+                msg = "limit argument expected to be an interger > 0"
+                raise ValueError(msg)
+        try:
+            self._offset = int(offset)
+            if self._offset < 0:
+                raise ValueError()
+        except ValueError:
+            msg = "offset argument expected to be an integer >= 0"
+            raise ValueError(msg)
+
+    ## @brief Sets the group fields and the metrics
+    #@param group_by list|None : group fields names
+    #@param metrics dict|None : metrics indexed by name
+    #@throw LeApiQueryErrors if a field or a metric is invalid
+    def set_aggregation(self, group_by, metrics):
+        group_by = list() if group_by is None else list(group_by)
+        metrics = dict() if metrics is None else metrics
+        err_l = dict()
+        for fname in group_by:
+            ret = self._check_field(self._target_class, fname)
+            if isinstance(ret, Exception):
+                err_l[fname] = ret
+        res_metrics = OrderedDict()
+        for name in sorted(metrics):
+            spec = metrics[name]
+            if name in group_by:
+                err_l[name] = NameError(
+                    "Metric name '%s' is also a group field" % name)
+                continue
+            if spec == 'count':
+                spec = ('count', None)
+            try:
+                operator, fname = spec
+            except (TypeError, ValueError):
+                err_l[name] = ValueError(
+                    "Invalid metric '%s' : %s" % (name, repr(spec)))
+                continue
+            if operator not in self.metrics_operators:
+                err_l[name] = ValueError(
+                    "Invalid metric operator '%s'" % operator)
+                continue
+            if fname is not None:
+                ret = self._check_field(self._target_class, fname)
+                if isinstance(ret, Exception):
+                    err_l[name] = ret
+                    continue
+            elif operator != 'count':
+                err_l[name] = ValueError(
+                    "A field is expected for metric operator '%s'" % operator)
+                continue
+            res_metrics[name] = (operator, fname)
+        if len(err_l) > 0:
+            msg = "Error while setting aggregation in an aggregate query"
+            raise LeApiQueryErrors(msg=msg, exceptions=err_l)
+        self._group_by = group_by
+        self._metrics = res_metrics
+
+    ## @brief Sets the groups order
+    #@param order list : A list of group field or metric names or tuple
+    # (NAME,[ASC | DESC])
+    #@throw ValueError if order is invalid
+    def set_order(self, order):
+        res = list()
+        for item in order:
+            if isinstance(item, str):
+                item = (item, 'ASC')
+            name, direction = item
+            direction = direction.upper()
+            if direction not in ('ASC', 'DESC'):
+                raise ValueError("Invalid order direction '%s'" % direction)
+            if name not in self._group_by and name not in self._metrics:
+                raise ValueError(
+                    "Cannot order by '%s' : not a group field nor a metric" % (
+                        name))
+            res.append((name, direction))
+        self._order = res
+
+    ## @brief Executes the aggregate query
+    def execute(self, data=None):
+        return super().execute()
+
+    ## @brief Returns the result of an aggregate query matching nothing
+    # @return an empty list
+    def _empty_result(self):
+        return list()
+
+    ## @brief Implements aggregate query operations
+    #@return a list of dict
+    def _query(self, data=None):
+        return self._ro_datasource.aggregate(
+            target=self._target_class,
+            filters=self._query_filter[0],
+            relational_filters=self._query_filter[1],
+            group_by=list(self._group_by),
+            metrics=OrderedDict(self._metrics),
+            order=self._order,
+            limit=self._limit,
+            offset=self._offset)
+
+    ## @brief Returns a dict with query infos
+    # @return a dict
+    def dump_infos(self):
+        ret = super().dump_infos()
+        ret.update({'group_by': self._group_by,
+                    'metrics': self._metrics,
+                    'order': self._order,
+                    'limit': self._limit,
+                    'offset': self._offset})
+        return ret
+
 
 class LeGetQuery(LeFilteredQuery):
     _hook_prefix = 'leapi_get_'
@@ -647,6 +1539,10 @@ class LeGetQuery(LeFilteredQuery):
     #   - group list : A list of field names or tuple (FIELDNAME,[ASC | DESC])
     #   - limit int : The maximum number of returned results
     #   - offset int : offset
+    #   - after tuple|str|None : keyset pagination, see
+    #@ref LeGetQuery.set_after()
+    #   - prefetch list|None : reference fields to prefetch, see
+    #@ref LeGetQuery.set_prefetch()
     def __init__(self, target_class, query_filters, **kwargs):
         super().__init__(target_class, query_filters)
         ## @brief The fields to get
@@ -659,11 +1555,17 @@ class LeGetQuery(LeFilteredQuery):
         self._limit = None
         ## @brief An equivalent to the SQL LIMIT x, OFFSET
         self._offset = 0
+        ## @brief Keyset pagination : values of the sort keys of the last
+        # record of the previous page
+        self._after = None
+        ## @brief Reference fields whose referenced objects are prefetched
+        self._prefetch = None
 
         # Checking kwargs and assigning default values if there is some
         for argname in kwargs:
             if argname not in (
-                    'field_list', 'order', 'group', 'limit', 'offset'):
+                    'field_list', 'order', 'group', 'limit', 'offset',
+                    'after', 'prefetch'):
                 raise TypeError("Unexpected argument '%s'" % argname)
 
         if 'field_list' not in kwargs:
@@ -693,6 +1595,155 @@ class LeGetQuery(LeFilteredQuery):
             except ValueError:
                 msg = "offset argument expected to be an integer >= 0"
                 raise ValueError(msg)
+        if 'after' in kwargs and kwargs['after'] is not None:
+            self.set_after(kwargs['after'])
+        if 'prefetch' in kwargs and kwargs['prefetch'] is not None:
+            self.set_prefetch(kwargs['prefetch'])
+
+    ## @brief Set the reference fields to prefetch
+    #
+    # The query only checks the fields and makes sure that they are fetched,
+    # referenced objects are fetched and attached to instances by
+    # LeObject.get()
+    #@param prefetch list : reference field names
+    #@throw LeApiQueryErrors if a field is unknown or is not a reference
+    def set_prefetch(self, prefetch):
+        err_l = dict()
+        for fname in prefetch:
+            ret = self._check_field(self._target_class, fname)
+            if isinstance(ret, Exception):
+                err_l[fname] = ret
+            elif not self._target_class.field(fname).is_reference():
+                err_l[fname] = NameError("The field '%s' in %s is not a \
+reference" % (fname, self._target_class.__name__))
+        if len(err_l) > 0:
+            msg = "Error while setting prefetch in a get query"
+            raise LeApiQueryErrors(msg=msg, exceptions=err_l)
+        self._prefetch = list(prefetch)
+        if self._field_list is not None:
+            self._field_list = list(set(self._field_list) | set(prefetch))
+
+    ## @brief Enables keyset (seek) pagination
+    #
+    # Instead of skipping offset records, the query returns the records
+    # coming after the given sort key in the keyset order (the query order
+    # followed by the uid field, see LeGetQuery.keyset_order()). The
+    # datasource pushes it down as a range filter on the sort fields.
+    #
+    # An empty tuple means first page : the keyset order is applied with no
+    # range filter.
+    #@param after tuple|list|str : the keyset order values of the last
+    # record of the previous page or a continuation token (see
+    # LeGetQuery.continuation_token())
+    #@throw ValueError if after is invalid or used with offset or group
+    def set_after(self, after):
+        if self._offset != 0:
+            raise ValueError("offset and after arguments can't be used \
+together")
+        if self._group is not None:
+            raise ValueError("after argument can't be used with group")
+        self._order = self.keyset_order(self._target_class, self._order)
+        if isinstance(after, str):
+            after = self.decode_token(self._order, after)
+        after = tuple(after)
+        if len(after) == 0:
+            self._after = None
+            return
+        if len(after) != len(self._order):
+            raise ValueError("after argument expected to have %d values \
+(%s) but %d given" % (
+                len(self._order), ', '.join(f for f, _ in self._order),
+                len(after)))
+        checked = list()
+        for (fname, _), value in zip(self._order, after):
+            cvalue, error = self._target_class.field(fname).check_data_value(
+                value)
+            checked.append(value if isinstance(error, Exception) else cvalue)
+        self._after = tuple(checked)
+
+    ## @brief Returns the keyset order for a class
+    #
+    # Order items are normalized as tuple(FIELDNAME, 'ASC'|'DESC') and the
+    # uid field is appended to make the order total.
+    #@param target_class LeObject : class of object the query is about
+    #@param order list|None : A list of field names or tuple
+    # (FIELDNAME,[ASC | DESC])
+    #@return a list of tuple (FIELDNAME, 'ASC'|'DESC')
+    #@warning Does not support multiple UID
+    @classmethod
+    def keyset_order(cls, target_class, order):
+        res = list()
+        for item in ([] if order is None else order):
+            if isinstance(item, str):
+                item = (item, 'ASC')
+            fname, direction = item
+            direction = direction.upper()
+            if direction not in ('ASC', 'DESC'):
+                raise ValueError("Invalid order direction '%s'" % direction)
+            if isinstance(cls._check_field(target_class, fname), Exception):
+                raise ValueError("No field named '%s' in %s" % (
+                    fname, target_class.__name__))
+            res.append((fname, direction))
+        uid_name = target_class.uid_fieldname()[0]
+        if uid_name not in [fname for fname, _ in res]:
+            res.append((uid_name, 'ASC'))
+        return res
+
+    ## @brief Forges a continuation token
+    #@param order list : keyset order as returned by LeGetQuery.keyset_order()
+    #@param record dict|LeObject : the last record of a page
+    #@return an url safe str
+    @classmethod
+    def continuation_token(cls, order, record):
+        if isinstance(record, dict):
+            values = [record[fname] for fname, _ in order]
+        else:
+            values = [record.data(fname) for fname, _ in order]
+        token = json.dumps(
+            {'o': order, 'k': values},
+            default=cls.__token_encode_value,
+            separators=(',', ':'))
+        return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+    ## @brief Decodes a continuation token
+    #@param order list : keyset order as returned by LeGetQuery.keyset_order()
+    #@param token str : as returned by LeGetQuery.continuation_token()
+    #@return a tuple of values
+    #@throw ValueError if the token is invalid or doesn't match order
+    @classmethod
+    def decode_token(cls, order, token):
+        try:
+            token = json.loads(
+                base64.urlsafe_b64decode(token.encode('ascii')).decode(
+                    'utf-8'),
+                object_hook=cls.__token_decode_value)
+            token_order = [tuple(item) for item in token['o']]
+            values = tuple(token['k'])
+        except (ValueError, TypeError, KeyError) as e:
+            raise ValueError("Invalid continuation token : %s" % e)
+        if token_order != list(order):
+            raise ValueError("Continuation token was forged for another \
+order : %s" % token_order)
+        return values
+
+    ## @brief json.dumps() default function for continuation tokens
+    @staticmethod
+    def __token_encode_value(value):
+        if isinstance(value, datetime.datetime):
+            return {'$dt': value.isoformat()}
+        if isinstance(value, (set, tuple)):
+            return list(value)
+        raise TypeError("%s can't be stored in a continuation token" % (
+            type(value),))
+
+    ## @brief json.loads() object_hook for continuation tokens
+    @staticmethod
+    def __token_decode_value(value):
+        if len(value) == 1 and '$dt' in value:
+            return datetime.datetime.strptime(
+                value['$dt'], '%Y-%m-%dT%H:%M:%S.%f' \
+                    if '.' in value['$dt'] else '%Y-%m-%dT%H:%M:%S')
+        return value
 
     ## @brief Set the field list
     # @param field_list list | None : If None use all fields
@@ -717,6 +1768,47 @@ class LeGetQuery(LeFilteredQuery):
     def execute(self, data=None):
         return super().execute()
 
+    ## @brief Executes the get query and returns an iterator on results
+    #
+    # Unlike execute() the results are not materialized in a list : they are
+    # fetched lazily from the datasource by batches. The post hook called is
+    # leapi_get_iter_post, its payload is the results iterator, callbacks
+    # can wrap it but should not consume it.
+    #@param batch_size int|None : number of records fetched by datasource
+    # round trip (None means datasource default)
+    #@return an iterator on dict
+    def execute_iter(self, batch_size=None):
+        if batch_size is not None:
+            try:
+                batch_size = int(batch_size)
+                if batch_size <= 0:
+                    raise ValueError()
+            except ValueError:
+                msg = "batch_size argument expected to be an interger > 0"
+                raise ValueError(msg)
+        orig_filters = self._query_filter
+        try:
+            self._query_filter = self._subqueries_filters()
+            LodelHook.call_hook(self._hook_prefix + 'pre',
+                                self._target_class,
+                                None)
+            if self._no_match:
+                ret = iter(())
+            else:
+                ret = self._query_iter(batch_size)
+        finally:
+            self._query_filter = orig_filters
+            self._no_match = False
+        ret = LodelHook.call_hook(self._hook_prefix + 'iter_post',
+                                  self._target_class,
+                                  ret)
+        return ret
+
+    ## @brief Returns the result of a get query matching nothing
+    # @return an empty list
+    def _empty_result(self):
+        return list()
+
     ## @brief Implements select query operations
     # @return a list containing the item(s)
     def _query(self, data=None):
@@ -730,9 +1822,27 @@ class LeGetQuery(LeFilteredQuery):
             order=self._order,
             group=self._group,
             limit=self._limit,
-            offset=self._offset)
+            offset=self._offset,
+            after=self._after)
         return l_data
 
+    ## @brief Implements lazy select query operations
+    # @param batch_size int|None
+    # @return an iterator on item(s)
+    def _query_iter(self, batch_size=None):
+        fl = list(self._field_list) if self._field_list is not None else None
+        return self._ro_datasource.select_iter(
+            target=self._target_class,
+            field_list=fl,
+            filters=list(self._query_filter[0]),
+            relational_filters=list(self._query_filter[1]),
+            order=self._order,
+            group=self._group,
+            limit=self._limit,
+            offset=self._offset,
+            after=self._after,
+            batch_size=batch_size)
+
     ## @brief Returns a dict with query infos
     # @return a dict
     def dump_infos(self):
@@ -742,6 +1852,8 @@ class LeGetQuery(LeFilteredQuery):
                     'group': self._group,
                     'limit': self._limit,
                     'offset': self._offset,
+                    'after': self._after,
+                    'prefetch': self._prefetch,
                     })
         return ret
 
@@ -750,7 +1862,7 @@ class LeGetQuery(LeFilteredQuery):
     def __repr__(self):
         res = "<LeGetQuery target={target_class} filter={query_filter} \
 field_list={field_list} order={order} group={group} limit={limit} \
-offset={offset}"
+offset={offset} after={after}"
         res = res.format(**self.dump_infos())
         if len(self.subqueries) > 0:
             for n, subq in enumerate(self.subqueries):
@@ -0,0 +1,183 @@
+#
+# This file is part of Lodel 2 (https://github.com/OpenEdition)
+#
+# Copyright (C) 2015-2017 Cléo UMS-3287
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+## @package lodel.leapi.session
+# This module defines the LeSession class, a unit of work batching write
+# queries.
+#
+# While a session is opened, the inserts, updates and deletes issued through
+# LeObject.insert(), LeObject.update(), LeObject.delete() and
+# LeObject.delete_bundle() are queued. They are written when the session is
+# closed :
+#<pre>with LeSession() as session:
+#    for text in texts:
+#        text.update({'title': 'foo'}) # queued
+## the updates are written here in one bulk write</pre>
+#
+# Data are checked when a query is queued, so LeApiDataCheckErrors are
+# raised by the LeObject method call. The uid of an inserted object is
+# allocated and returned at this time too. Updates and deletes return None,
+# their results are returned by LeSession.flush().
+#
+# On flush the queued queries are converted in datasource operations, in
+# order, and sent with one AbstractDatasource.bulk_write() call per
+# datasource. The operations of a query that reads records (an update with
+# filters of back referenced fields, or a query with relational filters on
+# classes stored in another datasource, for example) are built after the
+# previous operations are written.
+#
+# Hooks are called in a batched form : the queries are grouped by type and
+# target class, the leapi_insert_multi_pre, leapi_update_multi_pre and
+# leapi_delete_multi_pre hooks are called with the list of queries data as
+# payload and the leapi_*_multi_post hooks with the list of results.
+#
+# If the with block raises an exception, the queued queries are discarded.
+
+import threading
+from collections import OrderedDict
+
+from lodel.context import LodelContext
+LodelContext.expose_modules(globals(), {
+    'lodel.plugin.hooks': ['LodelHook'],
+    'lodel.leapi.identity_map': ['LeIdentityMap'],
+    'lodel.logger': 'logger'})
+
+
+## @brief Unit of work queuing LeAPI write queries
+#
+# Sessions are stored in a per thread stack : sessions can be nested, the
+# write queries are queued in the last opened session.
+class LeSession(object):
+
+    ## @brief Per thread stack of opened sessions
+    _local = threading.local()
+
+    def __init__(self):
+        ## @brief Queued (LeQuery, data) tuples
+        self.__queue = list()
+
+    ## @brief Returns the session in use in the current thread
+    # @return a LeSession instance or None if no session is opened
+    @classmethod
+    def current(cls):
+        stack = cls.__stack()
+        return stack[-1] if len(stack) > 0 else None
+
+    ## @return the current thread sessions stack
+    @classmethod
+    def __stack(cls):
+        if not hasattr(cls._local, 'stack'):
+            cls._local.stack = list()
+        return cls._local.stack
+
+    def __enter__(self):
+        self.__stack().append(self)
+        return self
+
+    ## @brief Closes the session, flushing it unless an exception was raised
+    def __exit__(self, exc_type, exc_value, traceback):
+        stack = self.__stack()
+        if len(stack) > 0 and stack[-1] is self:
+            stack.pop()
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+        return False
+
+    ## @brief Queues a write query
+    # @param query LeQuery : an insert, update or delete query
+    # @param data * : the query data
+    # @return the checked (and constructed for an insert) data
+    # @throw LeApiDataCheckErrors if data are invalid
+    def add(self, query, data=None):
+        data = query._bulk_prepare(data)
+        self.__queue.append((query, data))
+        return data
+
+    ## @brief Removes the queued queries
+    def discard(self):
+        if len(self.__queue) > 0:
+            logger.debug("%d queued queries discarded" % len(self.__queue))
+        self.__queue = list()
+
+    ## @brief Writes the queued queries
+    # @return the list of the queries results, in queue order
+    def flush(self):
+        queue, self.__queue = self.__queue, list()
+        if len(queue) == 0:
+            return []
+        groups = OrderedDict()
+        for i, (query, _) in enumerate(queue):
+            groups.setdefault(
+                (query._hook_prefix, query._target_class), []).append(i)
+        for (hook_prefix, target_class), indexes in groups.items():
+            LodelHook.call_hook(hook_prefix + 'multi_pre', target_class,
+                                [queue[i][1] for i in indexes])
+        try:
+            results = self.__write(queue)
+        finally:
+            LeIdentityMap.invalidate()
+        for (hook_prefix, target_class), indexes in groups.items():
+            ret = LodelHook.call_hook(hook_prefix + 'multi_post', target_class,
+                                      [results[i] for i in indexes])
+            for i, res in zip(indexes, ret):
+                results[i] = res
+        return results
+
+    ## @brief Converts the queries in operations and writes them
+    # @param queue list : (LeQuery, data) tuples
+    # @return the list of the queries results
+    def __write(self, queue):
+        results = [None] * len(queue)
+        # Pending operations by datasource : [datasource, operations,
+        # (queue index, operations count) list]
+        pending = OrderedDict()
+        for i, (query, data) in enumerate(queue):
+            if query._bulk_reads(data):
+                self.__write_pending(pending, queue, results)
+            ops = query._datasource_bulk_ops(data)
+            datasource = query._rw_datasource
+            if id(datasource) not in pending:
+                pending[id(datasource)] = (datasource, list(), list())
+            _, ds_ops, ds_queries = pending[id(datasource)]
+            ds_ops.extend(ops)
+            ds_queries.append((i, len(ops)))
+        self.__write_pending(pending, queue, results)
+        return results
+
+    ## @brief Writes pending operations with one bulk write per datasource
+    # @param pending OrderedDict : see __write()
+    # @param queue list : (LeQuery, data) tuples
+    # @param results list : queries results, updated by this method
+    @staticmethod
+    def __write_pending(pending, queue, results):
+        for datasource, ds_ops, ds_queries in pending.values():
+            # the queries may match nothing (see LeFilteredQuery._no_match)
+            ds_results = datasource.bulk_write(ds_ops) \
+                if len(ds_ops) > 0 else []
+            start = 0
+            for i, count in ds_queries:
+                results[i] = queue[i][0]._datasource_bulk_result(
+                    ds_results[start:start + count])
+                start += count
+        pending.clear()
+
+    def __len__(self):
+        return len(self.__queue)
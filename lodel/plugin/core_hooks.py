@@ -58,6 +58,24 @@ def datasources_bootstrap_hook(hook_name, caller, payload):
         log_msg %= (ds_name, identifier)
         logger.debug(log_msg)
 
+## @brief Bootstrap hook that configures the leapi queries
+# @param hook_name str
+# @param caller * : the hook's caller
+# @param payload * : data to be given to the hook
+@LodelHook('lodel2_bootstraped')
+def leapi_queries_bootstrap_hook(hook_name, caller, payload):
+    LodelContext.expose_modules(globals(), {
+        'lodel.leapi.query': ['LeFilteredQuery']})
+    LeFilteredQuery.set_subqueries_workers(Settings.subqueries_workers)
+
+## @brief Bootstrap hook that enables the hooks stats if configured
+# @param hook_name str
+# @param caller * : the hook's caller
+# @param payload * : data to be given to the hook
+@LodelHook('lodel2_bootstraped')
+def hooks_stats_bootstrap_hook(hook_name, caller, payload):
+    LodelHook.set_stats(Settings.hooks_stats)
+
 ## @brief Bootstrap hook that prints debug infos about registered hooks
 # @param name str
 # @param caller * : the hook's caller
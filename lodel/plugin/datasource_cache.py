@@ -0,0 +1,279 @@
+#
+# This file is part of Lodel 2 (https://github.com/OpenEdition)
+#
+# Copyright (C) 2015-2017 Cléo UMS-3287
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+## @package lodel.plugin.datasource_cache Read-through cache for read only
+# datasources
+#
+# A CachedDatasource wraps a datasource instance and keeps the results of
+# small selects (uid lookups for example) in a DatasourceCache. Cache entries
+# are evicted in LRU order when the cache holds too many records, and expire
+# after a TTL.
+#
+# Entries are invalidated by the leapi_*_post hooks fired by LeQuery.execute()
+# : a write on a class invalidates the entries about this class, its parent
+# and child classes, and the classes updated by its back references.
+#
+# The cache is enabled per datasource in the configuration :
+#<pre>
+#[lodel2.datasources.main]
+#identifier = mongodb_datasource.default
+#cache_size = 10000
+#cache_ttl = 300
+#</pre>
+# Only the read only datasource instances are wrapped (see
+# DatasourcePlugin.init_datasource() ).
+
+import copy
+import time
+import threading
+import weakref
+from collections import OrderedDict
+
+from lodel.context import LodelContext
+LodelContext.expose_modules(globals(), {
+    'lodel.plugin.datasource_plugin': ['AbstractDatasource'],
+    'lodel.plugin.hooks': ['LodelHook'],
+    'lodel.logger': 'logger'})
+
+
+## @brief Stores select results indexed by query
+#
+# The memory bound is expressed in records : each entry costs the number of
+# records it holds (at least 1).
+class DatasourceCache(object):
+
+    ## @brief All the existing caches, notified by the invalidation hooks
+    _instances = weakref.WeakSet()
+
+    ##
+    # @param size int : maximum number of cached records
+    # @param ttl int|None : entries lifetime in seconds (None for no expiration)
+    # @param max_result int : results with more records are not cached
+    def __init__(self, size, ttl=None, max_result=100):
+        self.size = size
+        self.ttl = ttl
+        self.max_result = max_result
+        ## @brief Entries (expiration time, deps, records) indexed by key
+        self.__entries = OrderedDict()
+        ## @brief Keys indexed by the LeObject classes they depend on
+        self.__deps = dict()
+        ## @brief Number of cached records
+        self.__cost = 0
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._instances.add(self)
+
+    ## @brief Fetches an entry
+    # @param key str
+    # @return a copy of the cached records or None if not found
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key, None)
+            if entry is not None and entry[0] is not None \
+                    and entry[0] < time.monotonic():
+                self.__remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[2])
+
+    ## @brief Stores an entry
+    # @param key str
+    # @param deps iterable : LeObject classes the records depend on
+    # @param records list : select result
+    # @return False if the result was too big to be cached else True
+    def set(self, key, deps, records):
+        if len(records) > self.max_result:
+            return False
+        expire = None if self.ttl is None else time.monotonic() + self.ttl
+        records = copy.deepcopy(records)
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            deps = frozenset(deps)
+            self.__entries[key] = (expire, deps, records)
+            self.__cost += self.__entry_cost(records)
+            for dep in deps:
+                self.__deps.setdefault(dep, set()).add(key)
+            while self.__cost > self.size and len(self.__entries) > 0:
+                self.__remove(next(iter(self.__entries)))
+        return True
+
+    ## @brief Invalidates the entries about a class
+    #
+    # Entries depending on a parent or a child class are invalidated too.
+    # @param leo_cls LeObject child class
+    # @return the number of invalidated entries
+    def invalidate(self, leo_cls):
+        count = 0
+        with self.__lock:
+            for dep in [dep for dep in self.__deps
+                        if issubclass(dep, leo_cls)
+                        or issubclass(leo_cls, dep)]:
+                for key in list(self.__deps.get(dep, ())):
+                    self.__remove(key)
+                    count += 1
+        return count
+
+    ## @brief Removes all the entries
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__deps.clear()
+            self.__cost = 0
+
+    ## @brief Removes an entry, the lock has to be held
+    # @param key str
+    def __remove(self, key):
+        _, deps, records = self.__entries.pop(key)
+        self.__cost -= self.__entry_cost(records)
+        for dep in deps:
+            keys = self.__deps[dep]
+            keys.discard(key)
+            if len(keys) == 0:
+                del(self.__deps[dep])
+
+    @staticmethod
+    def __entry_cost(records):
+        return max(1, len(records))
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+## @brief Datasource wrapper caching select results
+#
+# Methods other than select() are forwarded to the wrapped datasource.
+class CachedDatasource(AbstractDatasource):
+
+    ##
+    # @param datasource AbstractDatasource : the wrapped datasource instance
+    # @param cache DatasourceCache : the cache (can be shared by wrappers of
+    # the same datasource)
+    def __init__(self, datasource, cache):
+        self._datasource = datasource
+        self._cache = cache
+
+    ## @brief Returns a selection of documents, from the cache if possible
+    # @see AbstractDatasource.select()
+    def select(self, target, field_list, filters, relational_filters=None,
+               order=None, group=None, limit=None, offset=0, after=None):
+        key = repr((target, field_list, filters, relational_filters, order,
+                    group, limit, offset, after))
+        res = self._cache.get(key)
+        if res is None:
+            res = self._datasource.select(
+                target, field_list, filters, relational_filters, order=order,
+                group=group, limit=limit, offset=offset, after=after)
+            self._cache.set(
+                key, self._dependencies(target, relational_filters), res)
+        return res
+
+    ## @brief Returns the classes a select result depends on
+    # @param target LeObject child class
+    # @param rel_filters list|None : relational filters
+    # @return a set of LeObject child classes
+    @staticmethod
+    def _dependencies(target, rel_filters):
+        deps = {target}
+        for (_, ref_dict), _, _ in rel_filters or ():
+            deps |= set(ref_dict.keys())
+        return deps
+
+    def new_numeric_id(self, emcomp):
+        return self._datasource.new_numeric_id(emcomp)
+
+    def reserve_ids(self, emcomp, n):
+        return self._datasource.reserve_ids(emcomp, n)
+
+    def select_iter(self, target, field_list, filters, relational_filters=None,
+                    order=None, group=None, limit=None, offset=0,
+                    after=None, batch_size=None):
+        return self._datasource.select_iter(
+            target, field_list, filters, relational_filters, order=order,
+            group=group, limit=limit, offset=offset, after=after,
+            batch_size=batch_size)
+
+    def count(self, target, filters, relational_filters=None, limit=None):
+        return self._datasource.count(
+            target, filters, relational_filters, limit=limit)
+
+    def aggregate(self, target, filters, relational_filters, group_by,
+                  metrics, order=None, limit=None, offset=0):
+        return self._datasource.aggregate(
+            target, filters, relational_filters, group_by, metrics,
+            order=order, limit=limit, offset=offset)
+
+    def delete(self, target, filters, relational_filters):
+        return self._datasource.delete(target, filters, relational_filters)
+
+    def update(self, target, filters, relational_filters, upd_datas):
+        return self._datasource.update(
+            target, filters, relational_filters, upd_datas)
+
+    def update_many(self, target, filters, relational_filters, upd_datas):
+        return self._datasource.update_many(
+            target, filters, relational_filters, upd_datas)
+
+    def insert(self, target, new_datas):
+        return self._datasource.insert(target, new_datas)
+
+    def insert_multi(self, target, datas_list):
+        return self._datasource.insert_multi(target, datas_list)
+
+    def bulk_write(self, operations):
+        return self._datasource.bulk_write(operations)
+
+    ## @brief Gives access to the wrapped datasource specific attributes
+    def __getattr__(self, name):
+        return getattr(self.__dict__['_datasource'], name)
+
+
+## @brief Returns the classes modified by a write query
+# @param leo_cls LeObject child class : the query target
+# @return a set of LeObject child classes
+def touched_classes(leo_cls):
+    res = {leo_cls}
+    for fdh in leo_cls.reference_handlers(True).values():
+        res |= set(fdh.linked_classes)
+    return res
+
+
+## @brief Hook invalidating the cache entries after a write query
+# @param hook_name str
+# @param caller LeObject child class : the query target
+# @param payload * : the query result, returned unchanged
+@LodelHook('leapi_insert_post')
+@LodelHook('leapi_insert_multi_post')
+@LodelHook('leapi_update_post')
+@LodelHook('leapi_update_multi_post')
+@LodelHook('leapi_delete_post')
+@LodelHook('leapi_delete_multi_post')
+def datasource_cache_invalidation_hook(hook_name, caller, payload):
+    classes = touched_classes(caller)
+    for cache in list(DatasourceCache._instances):
+        count = sum(cache.invalidate(leo_cls) for leo_cls in classes)
+        if count > 0:
+            logger.debug("%d datasource cache entries invalidated by %s on \
+%s" % (count, hook_name, caller.__name__))
+    return payload
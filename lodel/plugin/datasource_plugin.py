@@ -23,6 +23,8 @@
 # It contains the base classes for all the datasource plugins that could be added to Lodel
 
 
+from collections import OrderedDict
+
 from lodel.context import LodelContext
 LodelContext.expose_modules(globals(), {
     'lodel.plugin.plugins': ['Plugin'],
@@ -38,6 +40,9 @@ _glob_typename = 'datasource'
 
 ## @brief Main abstract class from which the plugins' datasource classes must inherit.
 class AbstractDatasource(object):
+
+    ## @brief Methods allowed in bulk_write() operations
+    _bulk_methods = ('insert', 'update', 'update_many', 'delete')
     
     ## @brief Trigger LodelFatalError when abtract method called
     # @throw LodelFatalError if there is an attempt to instanciate an object from this class
@@ -58,6 +63,22 @@ reimplemented by plugin datasource child class")
     def new_numeric_id(self, emcomp):
         self._abs_err()
 
+    ## @brief Reserves a block of new uniq numeric IDs
+    #
+    # Default implementation returns the n ids following the one given by a
+    # single new_numeric_id() call : nothing is inserted between the calls,
+    # so a datasource computing new ids from the greatest stored one would
+    # return the same id n times. Datasources able to allocate a block
+    # atomically should reimplement this method.
+    # @param emcomp LeObject subclass (not instance) : defines against which objects type the ids should be unique
+    # @param n int : number of ids to reserve
+    # @return a list of int
+    def reserve_ids(self, emcomp, n):
+        if n <= 0:
+            return []
+        first_id = self.new_numeric_id(emcomp)
+        return list(range(first_id, first_id + n))
+
     ## @brief Returns a selection of documents from the datasource
     # @param target Emclass : class of the documents
     # @param field_list list : fields to get from the datasource
@@ -68,11 +89,131 @@ reimplemented by plugin datasource child class")
     # @param limit int : Number of records to be returned (default value None)
     # @param offset int: used with limit to choose the start record (default value : 0)
     # @param instanciate bool : If true, the records are returned as instances, else they are returned as dict (default value : True)
+    # @param after tuple : keyset pagination, values of the order fields of the last record of the previous page. When given, order is complete (it ends with the uid field) and only records coming after these values in this order are returned (default value : None)
     # @return list
     def select(self, target, field_list, filters, rel_filters=None, order=None, group=None, limit=None, offset=0,
-               instanciate=True):
+               instanciate=True, after=None):
+        self._abs_err()
+
+    ## @brief Returns an iterator on a selection of documents
+    #
+    # Default implementation materializes the select() result. Datasources
+    # able to stream records should reimplement this method.
+    # @param target Emclass : class of the documents
+    # @param field_list list : fields to get from the datasource
+    # @param filters list : List of filters
+    # @param relational_filters list : List of relational filters (default value : None)
+    # @param order list : List of column to order (default value : None)
+    # @param group list : List of tupple representing the column to group together (default value : None)
+    # @param limit int : Number of records to be returned (default value None)
+    # @param offset int: used with limit to choose the start record (default value : 0)
+    # @param after tuple : keyset pagination (see select()) (default value : None)
+    # @param batch_size int : Number of records fetched by round trip (default value : None)
+    # @return an iterator on dict
+    def select_iter(self, target, field_list, filters, relational_filters=None,
+                    order=None, group=None, limit=None, offset=0,
+                    after=None, batch_size=None):
+        return iter(self.select(target, field_list, filters,
+                                relational_filters, order=order, group=group,
+                                limit=limit, offset=offset, after=after))
+
+    ## @brief Counts the records matching given filters
+    # @param target Emclass : class of the records to count
+    # @param filters list : List of filters
+    # @param relational_filters list : List of relational filters (default value : None)
+    # @param limit int : if given, stop counting when limit is reached (default value : None)
+    # @return int : number of matching records
+    def count(self, target, filters, relational_filters=None, limit=None):
         self._abs_err()
 
+    ## @brief Computes metrics on groups of records
+    #
+    # Default implementation fetches the needed fields with select_iter()
+    # and computes the groups in python. Datasources able to group records
+    # on the server side should reimplement this method.
+    # @param target Emclass : class of the records
+    # @param filters list : List of filters
+    # @param relational_filters list : List of relational filters
+    # @param group_by list : names of the group fields, multiple references
+    # are unwinded (each referenced uid is a group)
+    # @param metrics OrderedDict : tuples (OPERATOR, FIELDNAME|None) indexed
+    # by metric name, OPERATOR is one of 'count', 'sum', 'avg', 'min', 'max'
+    # @param order list : List of tuple (NAME, 'ASC'|'DESC') with NAME a group
+    # field or a metric name (default value : None)
+    # @param limit int : Number of groups to be returned (default value None)
+    # @param offset int : Number of groups skipped (default value : 0)
+    # @return a list of dict with group fields and metrics values
+    def aggregate(self, target, filters, relational_filters, group_by,
+                  metrics, order=None, limit=None, offset=0):
+        fields = set(group_by)
+        fields |= set(fname for _, fname in metrics.values()
+                      if fname is not None)
+        records = self.select_iter(target, list(fields), filters,
+                                   relational_filters)
+        unwinded = self._multivalued_fields(target, group_by)
+        groups = OrderedDict()
+        for record in records:
+            keys = [()]
+            for fname in group_by:
+                value = record.get(fname, None)
+                if fname in unwinded:
+                    if not value:
+                        # like a mongodb $unwind, no group for this record
+                        keys = []
+                        break
+                    keys = [key + (val,) for key in keys for val in value]
+                else:
+                    keys = [key + (value,) for key in keys]
+            for key in keys:
+                groups.setdefault(key, list()).append(record)
+        results = list()
+        for key, group in groups.items():
+            res = OrderedDict(zip(group_by, key))
+            for name, (operator, fname) in metrics.items():
+                res[name] = self._metric_value(operator, fname, group)
+            results.append(res)
+        for name, direction in reversed(order or []):
+            # records with None values come first (like mongodb)
+            results.sort(
+                key=lambda res: (res[name] is not None, res[name]),
+                reverse=(direction == 'DESC'))
+        results = results[offset:]
+        if limit is not None:
+            results = results[:limit]
+        return results
+
+    ## @brief Returns the group fields that have to be unwinded
+    # @param target Emclass : class of the records
+    # @param group_by list : names of the group fields
+    # @return a set of field names (the multiple references)
+    @staticmethod
+    def _multivalued_fields(target, group_by):
+        res = set()
+        for fname in group_by:
+            fdh = target.field(fname)
+            if fdh.is_reference() and not fdh.is_singlereference():
+                res.add(fname)
+        return res
+
+    ## @brief Computes a metric value on a group of records
+    # @param operator str : 'count', 'sum', 'avg', 'min' or 'max'
+    # @param fname str|None : the field name
+    # @param records list : list of dict
+    # @return the metric value (None values are ignored)
+    @staticmethod
+    def _metric_value(operator, fname, records):
+        if operator == 'count':
+            return len(records)
+        values = [record[fname] for record in records
+                  if record.get(fname, None) is not None]
+        if operator == 'sum':
+            return sum(values)
+        if len(values) == 0:
+            return None
+        if operator == 'avg':
+            return sum(values) / len(values)
+        return min(values) if operator == 'min' else max(values)
+
     ## @brief Deletes records according to given filters
     # @param target Emclass : class of the record to delete
     # @param filters list : List of filters
@@ -90,6 +231,19 @@ reimplemented by plugin datasource child class")
     def update(self, target, filters, relational_filters, upd_datas):
         self._abs_err()
 
+    ## @brief updates all records matching given filters with the same values
+    #
+    # Unlike update() no back reference is handled : the caller ensures that
+    # upd_datas contains no reference field with a back reference. Default
+    # implementation calls update().
+    # @param target Emclass : class of the objects to update
+    # @param filters list : List of filters
+    # @param relational_filters list : List of relational filters
+    # @param upd_datas dict : datas to update (new values)
+    # @return int : Number of updated records
+    def update_many(self, target, filters, relational_filters, upd_datas):
+        return self.update(target, filters, relational_filters, upd_datas)
+
     ## @brief Inserts a record in a given collection
     # @param target Emclass : class of the object to insert
     # @param new_datas dict : datas to insert
@@ -104,6 +258,25 @@ reimplemented by plugin datasource child class")
     def insert_multi(self, target, datas_list):
         self._abs_err()
 
+    ## @brief Runs a list of write operations in order
+    #
+    # Operations are tuples (METHOD, TARGET, *ARGS) where METHOD is the name
+    # of the datasource method to call with TARGET and ARGS : 'insert',
+    # 'update', 'update_many' or 'delete'. Default implementation calls the
+    # methods one by one, datasources override it to send the operations in
+    # batches.
+    # @param operations list : list of operations tuples
+    # @return list : the results of the operations, None when a datasource
+    # can not tell the result of a batched operation
+    # @throw ValueError if an operation method is unknown
+    def bulk_write(self, operations):
+        results = list()
+        for method, target, *args in operations:
+            if method not in self._bulk_methods:
+                raise ValueError("Unknown bulk write method '%s'" % method)
+            results.append(getattr(self, method)(target, *args))
+        return results
+
 
 ## @brief Represents a Datasource plugin
 #
@@ -118,6 +291,9 @@ reimplemented by plugin datasource child class")
 class DatasourcePlugin(Plugin):
     
     _type_conf_name = _glob_typename
+
+    ## @brief Stores read only datasources caches indexed by datasource name
+    _caches = dict()
   
     ## @brief Stores confspecs indicating where DatasourcePlugin list is stored
     _plist_confspecs = {
@@ -157,6 +333,9 @@ lodel.plugin.datasource_plugin.AbstractDatasource" % (self.name))
         return self.loader_module().migration_handler_class()
 
     ## @brief Returns an initialized Datasource instance
+    #
+    # Read only datasources with a cache_size configured are wrapped in a
+    # @ref lodel.plugin.datasource_cache.CachedDatasource
     # @param ds_name str : The name of the datasource to instanciate
     # @param ro bool : indicates if it will be in read only mode, else it will be in write only mode
     # @return A properly initialized Datasource instance
@@ -165,7 +344,36 @@ lodel.plugin.datasource_plugin.AbstractDatasource" % (self.name))
         plugin_name, ds_identifier = cls.plugin_name(ds_name, ro)
         ds_conf = cls._get_ds_connection_conf(ds_identifier, plugin_name)
         ds_cls = cls.get_datasource(plugin_name)
-        return ds_cls(**ds_conf)
+        datasource = ds_cls(**ds_conf)
+        if ro:
+            cache = cls.datasource_cache(ds_name)
+            if cache is not None:
+                LodelContext.expose_modules(globals(), {
+                    'lodel.plugin.datasource_cache': ['CachedDatasource']})
+                datasource = CachedDatasource(datasource, cache)
+        return datasource
+
+    ## @brief Returns the cache of a read only datasource
+    #
+    # A cache is shared by all the datasource instances with the same name
+    # @param ds_name str : The datasource name
+    # @return a DatasourceCache instance or None if no cache is configured
+    @classmethod
+    def datasource_cache(cls, ds_name):
+        if ds_name not in cls._caches:
+            LodelContext.expose_modules(globals(), {
+                'lodel.settings': ['Settings'],
+                'lodel.plugin.datasource_cache': ['DatasourceCache']})
+            ds_settings = getattr(Settings.datasources, ds_name)
+            cache_size = getattr(ds_settings, 'cache_size', 0)
+            cache = None
+            if cache_size is not None and cache_size > 0:
+                ttl = getattr(ds_settings, 'cache_ttl', None)
+                cache = DatasourceCache(
+                    cache_size, None if ttl is None or ttl <= 0 else ttl,
+                    getattr(ds_settings, 'cache_max_result', 100))
+            cls._caches[ds_name] = cache
+        return cls._caches[ds_name]
     
     ## @brief Returns an initialized MigrationHandler instance
     # @param ds_name str : The datasource name
@@ -287,6 +495,18 @@ but %s is a %s" % (ds_name, pinstance.__class__.__name__))
 # </pre>
 #  See below for DATASOURCE_FAMILY & SOURCE_NAME
 #
+# @par Read cache
+# Read only datasources can be wrapped in a read-through cache by adding
+# cache options to the datasource declaration :
+# <pre>
+# [lodel2.datasources.DATASOURCE_NAME]
+# identifier = DATASOURCE_FAMILY.SOURCE_NAME
+# cache_size = 10000 ; maximum number of cached records, 0 disables the cache
+# cache_ttl = 300 ; entries lifetime in seconds, 0 for no expiration
+# cache_max_result = 100 ; bigger select results are not cached
+# </pre>
+# See @ref lodel.plugin.datasource_cache
+#
 # @par Datasources plugins
 # Each datasource family is a plugin ( @ref plugin_doc "More informations on plugins" ). 
 # For example mysql or a mongodb plugins. \n
@@ -22,7 +22,7 @@
 
 import os
 import copy
-from lodel.context import LodelContext
+import time
 
 
 ## @brief Class designed to handle a hook's callback with a priority
@@ -33,6 +33,11 @@ class DecoratedWrapper(object):
     def __init__(self, hook, priority):
         self._priority = priority
         self._hook = hook
+        ## @brief Number of calls (counted when stats are enabled)
+        self.calls = 0
+        ## @brief Cumulative wall time of the calls in seconds (measured
+        # when stats are enabled)
+        self.total_time = 0.0
     
     ## @brief Calls the callback
     # @param hook_name str : The name of the called hook
@@ -42,6 +47,16 @@ class DecoratedWrapper(object):
     def __call__(self, hook_name, caller, payload):
         return self._hook(hook_name, caller, payload)
 
+    ## @brief Calls the callback and updates the stats
+    # @see __call__()
+    def timed_call(self, hook_name, caller, payload):
+        start = time.perf_counter()
+        try:
+            return self._hook(hook_name, caller, payload)
+        finally:
+            self.total_time += time.perf_counter() - start
+            self.calls += 1
+
     ## @brief Returns the string representation of the class
     # It shows the name and the priority of the hook
     def __str__(self):
@@ -57,25 +72,33 @@ class DecoratedWrapper(object):
 #  - payload : datas depending on the hook
 class LodelHook(object):
     
-    ## @brief Stores all hooks (DecoratedWrapper instances)
+    ## @brief Stores all hooks chains : tuples of DecoratedWrapper instances
+    # sorted by priority, indexed by hook name
     _hooks = dict()
+    ## @brief If True the callbacks calls are counted and timed (see
+    # LodelHook.set_stats() )
+    _stats = False
     
     ##
     # @param hook_name str : the name of the hook to register to
-    # @param priority int : the hook priority (default value : None)
+    # @param priority int : the hook priority (default value : None)
     def __init__(self, hook_name, priority = None):
         self._hook_name = hook_name
         self._priority = 0xFFFF if priority is None else priority
     
     ## @brief called just after __init__
+    #
+    # The wrapped hook is inserted after the hooks having a lower or equal
+    # priority, a new chain is built so running calls are not affected.
     # @param hook function : the decorated function
-    # @return the hook argument
+    # @return the hook argument
     def __call__(self, hook):
-        if not self._hook_name in self._hooks:
-            self._hooks[self._hook_name] = list()
+        chain = self._hooks.get(self._hook_name, ())
         wrapped = DecoratedWrapper(hook, self._priority)
-        self._hooks[self._hook_name].append(wrapped)
-        self._hooks[self._hook_name] = sorted(self._hooks[self._hook_name], key = lambda h: h._priority)
+        idx = len(chain)
+        while idx > 0 and chain[idx - 1]._priority > self._priority:
+            idx -= 1
+        self._hooks[self._hook_name] = chain[:idx] + (wrapped,) + chain[idx:]
         return hook
 
     ## @brief Calls a hook
@@ -85,14 +108,52 @@ class LodelHook(object):
     # @return modified payload
     @classmethod
     def call_hook(cls, hook_name, caller, payload):
-        LodelContext.expose_modules(globals(), {'lodel.logger': 'logger'})
-        logger.debug("Calling hook '%s'" % hook_name)
-        if hook_name in cls._hooks:
-            for hook in cls._hooks[hook_name]:
-                logger.debug("Lodel hook '%s' calls %s" % (
-                    hook_name, hook))
+        chain = cls._hooks.get(hook_name)
+        if chain is None:
+            return payload
+        if cls._stats:
+            for hook in chain:
+                payload = hook.timed_call(hook_name, caller, payload)
+        else:
+            for hook in chain:
                 payload = hook(hook_name, caller, payload)
         return payload
+
+    ## @brief Enables or disables the hooks stats
+    #
+    # When enabled each callback call is counted and timed, see
+    # LodelHook.hook_stats(). This value is set at bootstrap from the
+    # lodel2.hooks_stats setting.
+    # @param enabled bool
+    @classmethod
+    def set_stats(cls, enabled):
+        LodelHook._stats = bool(enabled)
+
+    ## @brief Fetches registered hooks stats
+    #
+    # The stats are gathered by the running process only : this method is
+    # meant to be called from inside the application (by a plugin or an
+    # interactive loader session), a new process (like lodel_admin.py)
+    # always sees zero calls.
+    # @param names list | None : optionnal filter on name (default value :
+    # None)
+    # @return dict containing for each name a list of tuples (hook,
+    # priority, calls count, cumulative time in seconds)
+    @classmethod
+    def hook_stats(cls, names = None):
+        return {
+            name: [(hook._hook, hook._priority, hook.calls, hook.total_time)
+                   for hook in hooks]
+            for name, hooks in cls._hooks.items()
+            if names is None or name in names}
+
+    ## @brief Resets the hooks stats
+    @classmethod
+    def reset_stats(cls):
+        for hooks in cls._hooks.values():
+            for hook in hooks:
+                hook.calls = 0
+                hook.total_time = 0.0
     
     ## @brief Fetches registered hooks
     # @param names list | None : optionnal filter on name (default value : None)
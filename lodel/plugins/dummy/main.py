@@ -32,12 +32,19 @@ LodelContext.expose_modules(globals(), {
 # @param payload : data to pass to the caller
 # @return payload
 @LodelHook('leapi_get_post')
+@LodelHook('leapi_get_iter_post')
 @LodelHook('leapi_update_pre')
 @LodelHook('leapi_update_post')
+@LodelHook('leapi_update_multi_pre')
+@LodelHook('leapi_update_multi_post')
 @LodelHook('leapi_delete_pre')
 @LodelHook('leapi_delete_post')
+@LodelHook('leapi_delete_multi_pre')
+@LodelHook('leapi_delete_multi_post')
 @LodelHook('leapi_insert_pre')
 @LodelHook('leapi_insert_post')
+@LodelHook('leapi_insert_multi_pre')
+@LodelHook('leapi_insert_multi_post')
 def dummy_callback(hook_name, caller, payload):
     if settings.Settings.debug:
         print("\tHook %s\tcaller %s with %s" % (hook_name, caller, payload))
@@ -50,11 +50,21 @@ class DummyDatasource(AbstractDatasource):
     # @param limit int : Number of records to be returned (default value : None)
     # @param offset int: used with limit to choose the start record (default value : 0)
     # @param instanciate bool : If true, the records are returned as instances, else they are returned as dict (default value : True)
+    # @param after tuple : keyset pagination values (default value : None)
     # @return list
     def select(self, target, field_list, filters, relational_filters=None, order=None, group=None, limit=None, offset=0,
-               instanciate=True):
+               instanciate=True, after=None):
         pass
 
+    ## @brief Counts the records matching given filters
+    # @param target Emclass : class of the records to count
+    # @param filters list : List of filters
+    # @param relational_filters list : List of relational filters (default value : None)
+    # @param limit int : if given, stop counting when limit is reached (default value : None)
+    # @return int : number of matching records
+    def count(self, target, filters, relational_filters=None, limit=None):
+        return 0
+
     ## @brief Deletes records according to given filters
     # @param target Emclass : class of the record to delete
     # @param filters list : List of filters
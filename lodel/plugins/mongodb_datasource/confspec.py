@@ -33,6 +33,13 @@ CONFSPEC = {
         'port': (None, Validator('string', none_is_valid = True)),
         'db_name':('lodel', Validator('string')),
         'username': (None, Validator('string')),
-        'password': (None, Validator('string'))
+        'password': (None, Validator('string')),
+        'ids_block_size': (100, Validator('int')),
+        'check_backrefs': (False, Validator('bool')),
+        'write_concern_w': (None, Validator('string', none_is_valid = True)),
+        'write_concern_j': (None, Validator('bool', none_is_valid = True)),
+        'write_concern_wtimeout': (None,
+            Validator('int', none_is_valid = True)),
+        'relational_lookup': (False, Validator('bool'))
     }
 }
@@ -24,18 +24,23 @@
 # operations that can be done (CRUD ones).
 
 import re
-import warnings
 import copy
+import warnings
 import functools
+import heapq
+import itertools
+import threading
+import contextlib
 from bson.son import SON
 from collections import OrderedDict
 import pymongo
-from pymongo.errors import BulkWriteError
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 from lodel.context import LodelContext
 LodelContext.expose_modules(globals(), {
     'lodel.logger': 'logger',
     'lodel.leapi.leobject': ['CLASS_ID_FIELDNAME'],
+    'lodel.leapi.query': ['LeQueryProfile'],
     'lodel.leapi.datahandlers.base_classes': ['Reference', 'MultipleRef'],
     'lodel.exceptions': ['LodelException', 'LodelFatalError'],
     'lodel.plugin.datasource_plugin': ['AbstractDatasource']})
@@ -46,6 +51,82 @@ from .utils import object_collection_name, collection_name, \
     MONGODB_SORT_OPERATORS_MAP, connection_string, mongo_fieldname
 
 
+## @brief Decorator running a datasource method in a filters cache scope
+#
+# The filters and the relational filters subqueries are processed once
+# for the whole method call.
+# @see MongoDbDatasource._filters_scope()
+# @param method function : a MongoDbDatasource method
+# @return the decorated method
+def filters_cache_scope(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._filters_scope():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+## @brief Buffers write requests to send them with few bulk_write() calls
+# @ingroup plugin_mongodb_datasource
+#
+# Consecutive requests on the same collection with the same ordered flag are
+# sent in one bulk_write() call. Unordered batches are for requests that do
+# not depend on each other : the server may apply them in any order and does
+# not stop at the first error.
+class MongoWriteBuffer(object):
+
+    ##
+    # @param database pymongo.database.Database
+    def __init__(self, database):
+        self.database = database
+        ## @brief Batches : [collection name, requests, ordered, only
+        # deletes] lists in order
+        self.__batches = list()
+
+    ## @brief Buffers write requests
+    # @param coll_name str : collection name
+    # @param requests list : pymongo requests (InsertOne, UpdateMany...)
+    # @param ordered bool : if False the requests (and the unordered
+    # requests buffered just before on the same collection) can be applied
+    # in any order
+    # @param deletes bool : True if the requests are deletes
+    def add(self, coll_name, requests, ordered = True, deletes = False):
+        if len(requests) == 0:
+            return
+        if len(self.__batches) == 0 \
+                or self.__batches[-1][0] != coll_name \
+                or self.__batches[-1][2] != ordered:
+            self.__batches.append([coll_name, list(), ordered, True])
+        batch = self.__batches[-1]
+        batch[1].extend(requests)
+        batch[3] &= deletes
+
+    ## @brief Checks if buffered requests, other than deletes, write in a
+    # collection
+    # @param coll_name str : collection name
+    # @return bool
+    def writes_on(self, coll_name):
+        return any(b_coll == coll_name and not only_deletes
+            for b_coll, _, _, only_deletes in self.__batches)
+
+    ## @brief Sends the buffered requests
+    # @return a list of pymongo BulkWriteResult
+    def flush(self):
+        batches, self.__batches = self.__batches, list()
+        results = list()
+        for coll_name, requests, ordered, _ in batches:
+            LeQueryProfile.annotate(
+                collection = coll_name, bulk_write = len(requests),
+                ordered = ordered)
+            results.append(self.database[coll_name].bulk_write(
+                requests, ordered = ordered))
+        return results
+
+    ## @return the number of buffered requests
+    def __len__(self):
+        return sum(len(batch[1]) for batch in self.__batches)
+
+
 ## @brief Datasource class
 # @ingroup plugin_mongodb_datasource
 class MongoDbDatasource(AbstractDatasource):
@@ -61,6 +142,15 @@ class MongoDbDatasource(AbstractDatasource):
     # - db : the pymongo database object instance
     _connections = dict()
 
+    ## @brief Reserved ids not used yet, shared by the instances using the
+    # same connection
+    #
+    # [next id, last id] lists indexed by (connection hash, counter name)
+    # @see MongoDbDatasource::reserve_ids()
+    _id_blocks = dict()
+    ## @brief Protects _id_blocks
+    _id_blocks_lock = threading.Lock()
+
     ## @brief Mapping from lodel2 operators to mongodb operators
     lodel2mongo_op_map = {
         '=':'$eq', '<=':'$lte', '>=':'$gte', '!=':'$ne', '<':'$lt',
@@ -78,16 +168,50 @@ class MongoDbDatasource(AbstractDatasource):
     # @param password str
     # @param read_only bool : If True the Datasource is for read only, else the
     # Datasource is write only !
-    def __init__(self, host, port, db_name, username, password, read_only = False):
+    # @param ids_block_size int : number of ids reserved at once by
+    # reserve_ids()
+    # @param check_backrefs bool : if True the back referenced objects are
+    # read to check the back references changes before writing them
+    # @param write_concern_w str|None : write concern w option (number of
+    # nodes or tag like "majority")
+    # @param write_concern_j bool|None : write concern j option
+    # @param write_concern_wtimeout int|None : write concern wtimeout option
+    # in milliseconds
+    # @param relational_lookup bool : if True the relational filters of the
+    # reads are resolved server side with $lookup stages (see
+    # MongoDbDatasource::__lookup_stages() ). Off by default : a $lookup
+    # runs for each document matched by the other filters while a subquery
+    # runs once, the lookups only pay off when subqueries return many uids
+    # @throw MongoDbDataSourceError if writes are unacknowledged (w = 0)
+    def __init__(self, host, port, db_name, username, password, read_only = False,
+            ids_block_size = 100, check_backrefs = False,
+            write_concern_w = None, write_concern_j = None,
+            write_concern_wtimeout = None, relational_lookup = False):
         ## @brief Connections infos that can be kept securly
         self.__db_infos = {'host': host, 'port': port, 'db_name': db_name}
         ## @brief Is the instance read only ? (if not it's write only)
         self.__read_only = bool(read_only)
         ## @brief Uniq ID for mongodb connection
         self.__conn_hash= None
+        ## @brief Number of ids reserved by each counter increment
+        self.__ids_block_size = max(1, int(ids_block_size))
+        ## @brief Consistency verification mode for back references updates
+        self.__check_backrefs = bool(check_backrefs)
+        ## @brief Are relational filters of reads joined server side ?
+        self.__relational_lookup = bool(relational_lookup)
+        ## @brief Per thread filters caches (see _filters_scope() )
+        self._filters_local = threading.local()
         ## @brief Stores the database cursor
         self.database = self.__connect(
             username, password, db_name, self.__read_only)
+        concern = utils.write_concern(
+            write_concern_w, write_concern_j, write_concern_wtimeout)
+        if concern is not None:
+            if not concern.acknowledged:
+                raise MongoDbDataSourceError("Unacknowledged writes are not \
+supported : the number of written records is needed")
+            self.database = self.database.with_options(
+                write_concern = concern)
 
     ## @brief Destructor that attempt to close connection to DB
     #
@@ -106,15 +230,72 @@ class MongoDbDatasource(AbstractDatasource):
     # have to be uniq
     # @warning multiple UID broken by this method
     # @return an integer
+    # @see MongoDbDatasource::reserve_ids()
     def new_numeric_id(self, emcomp):
+        return self.reserve_ids(emcomp, 1)[0]
+
+    ## @brief Reserves a block of new uniq numeric IDs
+    #
+    # IDs are allocated in hi/lo style : a counter document per uid source
+    # class is atomically incremented by ids_block_size (or by n if greater)
+    # and the ids of the block are given without any round trip until the
+    # block is exhausted. Concurrent processes get distinct blocks, unused
+    # ids are lost when the process ends.
+    # @param emcomp LeObject subclass (not instance) : To know on wich things we
+    # have to be uniq
+    # @param n int : number of ids to reserve
+    # @warning multiple UID broken by this method
+    # @return a list of int
+    def reserve_ids(self, emcomp, n):
+        if n <= 0:
+            return []
         target = emcomp.uid_source()
-        tuid = target._uid[0] # Multiple UID broken here
-        results = self.select(
-            target, field_list = [tuid], filters = [],
-            order=[(tuid, 'DESC')], limit = 1)
-        if len(results) == 0:
-            return 1
-        return results[0][tuid]+1
+        key = (self.__conn_hash, object_collection_name(target))
+        with self._id_blocks_lock:
+            if key not in self._id_blocks:
+                self._id_blocks[key] = [1, 0]
+            block = self._id_blocks[key]
+            count = min(n, block[1] - block[0] + 1)
+            ids = list(range(block[0], block[0] + count))
+            block[0] += count
+            missing = n - count
+            if missing > 0:
+                size = max(missing, self.__ids_block_size)
+                last_id = self.__counter_inc(target, size)
+                first_id = last_id - size + 1
+                ids.extend(range(first_id, first_id + missing))
+                block[0], block[1] = first_id + missing, last_id
+        return ids
+
+    ## @brief Atomically increments the ids counter of an uid source class
+    #
+    # The counter is created on first use, starting from the greatest
+    # existing id.
+    # @param target LeObject subclass (not instance) : the uid source class
+    # @param n int : increment
+    # @return the last reserved id
+    def __counter_inc(self, target, n):
+        counters = self.database[utils.common_collections['counters']]
+        name = object_collection_name(target)
+        for _ in range(2):
+            counter = counters.find_one_and_update(
+                {'_id': name}, {'$inc': {'seq': n}},
+                return_document = pymongo.ReturnDocument.AFTER)
+            if counter is not None:
+                return counter['seq']
+            tuid = target._uid[0] # Multiple UID broken here
+            results = self.select(
+                target, field_list = [tuid], filters = [],
+                order=[(tuid, 'DESC')], limit = 1)
+            max_id = 0 if len(results) == 0 else results[0][tuid]
+            try:
+                # $max keeps the counter if another process created it
+                counters.update_one(
+                    {'_id': name}, {'$max': {'seq': max_id}}, upsert = True)
+            except DuplicateKeyError:
+                pass
+        raise MongoDbDataSourceError(
+            "Unable to initialize the ids counter of %s" % name)
 
     ## @brief returns a selection of documents from the datasource
     # @param target Emclass
@@ -126,102 +307,375 @@ class MongoDbDatasource(AbstractDatasource):
     # "group by" fields. ex: group = [('title', 'ASC'),]
     # @param limit int : Number of records to be returned
     # @param offset int: used with limit to choose the start record
+    # @param after tuple : keyset pagination, values of the order fields of
+    # the last record of the previous page
     # @return list
-    # @todo Implement group for abstract LeObject childs
+    @filters_cache_scope
     def select(self, target, field_list, filters = None,
             relational_filters=None, order=None, group=None, limit=None,
-            offset=0):
+            offset=0, after=None):
+        if group is None and target.is_abstract():
+            return list(self.__abstract_iter(target, field_list, filters,
+                relational_filters, order, limit, offset, after))
+        # Default behavior
+        if group is None:
+            cursor = self.__find_cursor(target, field_list, filters,
+                relational_filters, order, limit, offset, after)
+        else:
+            # Distinct values of the group fields, sorted by group fields
+            cursor = self.aggregate(target, filters, relational_filters,
+                [field_name for field_name, _ in group], OrderedDict(),
+                order = list(group), limit = limit, offset = offset)
+
+        results = list()
+        for document in cursor:
+            results.append(document)
+
+        return results
+
+    ## @brief returns an iterator on a selection of documents
+    #
+    # Documents are streamed from the pymongo cursor instead of being
+    # copied in a list.
+    # @note grouped selects are not streamed for the moment
+    # @param target Emclass
+    # @param field_list list
+    # @param filters list : List of filters
+    # @param relational_filters list : List of relational filters
+    # @param order list : List of column to order. ex: order = [('title', 'ASC'),]
+    # @param group list : List of tupple representing the column used as
+    # "group by" fields. ex: group = [('title', 'ASC'),]
+    # @param limit int : Number of records to be returned
+    # @param offset int: used with limit to choose the start record
+    # @param after tuple : keyset pagination (see select())
+    # @param batch_size int : number of documents fetched by round trip
+    # @return an iterator on dict
+    @filters_cache_scope
+    def select_iter(self, target, field_list, filters = None,
+            relational_filters=None, order=None, group=None, limit=None,
+            offset=0, after=None, batch_size=None):
+        if group is not None:
+            return iter(self.select(target, field_list, filters,
+                relational_filters, order = order, group = group,
+                limit = limit, offset = offset, after = after))
         if target.is_abstract():
-            # Reccursive calls for abstract LeObject child
-            results =  self.__act_on_abstract(target, filters,
-                relational_filters, self.select, field_list = field_list,
-                order = order, group = group, limit = limit)
-
-            # Here we may implement the group
-            # If sorted query we have to sort again
-            if order is not None:
-                key_fun = functools.cmp_to_key(
-                    self.__generate_lambda_cmp_order(order))
-                results = sorted(results, key=key_fun)
-            # If limit given apply limit again
-            if offset > len(results):
-                results = list()
+            return self.__abstract_iter(target, field_list, filters,
+                relational_filters, order, limit, offset, after, batch_size)
+        cursor = self.__find_cursor(target, field_list, filters,
+            relational_filters, order, limit, offset, after)
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+
+    ## @brief Returns an iterator on a selection of documents of an abstract
+    # class
+    #
+    # Each non abstract child collection is queried with the order pushed
+    # down and at most offset + limit documents. The server sorted cursors
+    # are merged with a heap (k-way merge), then offset and limit are applied
+    # on the merged stream : only the needed documents are fetched.
+    # @param target Emclass : an abstract class
+    # @param field_list list|None
+    # @param filters list|None : List of filters
+    # @param relational_filters list|None : List of relational filters
+    # @param order list|None : list of tuple (FIELDNAME, 'ASC'|'DESC')
+    # @param limit int|None
+    # @param offset int
+    # @param after tuple|None : keyset pagination values
+    # @param batch_size int|None : number of documents fetched by round trip
+    # @return an iterator on dict
+    def __abstract_iter(self, target, field_list, filters,
+            relational_filters, order, limit, offset, after = None,
+            batch_size = None):
+        if filters is None:
+            filters = list()
+        child_limit = None if limit is None else offset + limit
+        hidden_fields = list()
+        if order is not None and field_list is not None:
+            # order fields are needed to merge the cursors
+            hidden_fields = [fname for fname, _ in order
+                if fname not in field_list]
+            field_list = list(field_list) + hidden_fields
+        cursors = list()
+        for target_child in target.child_classes():
+            if target_child.is_abstract():
+                continue
+            logger.debug("Abstract select on %s" % target_child.__name__)
+            cursor = self.__find_cursor(target_child, field_list,
+                self.__child_filters(filters, target_child),
+                relational_filters, order, child_limit, 0, after)
+            if batch_size is not None:
+                cursor = cursor.batch_size(batch_size)
+            cursors.append(cursor)
+        if order is None or len(order) == 0:
+            results = itertools.chain(*cursors)
+        else:
+            results = heapq.merge(*cursors, key = self.__order_key(order))
+        results = itertools.islice(
+            results, offset, None if limit is None else offset + limit)
+        if len(hidden_fields) > 0:
+            results = self.__drop_fields(results, hidden_fields)
+        return results
+
+    ## @brief Removes fields from documents
+    # @param documents iterable : dict
+    # @param fnames list : names of the fields to remove
+    # @return a generator on dict
+    @staticmethod
+    def __drop_fields(documents, fnames):
+        for document in documents:
+            for fname in fnames:
+                document.pop(fname, None)
+            yield document
+
+    ## @brief Returns the filters of a query on a child class of an abstract
+    # class
+    #
+    # The class identifier filters are replaced by a filter on the child
+    # class
+    # @param filters list : List of filters
+    # @param target_child Emclass : a child class
+    # @return a list of filters
+    @staticmethod
+    def __child_filters(filters, target_child):
+        new_filters = list()
+        for fname, op, val in filters:
+            if fname == CLASS_ID_FIELDNAME:
+                logger.warning("Dirty drop of filter : '%s %s %s'" % (
+                    fname, op, val))
             else:
-                if limit is not None:
-                    if limit + offset > len(results):
-                        limit = len(results)-offset-1
-                    results = results[offset:offset+limit]
-            return results
-        # Default behavior
+                new_filters.append((fname, op, val))
+        new_filters.append(
+            (CLASS_ID_FIELDNAME, '=', collection_name(target_child.__name__)))
+        return new_filters
+
+    ## @brief Returns a sort key function implementing a query order
+    #
+    # None values come first like in mongodb ascending sorts
+    # @param order list : list of tuple (FIELDNAME, 'ASC'|'DESC')
+    # @return a key function for sorted() or heapq.merge()
+    @staticmethod
+    def __order_key(order):
+        def cmp_documents(doc_a, doc_b):
+            for fname, direction in order:
+                val_a = doc_a.get(fname, None)
+                val_b = doc_b.get(fname, None)
+                if val_a == val_b:
+                    continue
+                if val_a is None:
+                    res = -1
+                elif val_b is None:
+                    res = 1
+                else:
+                    res = -1 if val_a < val_b else 1
+                return res if direction == 'ASC' else -res
+            return 0
+        return functools.cmp_to_key(cmp_documents)
+
+    ## @brief Forge a pymongo cursor for a non abstract target
+    #
+    # @note filters are processed when this method is called, not when the
+    # cursor is consumed
+    # @param target Emclass : a non abstract class
+    # @param field_list list|None
+    # @param filters list|None : List of filters
+    # @param relational_filters list|None : List of relational filters
+    # @param order list|None
+    # @param limit int|None
+    # @param offset int
+    # @param after tuple|None : keyset pagination values
+    # @return a pymongo cursor (a command cursor when the relational filters
+    # are resolved with an aggregation pipeline)
+    def __find_cursor(self, target, field_list, filters, relational_filters,
+            order, limit, offset, after = None):
         if filters is None:
             filters = list()
         if relational_filters is None:
             relational_filters = list()
 
-        collection_name = object_collection_name(target)
-        collection = self.database[collection_name]
-
+        collection = self.__collection(target)
+        lookup_stages = self.__lookup_stages(target, relational_filters)
+        if lookup_stages is not None:
+            relational_filters = list()
         query_filters = self.__process_filters(
             target, filters, relational_filters)
+        if after is not None:
+            keyset_filters = self.__keyset_filters(order, after)
+            if len(query_filters) > 0:
+                query_filters = {'$and': [query_filters, keyset_filters]}
+            else:
+                query_filters = keyset_filters
 
         query_result_ordering = None
         if order is not None:
             query_result_ordering = utils.parse_query_order(order)
 
-        if group is None:
-            if field_list is None:
-                field_list = dict()
-            else:
-                f_list=dict()
-                for fl in field_list:
-                    f_list[fl] = 1
-                field_list = f_list
-            field_list['_id'] = 0
-            cursor = collection.find(
-                spec = query_filters,
-                fields=field_list,
-                skip=offset,
-                limit=limit if limit != None else 0,
-                sort=query_result_ordering)
+        if field_list is None:
+            field_list = dict()
         else:
+            f_list=dict()
+            for fl in field_list:
+                f_list[fl] = 1
+            field_list = f_list
+        field_list['_id'] = 0
+        if lookup_stages is not None:
             pipeline = list()
-            unwinding_list = list()
-            grouping_dict = OrderedDict()
-            sorting_list = list()
-            for group_param in group:
-                field_name = group_param[0]
-                field_sort_option = group_param[1]
-                sort_option = MONGODB_SORT_OPERATORS_MAP[field_sort_option]
-                unwinding_list.append({'$unwind': '$%s' % field_name})
-                grouping_dict[field_name] = '$%s' % field_name
-                sorting_list.append((field_name, sort_option))
-
-            sorting_list.extends(query_result_ordering)
-
-            pipeline.append({'$match': query_filters})
-            if field_list is not None:
-                pipeline.append({
-                    '$project': SON([{field_name: 1}
-                    for field_name in field_list])})
-            pipeline.extend(unwinding_list)
-            pipeline.append({'$group': grouping_dict})
-            pipeline.extend({'$sort': SON(sorting_list)})
+            if len(query_filters) > 0:
+                pipeline.append({'$match': query_filters})
+            pipeline += lookup_stages
+            if query_result_ordering is not None \
+                    and len(query_result_ordering) > 0:
+                pipeline.append({'$sort': SON(query_result_ordering)})
             if offset > 0:
                 pipeline.append({'$skip': offset})
             if limit is not None:
                 pipeline.append({'$limit': limit})
+            pipeline.append({'$project': field_list})
+            LeQueryProfile.annotate(
+                collection = collection.name, pipeline = pipeline)
+            return collection.aggregate(pipeline)
+        LeQueryProfile.annotate(
+            collection = collection.name, filter = query_filters,
+            projection = field_list, sort = query_result_ordering,
+            skip = offset, limit = limit)
+        return collection.find(
+            query_filters,
+            projection=field_list,
+            skip=offset,
+            limit=limit if limit != None else 0,
+            sort=query_result_ordering)
 
-        results = list()
-        for document in cursor:
-            results.append(document)
+    ## @brief Forge the range filter of a keyset pagination
+    #
+    # For order (a ASC, b DESC, uid ASC) and after (x, y, z) the filter
+    # is : a > x OR (a = x AND b < y) OR (a = x AND b = y AND uid > z)
+    # @param order list : list of tuple (FIELDNAME, 'ASC'|'DESC')
+    # @param after tuple : values of the order fields
+    # @return a pymongo filter dict
+    @staticmethod
+    def __keyset_filters(order, after):
+        or_filters = list()
+        for i, (fname, direction) in enumerate(order):
+            cond = {order[j][0]: after[j] for j in range(i)}
+            cond[fname] = {'$gt' if direction == 'ASC' else '$lt': after[i]}
+            or_filters.append(cond)
+        return {'$or': or_filters}
 
-        return results
+    ## @brief Counts the documents matching given filters
+    #
+    # The count is done server side using count_documents (or a $count
+    # pipeline when relational filters are joined), for abstract targets the
+    # counts of each non abstract child are summed
+    # @param target Emclass
+    # @param filters list : List of filters
+    # @param relational_filters list : List of relational filters
+    # @param limit int : if given, stop counting when limit is reached
+    # @return int : number of matching documents
+    @filters_cache_scope
+    def count(self, target, filters, relational_filters=None, limit=None):
+        if target.is_abstract():
+            return self.__act_on_abstract(target, filters,
+                relational_filters, self.count, limit = limit)
+        if filters is None:
+            filters = list()
+        if relational_filters is None:
+            relational_filters = list()
+        lookup_stages = self.__lookup_stages(target, relational_filters)
+        if lookup_stages is not None:
+            query_filters = self.__process_filters(target, filters, [])
+            pipeline = list()
+            if len(query_filters) > 0:
+                pipeline.append({'$match': query_filters})
+            pipeline += lookup_stages
+            if limit is not None:
+                pipeline.append({'$limit': limit})
+            pipeline.append({'$count': 'count'})
+            LeQueryProfile.annotate(
+                collection = object_collection_name(target),
+                pipeline = pipeline)
+            for document in self.__collection(target).aggregate(pipeline):
+                return document['count']
+            return 0
+        query_filters = self.__process_filters(
+            target, filters, relational_filters)
+        count_opts = dict()
+        if limit is not None:
+            count_opts['limit'] = limit
+        LeQueryProfile.annotate(
+            collection = object_collection_name(target),
+            filter = query_filters, limit = limit)
+        return self.__collection(target).count_documents(
+            query_filters, **count_opts)
+
+    ## @brief Computes metrics on groups of records with an aggregation
+    # pipeline
+    #
+    # The pipeline is <code>$match, [$lookup, $match, $project] (relational
+    # filters), $unwind (multiple references group fields), $group, $project,
+    # $sort, $skip, $limit</code>
+    # @see AbstractDatasource.aggregate()
+    # @note abstract targets are aggregated in python (see
+    # AbstractDatasource.aggregate() )
+    @filters_cache_scope
+    def aggregate(self, target, filters, relational_filters, group_by,
+            metrics, order = None, limit = None, offset = 0):
+        if target.is_abstract():
+            return super().aggregate(target, filters, relational_filters,
+                group_by, metrics, order = order, limit = limit,
+                offset = offset)
+        if filters is None:
+            filters = list()
+        if relational_filters is None:
+            relational_filters = list()
+        lookup_stages = self.__lookup_stages(target, relational_filters)
+        if lookup_stages is not None:
+            relational_filters = list()
+        query_filters = self.__process_filters(
+            target, filters, relational_filters)
+        pipeline = list()
+        if len(query_filters) > 0:
+            pipeline.append({'$match': query_filters})
+        if lookup_stages is not None:
+            pipeline += lookup_stages
+        unwinded = self._multivalued_fields(target, group_by)
+        for field_name in group_by:
+            if field_name in unwinded:
+                pipeline.append({'$unwind': '$%s' % field_name})
+        if len(group_by) == 0:
+            grouping_dict = {'_id': None}
+        else:
+            grouping_dict = {'_id': SON(
+                [(field_name, '$%s' % field_name) for field_name in group_by])}
+        projection = {'_id': 0}
+        for field_name in group_by:
+            projection[field_name] = '$_id.%s' % field_name
+        for name, (operator, field_name) in metrics.items():
+            if operator == 'count':
+                grouping_dict[name] = {'$sum': 1}
+            else:
+                grouping_dict[name] = {
+                    '$%s' % operator: '$%s' % field_name}
+            projection[name] = 1
+        pipeline.append({'$group': grouping_dict})
+        pipeline.append({'$project': projection})
+        if order is not None and len(order) > 0:
+            pipeline.append({
+                '$sort': SON(utils.parse_query_order(order))})
+        if offset > 0:
+            pipeline.append({'$skip': offset})
+        if limit is not None:
+            pipeline.append({'$limit': limit})
+        LeQueryProfile.annotate(
+            collection = object_collection_name(target),
+            pipeline = pipeline)
+        return list(self.__collection(target).aggregate(pipeline))
 
     ## @brief Deletes records according to given filters
     # @param target Emclass : class of the record to delete
     # @param filters list : List of filters
     # @param relational_filters list : List of relational filters
     # @return int : number of deleted records
+    @filters_cache_scope
     def delete(self, target, filters, relational_filters):
         if target.is_abstract():
             logger.debug("Delete called on %s filtered by (%s,%s). Target is \
@@ -234,11 +688,15 @@ abstract, preparing reccursiv calls" % (target, filters, relational_filters))
         # Non abstract beahavior
         mongo_filters = self.__process_filters(
             target, filters, relational_filters)
+        LeQueryProfile.annotate(
+            collection = object_collection_name(target),
+            filter = mongo_filters)
         # Updating backref before deletion
         self.__update_backref_filtered(target, filters, relational_filters,
             None)
-        res = self.__collection(target).remove(mongo_filters)
-        return res['n']
+        res = self.__collection(target).delete_many(mongo_filters)
+        self._filters_cache_clear()
+        return res.deleted_count
 
     ## @brief updates records according to given filters
     # @param target Emclass : class of the object to insert
@@ -246,6 +704,7 @@ abstract, preparing reccursiv calls" % (target, filters, relational_filters))
     # @param relational_filters list : List of relational filters
     # @param upd_datas dict : datas to update (new values)
     # @return int : Number of updated records
+    @filters_cache_scope
     def update(self, target, filters, relational_filters, upd_datas):
         self._data_cast(upd_datas)
         #fetching current datas state
@@ -262,6 +721,34 @@ abstract, preparing reccursiv calls" % (target, filters, relational_filters))
             upd_datas, old_datas_l)
         return res
 
+    ## @brief updates all records matching given filters in a single
+    # multi-documents update
+    #
+    # No back reference is handled, upd_datas MUST NOT contain reference
+    # fields having a back reference.
+    # @param target Emclass : class of the objects to update
+    # @param filters list : List of filters
+    # @param relational_filters list : List of relational filters
+    # @param upd_datas dict : datas to update (new values)
+    # @return int : Number of updated records
+    @filters_cache_scope
+    def update_many(self, target, filters, relational_filters, upd_datas):
+        logger.debug("Update many called on %s filtered by (%s,%s) with \
+datas %s" % (target, filters, relational_filters, upd_datas))
+        if target.is_abstract():
+            return self.__act_on_abstract(target, filters,
+                relational_filters, self.update_many, upd_datas = upd_datas)
+        mongo_filters = self.__process_filters(
+            target, filters, relational_filters)
+        self._data_cast(upd_datas)
+        LeQueryProfile.annotate(
+            collection = object_collection_name(target),
+            filter = mongo_filters, update = {'$set': upd_datas})
+        res = self.__collection(target).update_many(
+            mongo_filters, {'$set': upd_datas})
+        self._filters_cache_clear()
+        return res.matched_count
+
     ## @brief Designed to be called by backref update in order to avoid
     # infinite updates between back references
     # @see update()
@@ -278,13 +765,18 @@ abstract, preparing reccursiv calls" % (target, filters, relational_filters))
             target, filters, relational_filters)
         self._data_cast(upd_datas)
         mongo_arg = {'$set': upd_datas }
-        res = self.__collection(target).update(mongo_filters, mongo_arg)
-        return res['n']
+        LeQueryProfile.annotate(
+            collection = object_collection_name(target),
+            filter = mongo_filters, update = mongo_arg)
+        res = self.__collection(target).update_many(mongo_filters, mongo_arg)
+        self._filters_cache_clear()
+        return res.matched_count
 
     ## @brief Inserts a record in a given collection
     # @param target Emclass : class of the object to insert
     # @param new_datas dict : datas to insert
     # @return the inserted uid
+    @filters_cache_scope
     def insert(self, target, new_datas):
         self._data_cast(new_datas)
         logger.debug("Insert called on %s with datas : %s"% (
@@ -293,22 +785,159 @@ abstract, preparing reccursiv calls" % (target, filters, relational_filters))
         if uidname not in new_datas:
             raise MongoDataSourceError("Missing UID data will inserting a new \
 %s" % target.__class__)
-        res = self.__collection(target).insert(new_datas)
+        LeQueryProfile.annotate(collection = object_collection_name(target))
+        self.__collection(target).insert_one(new_datas)
+        self._filters_cache_clear()
         self.__update_backref(target, new_datas[uidname], None, new_datas)
-        return str(res)
+        return new_datas[uidname]
 
     ## @brief Inserts a list of records in a given collection
     # @param target Emclass : class of the objects inserted
     # @param datas_list list : list of dict
     # @return list : list of the inserted records' ids
+    @filters_cache_scope
     def insert_multi(self, target, datas_list):
+        if len(datas_list) == 0:
+            return []
+        uidname = target.uid_fieldname()[0] #MULTIPLE UID BROKEN HERE
         for datas in datas_list:
+            if uidname not in datas:
+                raise MongoDataSourceError("Missing UID data will inserting \
+a new %s" % target.__class__)
             self._data_cast(datas)
-        res = self.__collection(target).insert_many(datas_list)
+        logger.debug("Insert multi called on %s with %d records" % (
+            target, len(datas_list)))
+        # The records are new and distinct, their order does not matter
+        self.__collection(target).insert_many(datas_list, ordered = False)
+        self._filters_cache_clear()
+        # Back references of the whole batch are gathered in a single
+        # bref_ops and flushed once
+        bref_ops = {}
         for new_datas in datas_list:
-            self.__update_backref(target, None, new_datas)
+            self.__update_backref(
+                target, new_datas[uidname], None, new_datas, bref_ops)
             target.make_consistency(datas=new_datas)
-        return list(res.inserted_ids)
+        self.__update_backref_flush(bref_ops)
+        return [datas[uidname] for datas in datas_list]
+
+    ## @brief Runs a list of write operations with ordered bulk writes
+    #
+    # Consecutive operations on the same collection are sent in a single
+    # ordered bulk_write() call. The back references changes of the whole
+    # batch are coalesced by referenced object and sent at the end in
+    # unordered bulk_write() calls.
+    #
+    # Updates and deletes on a class having reference fields read the
+    # targeted records first (to update back references) : the pending
+    # requests on the collection are written before, except deletes.
+    # Operations on abstract classes are not batched.
+    # @see AbstractDatasource.bulk_write()
+    # @param operations list : list of operations tuples
+    # @return list : the uids for inserts, the number of updated or deleted
+    # records when the records were read else None
+    # @throw ValueError if an operation method is unknown
+    @filters_cache_scope
+    def bulk_write(self, operations):
+        results = [None] * len(operations)
+        # Pending requests
+        pending = MongoWriteBuffer(self.database)
+        # uids of the records read then deleted by pending requests, indexed
+        # by collection name
+        deleted = dict()
+        bref_ops = {}
+        for i, (method, target, *args) in enumerate(operations):
+            if method not in self._bulk_methods:
+                raise ValueError("Unknown bulk write method '%s'" % method)
+            if target.is_abstract():
+                self.__bulk_flush(pending, deleted)
+                results[i] = getattr(self, method)(target, *args)
+                continue
+            coll_name = object_collection_name(target)
+            uidname = target.uid_fieldname()[0] #MULTIPLE UID BROKEN HERE
+            if method == 'insert':
+                new_datas = self._data_cast(args[0])
+                if uidname not in new_datas:
+                    raise MongoDataSourceError("Missing UID data will \
+inserting a new %s" % target.__class__)
+                request = pymongo.InsertOne(new_datas)
+                uid = new_datas[uidname]
+                self.__update_backref(target, uid, None, new_datas, bref_ops)
+                results[i] = uid
+            else:
+                filters, relational_filters = args[0], args[1]
+                new_datas = None
+                if method != 'delete':
+                    new_datas = self._data_cast(args[2])
+                if relational_filters:
+                    # Subqueries have to see the previous operations
+                    self.__bulk_flush(pending, deleted)
+                mongo_filters = self.__process_filters(
+                    target, filters, relational_filters)
+                old_datas_l = None
+                if method != 'update_many' and \
+                        len(target.reference_handlers(True)) > 0:
+                    old_datas_l = self.__bulk_read(
+                        target, mongo_filters, pending, deleted, bref_ops)
+                if method == 'delete':
+                    request = pymongo.DeleteMany(mongo_filters)
+                else:
+                    request = pymongo.UpdateMany(
+                        mongo_filters, {'$set': new_datas})
+                if old_datas_l is not None:
+                    results[i] = len(old_datas_l)
+                    for old_datas in old_datas_l:
+                        self.__update_backref(target, old_datas[uidname],
+                            old_datas, new_datas, bref_ops)
+                    if method == 'delete':
+                        deleted.setdefault(coll_name, set()).update(
+                            old_datas[uidname] for old_datas in old_datas_l)
+            pending.add(coll_name, [request], deletes = method == 'delete')
+        # Back references updates
+        if self.__check_backrefs:
+            # The checks read the objects written by the batch
+            self.__bulk_flush(pending, deleted)
+        for coll_name, requests in self.__bref_requests(bref_ops):
+            pending.add(coll_name, requests, ordered = False)
+        self.__bulk_flush(pending, deleted)
+        return results
+
+    ## @brief Reads the records targeted by an update or a delete of a
+    # bulk_write()
+    #
+    # Pending requests on the collection are written first unless they are
+    # all deletes, the records deleted by those deletes are ignored. Pending
+    # back references updates of the records replace the read values.
+    # @param target LeObject child class
+    # @param mongo_filters dict : filters as returned by __process_filters()
+    # @param pending MongoWriteBuffer : bulk_write() pending requests
+    # @param deleted dict : bulk_write() deleted uids
+    # @param bref_ops dict : bulk_write() back references changes
+    # @return a list of records
+    def __bulk_read(self, target, mongo_filters, pending, deleted, bref_ops):
+        coll_name = object_collection_name(target)
+        if pending.writes_on(coll_name):
+            self.__bulk_flush(pending, deleted)
+        uidname = target.uid_fieldname()[0]
+        skip = deleted.get(coll_name, ())
+        res = list()
+        for old_datas in self.__collection(target).find(mongo_filters):
+            uid = old_datas[uidname]
+            if uid in skip:
+                continue
+            for bref_cls, uid_dict in bref_ops.items():
+                if issubclass(target, bref_cls) and uid in uid_dict:
+                    self.__bref_apply(old_datas, uid_dict[uid])
+            res.append(old_datas)
+        return res
+
+    ## @brief Writes pending requests of a bulk_write()
+    # @param pending MongoWriteBuffer : bulk_write() pending requests
+    # @param deleted dict : bulk_write() deleted uids, emptied
+    def __bulk_flush(self, pending, deleted):
+        if len(pending) > 0:
+            pending.flush()
+            self._filters_cache_clear()
+        deleted.clear()
 
     ## @brief Update backref giving an action
     # @param target leObject child class
@@ -330,9 +959,12 @@ abstract, preparing reccursiv calls" % (target, filters, relational_filters))
             old_datas_l = list(old_datas_l)
 
         uidname = target.uid_fieldname()[0]  # MULTIPLE UID BROKEN HERE
+        # Changes of all the records are coalesced and flushed once
+        bref_ops = {}
         for old_datas in old_datas_l:
             self.__update_backref(
-                target, old_datas[uidname], old_datas, new_datas)
+                target, old_datas[uidname], old_datas, new_datas, bref_ops)
+        self.__update_backref_flush(bref_ops)
 
     ## @brief Update back references of an object
     # @ingroup plugin_mongodb_bref_op
@@ -349,35 +981,45 @@ abstract, preparing reccursiv calls" % (target, filters, relational_filters))
     # Delete()
     #   old_datas = self.datas()
     #   self.make_delete()
-    #   self.__update_backref(self.__class__, old_datas, None)
+    #   self.__update_backref(self.__class__, old_datas, None)
     # @par LeObject update __update_backref call
     # <pre>
     # Update(new_datas):
     #   old_datas = self.datas()
     #   self.make_udpdate(new_datas)
-    #   self.__update_backref(self.__class__, old_datas, new_datas)
+    #   self.__update_backref(self.__class__, old_datas, new_datas)
     # </pre>
     #
+    # The back referenced objects are not fetched : the changes are stored
+    # in a bref_ops dict and written with server side operators ($pull and
+    # $addToSet for multiple references, $set for single references) by
+    # __update_backref_flush().
+    #
     # @param target LeObject child classa
     # @param tuid mixed : The target UID (the value that will be inserted in
     # back references)
     # @param old_datas dict : datas state before update
     # @param new_datas dict : datas state after the update process
-    def __update_backref(self, target, tuid, old_datas, new_datas):
-        #upd_dict is the dict that will allow to run updates in an optimized
-        #way (or try to help doing it)
-        #
-        #Its structure looks like :
+    # @param bref_ops dict | None : if given, changes are accumulated in it
+    # and not flushed (the caller has to call __update_backref_flush())
+    # @throw MongoDbConsistencyError if a single back reference without
+    # default value has to be emptied
+    def __update_backref(self, target, tuid, old_datas, new_datas,
+            bref_ops = None):
+        #bref_ops stores the back references changes coalesced by
+        #referenced object. Its structure looks like :
         # { LeoCLASS : {
-        #       UID1: (
-        #           LeoINSTANCE,
-        #           { fname1 : value, fname2: value }),
-        #       UID2 (LeoINSTANCE, {fname...}),
+        #       UID1: {
+        #           multiple_ref_fname: {'add': [uid, ...], 'pull': [...]},
+        #           single_ref_fname: {'set': value}},
+        #       UID2: {...},
         #       },
         #   LeoClass2: {...
         #
-        upd_dict = {}
-        for fname, fdh in target.reference_handlers().items():
+        flush = bref_ops is None
+        if flush:
+            bref_ops = {}
+        for fname, fdh in target.reference_handlers(True).items():
             oldd = old_datas is not None and fname in old_datas and \
                 (not hasattr(fdh, 'default') or old_datas[fname] != fdh.default) \
                 and not old_datas[fname] is None
@@ -388,189 +1030,181 @@ abstract, preparing reccursiv calls" % (target, filters, relational_filters))
                     or not(oldd or newd):
                 # No changes or not concerned
                 continue
-            bref_cls = fdh.back_reference[0]
-            bref_fname = fdh.back_reference[1]
-            if not fdh.is_singlereference():
-                # fdh is a multiple reference. So the update preparation will be
-                # divided into two loops :
-                # - one loop for deleting old datas
-                # - one loop for inserting updated datas
-                #
-                # Preparing the list of values to delete or to add
-                if newd and oldd:
-                    old_values = old_datas[fname]
-                    new_values = new_datas[fname]
-                    to_del = [  val
-                                for val in old_values
-                                if val not in new_values]
-                    to_add = [  val
-                                for val in new_values
-                                if val not in old_values]
-                elif oldd and not newd:
-                    to_del = old_datas[fname]
-                    to_add = []
-                elif not oldd and newd:
-                    to_del = []
-                    to_add = new_datas[fname]
-                # Calling __back_ref_upd_one_value() with good arguments
-                for vtype, vlist in [('old',to_del), ('new', to_add)]:
-                    for value in vlist:
-                        # fetching backref infos
-                        bref_infos = self.__bref_get_check(
-                            bref_cls, value, bref_fname)
-                        # preparing the upd_dict
-                        upd_dict = self.__update_backref_upd_dict_prepare(
-                            upd_dict, bref_infos, bref_fname, value)
-                        # preparing updated bref_infos
-                        bref_cls, bref_leo, bref_dh, bref_value = bref_infos
-                        bref_infos = (bref_cls, bref_leo, bref_dh,
-                            upd_dict[bref_cls][value][1][bref_fname])
-                        vdict = {vtype: value}
-                        # fetch and store updated value
-                        new_bref_val = self.__back_ref_upd_one_value(
-                            fname, fdh, tuid, bref_infos, **vdict)
-                        upd_dict[bref_cls][value][1][bref_fname] = new_bref_val
+            bref_cls, bref_fname = fdh.back_reference
+            bref_dh = bref_cls.data_handler(bref_fname)
+            if not bref_dh.is_reference():
+                raise LodelFatalError("Found a back reference field that \
+is not a reference : '%s' field '%s'" % (bref_cls.__name__, bref_fname))
+            old_values = new_values = ()
+            if oldd:
+                old_values = [old_datas[fname]] \
+                    if fdh.is_singlereference() else old_datas[fname]
+            if newd:
+                new_values = [new_datas[fname]] \
+                    if fdh.is_singlereference() else new_datas[fname]
+            new_set = set(new_values)
+            old_set = set(old_values)
+            for value in old_values:
+                if value not in new_set:
+                    self.__bref_op(bref_ops, bref_cls, value, bref_fname,
+                        bref_dh, tuid, False)
+            for value in new_values:
+                if value not in old_set:
+                    self.__bref_op(bref_ops, bref_cls, value, bref_fname,
+                        bref_dh, tuid, True)
+        if flush:
+            self.__update_backref_flush(bref_ops)
+
+    ## @brief Stores a back reference change in a bref_ops dict
+    #
+    # An add cancels a previous removal of the same value and vice versa.
+    # @param bref_ops dict : as built by __update_backref()
+    # @param bref_cls LeObject child class : the back referenced class
+    # @param uidv mixed : the back referenced object UID
+    # @param bref_fname str : the back reference field name
+    # @param bref_dh DataHandler : the back reference field data handler
+    # @param tuid mixed : the uid to add in or remove from the back reference
+    # @param add bool : True to add tuid, False to remove it
+    # @throw MongoDbConsistencyError if a single back reference without
+    # default value has to be emptied
+    @staticmethod
+    def __bref_op(bref_ops, bref_cls, uidv, bref_fname, bref_dh, tuid, add):
+        fields_ops = bref_ops.setdefault(bref_cls, {}).setdefault(uidv, {})
+        if bref_dh.is_singlereference():
+            if add:
+                fields_ops[bref_fname] = {'set': tuid}
+            elif not hasattr(bref_dh, 'default'):
+                raise MongoDbConsistencyError("Unable to delete a value for a \
+back reference update. The concerned field don't have a default value : in \
+%s field %s" % (bref_cls.__name__, bref_fname))
             else:
-                # fdh is a single ref so the process is simpler, we do not have
-                # to loop and we may do an update in only one
-                # __back_ref_upd_one_value() call by giving both old and new
-                # value
-                vdict = {}
-                if oldd:
-                    vdict['old'] = old_datas[fname]
-                    uid_val = vdict['old']
-                if newd:
-                    vdict['new'] = new_datas[fname]
-                    if not oldd:
-                        uid_val = vdict['new']
-                # Fetching back ref infos
-                bref_infos = self.__bref_get_check(
-                    bref_cls, uid_val, bref_fname)
-                # prepare the upd_dict
-                upd_dict = self.__update_backref_upd_dict_prepare(
-                    upd_dict, bref_infos, bref_fname, uid_val)
-                # forging update bref_infos
-                bref_cls, bref_leo, bref_dh, bref_value = bref_infos
-                bref_infos = (bref_cls, bref_leo, bref_dh,
-                        upd_dict[bref_cls][uid_val][1][bref_fname])
-                # fetch and store updated value
-                new_bref_val = self.__back_ref_upd_one_value(
-                    fname, fdh, tuid, bref_infos, **vdict)
-                upd_dict[bref_cls][uid_val][1][bref_fname] = new_bref_val
-        # Now we've got our upd_dict ready.
-        # running the updates
-        for bref_cls, uid_dict in upd_dict.items():
-            for uidval, (leo, datas) in uid_dict.items():
-                # MULTIPLE UID BROKEN 2 LINES BELOW
-                self.__update_no_backref(
-                    leo.__class__, [(leo.uid_fieldname()[0], '=', uidval)],
-                    [], datas)
-
-    ## @brief Utility function designed to handle the upd_dict of __update_backref()
-    #
-    # Basically checks if a key exists at some level, if not create it with
-    # the good default value (in most case dict())
-    # @param upd_dict dict : in & out args modified by reference
-    # @param bref_infos tuple : as returned by __bref_get_check()
-    # @param bref_fname str : name of the field in referenced class
-    # @param uid_val mixed : the UID of the referenced object
-    # @return the updated version of upd_dict
+                fields_ops[bref_fname] = {'set': bref_dh.default}
+            return
+        op = fields_ops.setdefault(bref_fname, {'add': [], 'pull': []})
+        cancel, store = ('pull', 'add') if add else ('add', 'pull')
+        if tuid in op[cancel]:
+            op[cancel].remove(tuid)
+        elif tuid not in op[store]:
+            op[store].append(tuid)
+
+    ## @brief Applies the back references changes of an object to its datas
+    # @param datas dict : the object datas, modified
+    # @param fields_ops dict : the changes of the object as stored by
+    # __bref_op()
     @staticmethod
-    def __update_backref_upd_dict_prepare(upd_dict,bref_infos, bref_fname,
-            uid_val):
-        bref_cls, bref_leo, bref_dh, bref_value = bref_infos
-        if bref_cls not in upd_dict:
-            upd_dict[bref_cls] = {}
-        if uid_val not in upd_dict[bref_cls]:
-            upd_dict[bref_cls][uid_val] = (bref_leo, {})
-        if bref_fname not in upd_dict[bref_cls][uid_val]:
-            upd_dict[bref_cls][uid_val][1][bref_fname] = bref_value
-        return upd_dict
-
-
-    ## @brief Prepare a one value back reference update
-    # @param fname str : the source Reference field name
-    # @param fdh DataHandler : the source Reference DataHandler
-    # @param tuid mixed : the uid of the Leo that make reference to the backref
-    # @param bref_infos tuple : as returned by __bref_get_check() method
-    # @param old mixed : (optional **values) the old value
-    # @param new mixed : (optional **values) the new value
-    # @return the new back reference field value
-    def __back_ref_upd_one_value(self, fname, fdh, tuid, bref_infos, **values):
-        bref_cls, bref_leo, bref_dh, bref_val = bref_infos
-        oldd = 'old' in values
-        newdd = 'new' in values
-        if bref_val is None:
-            bref_val = bref_dh.empty()
-        if not bref_dh.is_singlereference():
-            if oldd and newdd:
-                if tuid not in bref_val:
-                    raise MongoDbConsistencyError("The value we want to \
-delete in this back reference update was not found in the back referenced \
-object : %s. Value was : '%s'" % (bref_leo, tuid))
-                return bref_val
-            elif oldd and not newdd:
-                # deletion
-                old_value = values['old']
-                if tuid not in bref_val:
-                    raise MongoDbConsistencyError("The value we want to \
-delete in this back reference update was not found in the back referenced \
-object : %s. Value was : '%s'" % (bref_leo, tuid))
-                if isinstance(bref_val, tuple):
-                    bref_val = set(bref_val)
-                if isinstance(bref_val, set):
-                    bref_val -= set([tuid])
-                else:
-                    del(bref_val[bref_val.index(tuid)])
-            elif not oldd and newdd:
-                if tuid in bref_val:
-                    raise MongoDbConsistencyError("The value we want to \
-add in this back reference update was found in the back referenced \
-object : %s. Value was : '%s'" % (bref_leo, tuid))
-                if isinstance(bref_val, tuple):
-                    bref_val = set(bref_val)
-                if isinstance(bref_val, set):
-                    bref_val |= set([tuid])
-                else:
-                    bref_val.append(tuid)
-        else:
-            # Single value backref
-            if oldd and newdd:
-                if bref_val != tuid:
-                    raise MongoDbConsistencyError("The backreference doesn't \
-have expected value. Expected was %s but found %s in %s" % (
-                        tuid, bref_val, bref_leo))
-                return bref_val
-            elif oldd and not newdd:
-                # deletion
-                if not hasattr(bref_dh, "default"):
-                    raise MongoDbConsistencyError("Unable to delete a \
-value for a back reference update. The concerned field don't have a default \
-value : in %s field %s" % (bref_leo,fname))
-                bref_val = getattr(bref_dh, "default")
-            elif not oldd and newdd:
-                bref_val = tuid
-        return bref_val
-
-    ## @brief Fetch back reference informations
-    # @warning thank's to __update_backref_act() this method is useless
-    # @param bref_cls LeObject child class : __back_reference[0]
-    # @param uidv mixed : UID value (the content of the reference field)
-    # @param bref_fname str : the name of the back_reference field
-    # @return tuple(bref_class, bref_LeObect_instance, bref_datahandler, bref_value)
-    # @throw MongoDbConsistencyError when LeObject instance not found given uidv
-    # @throw LodelFatalError if the back reference field is not a Reference subclass (major failure)
-    def __bref_get_check(self, bref_cls, uidv, bref_fname):
-        bref_leo = bref_cls.get_from_uid(uidv)
-        if bref_leo is None:
-            raise MongoDbConsistencyError("Unable to get the object we make \
-reference to : %s with uid = %s" % (bref_cls, repr(uidv)))
-        bref_dh = bref_leo.data_handler(bref_fname)
-        if not bref_dh.is_reference():
-            raise LodelFatalError("Found a back reference field that \
-is not a reference : '%s' field '%s'" % (bref_leo, bref_fname))
-        bref_val = bref_leo.data(bref_fname)
-        return (bref_leo.__class__, bref_leo, bref_dh, bref_val)
+    def __bref_apply(datas, fields_ops):
+        for fname, op in fields_ops.items():
+            if 'set' in op:
+                datas[fname] = op['set']
+                continue
+            value = datas.get(fname, None)
+            value = [] if value is None else list(value)
+            pull = set(op['pull'])
+            value = [v for v in value if v not in pull]
+            value += [v for v in op['add'] if v not in value]
+            datas[fname] = value
+
+    ## @brief Runs the updates prepared by __update_backref()
+    # @param bref_ops dict : as built by __update_backref()
+    def __update_backref_flush(self, bref_ops):
+        write_buffer = MongoWriteBuffer(self.database)
+        for coll_name, requests in self.__bref_requests(bref_ops):
+            write_buffer.add(coll_name, requests, ordered = False)
+        if len(write_buffer) > 0:
+            write_buffer.flush()
+            self._filters_cache_clear()
+
+    ## @brief Converts back references changes in bulk write requests
+    #
+    # Each change gives UpdateOne requests for each concrete collection of
+    # the back referenced class. The requests do not depend on each other
+    # and can be sent unordered : a pulled value is never added, and lists
+    # are updated with $pull/$addToSet only when they exist (the filter on
+    # the field type excludes null fields, set with $set instead). In
+    # consistency verification mode (see the check_backrefs option) the
+    # back referenced objects are read first to check the changes.
+    # @param bref_ops dict : as built by __update_backref()
+    # @return a list of tuples (collection name, requests list)
+    # @throw MongoDbConsistencyError if a check fails
+    def __bref_requests(self, bref_ops):
+        if self.__check_backrefs:
+            self.__bref_check(bref_ops)
+        res = list()
+        for bref_cls, uid_dict in bref_ops.items():
+            uidname = bref_cls.uid_fieldname()[0] #MULTIPLE UID BROKEN HERE
+            requests = list()
+            for uidv, fields_ops in uid_dict.items():
+                set_datas = dict()
+                for fname, op in fields_ops.items():
+                    if 'set' in op:
+                        set_datas[fname] = op['set']
+                        continue
+                    is_list = {uidname: uidv, fname: {'$type': 'array'}}
+                    if len(op['pull']) > 0:
+                        requests.append(pymongo.UpdateOne(
+                            is_list, {'$pull': {fname: {'$in': op['pull']}}}))
+                    if len(op['add']) > 0:
+                        requests.append(pymongo.UpdateOne(
+                            is_list,
+                            {'$addToSet': {fname: {'$each': op['add']}}}))
+                        # $addToSet fails on null fields
+                        requests.append(pymongo.UpdateOne(
+                            {uidname: uidv, fname: None},
+                            {'$set': {fname: list(op['add'])}}))
+                if len(set_datas) > 0:
+                    requests.append(pymongo.UpdateOne(
+                        {uidname: uidv}, {'$set': set_datas}))
+            if len(requests) == 0:
+                continue
+            for coll_cls in self.__concrete_classes(bref_cls):
+                res.append((object_collection_name(coll_cls), requests))
+        return res
+
+    ## @brief Checks back references changes against the stored objects
+    #
+    # The back referenced objects are fetched with one find per collection.
+    # @param bref_ops dict : as built by __update_backref()
+    # @throw MongoDbConsistencyError if an object is not found, if a removed
+    # value is not found or if an added value is already there
+    def __bref_check(self, bref_ops):
+        for bref_cls, uid_dict in bref_ops.items():
+            uidname = bref_cls.uid_fieldname()[0] #MULTIPLE UID BROKEN HERE
+            fnames = {fname for fields_ops in uid_dict.values()
+                for fname in fields_ops}
+            found = dict()
+            for coll_cls in self.__concrete_classes(bref_cls):
+                for datas in self.__collection(coll_cls).find(
+                        {uidname: {'$in': list(uid_dict)}},
+                        [uidname] + list(fnames)):
+                    found[datas[uidname]] = datas
+            for uidv, fields_ops in uid_dict.items():
+                if uidv not in found:
+                    raise MongoDbConsistencyError("Unable to get the object \
+we make reference to : %s with uid = %s" % (bref_cls, repr(uidv)))
+                for fname, op in fields_ops.items():
+                    if 'set' in op:
+                        continue
+                    value = found[uidv].get(fname, None) or ()
+                    for tuid in op['pull']:
+                        if tuid not in value:
+                            raise MongoDbConsistencyError("The value we want \
+to delete in this back reference update was not found in the back referenced \
+object : %s %s. Value was : '%s'" % (bref_cls.__name__, uidv, tuid))
+                    for tuid in op['add']:
+                        if tuid in value:
+                            raise MongoDbConsistencyError("The value we want \
+to add in this back reference update was found in the back referenced \
+object : %s %s. Value was : '%s'" % (bref_cls.__name__, uidv, tuid))
+
+    ## @brief Returns the non abstract classes storing the objects of a class
+    # @param leo_cls LeObject child class
+    # @return a list of LeObject child classes
+    @staticmethod
+    def __concrete_classes(leo_cls):
+        if not leo_cls.is_abstract():
+            return [leo_cls]
+        return [child for child in leo_cls.child_classes()
+            if not child.is_abstract()]
 
     ## @brief Act on abstract LeObject child
     #
@@ -582,7 +1216,6 @@ is not a reference : '%s' field '%s'" % (bref_leo, bref_fname))
     # @param act function : the caller method
     # @param **kwargs other arguments
     # @return sum of results (if it's an array it will result in a concat)
-    # @todo optimization implementing a cache for __bref_get_check()
     def __act_on_abstract(self,
         target, filters, relational_filters, act, **kwargs):
 
@@ -597,20 +1230,9 @@ on non abstract childs" % act.__name__)
         for target_child in target_childs:
             logger.debug(
                 "Abstract %s on %s" % (act.__name__, target_child.__name__))
-            # Add target_child to filter
-            new_filters = copy.copy(filters)
-            for i in range(len(filters)):
-                fname, op, val = filters[i]
-                if fname == CLASS_ID_FIELDNAME:
-                    logger.warning("Dirty drop of filter : '%s %s %s'" % (
-                        fname, op, val))
-                    del(new_filters[i])
-            new_filters.append(
-                (CLASS_ID_FIELDNAME, '=',
-                    collection_name(target_child.__name__)))
             result += act(
                 target = target_child,
-                filters = new_filters,
+                filters = self.__child_filters(filters, target_child),
                 relational_filters = relational_filters,
                 **kwargs)
         return result
@@ -661,6 +1283,19 @@ on non abstract childs" % act.__name__)
     # @param relational_filters : same composition thant filters except that FIELD is represented by a tuple(FIELDNAME, {CLASS1:RFIELD1, CLASS2:RFIELD2})
     # @return a list of pymongo filters ( dict {FIELD:{OPERATOR:VALUE}} )
     def __process_filters(self,target, filters, relational_filters):
+        cache = getattr(self._filters_local, 'filters', None)
+        if cache is not None:
+            key = (target, repr(filters), repr(relational_filters))
+            if key not in cache:
+                cache[key] = self.__compile_filters(
+                    target, filters, relational_filters)
+            return cache[key]
+        return self.__compile_filters(target, filters, relational_filters)
+
+    ## @brief Converts lodel filters in pymongo filters, running the
+    # relational filters subqueries
+    # @see __process_filters()
+    def __compile_filters(self, target, filters, relational_filters):
         # Simple filters lodel2 -> pymongo converting
         res = self.__filters2mongo(filters, target)
         rfilters = self.__prepare_relational_filters(target, relational_filters)
@@ -676,17 +1311,18 @@ on non abstract childs" % act.__name__)
                 res[fname] = dict()
             subq_results = set()
             for leobject, sq_filters in rfilters[fname].items():
-                uid_fname = mongo_fieldname(leobject._uid)
-                log_msg = "Subquery running on collection {coll} with filters \
-'{filters}'"
-                logger.debug(log_msg.format(
-                    coll=object_collection_name(leobject),
-                    filters=sq_filters))
-
-                cursor = self.__collection(leobject).find(
-                    filter=sq_filters,
-                    projection=uid_fname)
-                subq_results |= set(doc[uid_fname] for doc in cursor)
+                # abstract classes objects are stored in their childs
+                # collections
+                for concrete in self.__concrete_classes(leobject):
+                    uid_fname = mongo_fieldname(concrete._uid[0]) #MULTIPLE UID BROKEN HERE
+                    log_msg = "Subquery running on collection {coll} with \
+filters '{filters}'"
+                    logger.debug(log_msg.format(
+                        coll=object_collection_name(concrete),
+                        filters=sq_filters))
+
+                    subq_results |= self.__subquery(
+                        concrete, sq_filters, uid_fname)
             #generating new filter from result
             if '$in' in res[fname]:
                 #WARNING we allready have a IN on this field, doing dedup
@@ -702,6 +1338,123 @@ on non abstract childs" % act.__name__)
             logger.debug("End of subquery execution")
         return res
 
+    ## @brief Forges the aggregation stages joining the referenced objects
+    # matched by relational filters
+    #
+    # For each relational field, the referenced objects are joined with a
+    # $lookup stage by referenced collection (the non abstract classes of the
+    # referenced classes). A $match stage keeps the documents having at least
+    # one joined object matching the conditions of its collection, then the
+    # joined objects are dropped by a $project stage :
+    #<pre>[{'$lookup': {'from': 'Person', 'localField': 'linked_persons',
+    #    'foreignField': 'lodel_id', 'as': '_lookup_0'}},
+    # {'$match': {'_lookup_0': {'$elemMatch': {'lastname': {'$eq': 'foo'}}}}},
+    # {'$project': {'_lookup_0': 0}}]</pre>
+    #
+    # The referenced objects stay on the server, unlike the subqueries of
+    # __compile_filters() which fetch their uids to forge an $in filter.
+    # Hierarch fields are joined the same way : relational filters are about
+    # the directly referenced objects, not their ancestors.
+    #
+    # @param target LeObject child class : the queried class
+    # @param relational_filters list|None : relational filters
+    # @return a list of pipeline stages or None if relational filters have to
+    # be resolved by subqueries (no relational filters, lookups disabled or
+    # a referenced class stored by another datasource)
+    def __lookup_stages(self, target, relational_filters):
+        if not self.__relational_lookup or not relational_filters:
+            return None
+        rfilters = self.__prepare_relational_filters(
+            target, relational_filters)
+        stages = list()
+        conditions = list()
+        aliases = list()
+        for fname, leo_rfields in rfilters.items():
+            # conditions by referenced collection name
+            coll_conds = OrderedDict()
+            for leobject, rfields in leo_rfields.items():
+                if leobject._datasource_name != target._datasource_name:
+                    return None
+                for concrete in self.__concrete_classes(leobject):
+                    cond = coll_conds.setdefault(
+                        object_collection_name(concrete),
+                        (mongo_fieldname(concrete._uid[0]), dict()))[1]
+                    for rfield, op_values in rfields.items():
+                        cond[mongo_fieldname(rfield)] = \
+                            self.__op_value_listconv(
+                                op_values, concrete.field(rfield))
+            if len(coll_conds) == 0:
+                return None
+            alternatives = list()
+            for coll_name, (uid_fname, cond) in coll_conds.items():
+                alias = '_lookup_%d' % len(aliases)
+                aliases.append(alias)
+                stages.append({'$lookup': {
+                    'from': coll_name,
+                    'localField': mongo_fieldname(fname),
+                    'foreignField': uid_fname,
+                    'as': alias}})
+                alternatives.append({alias: {'$elemMatch': cond}})
+            if len(alternatives) == 1:
+                conditions.append(alternatives[0])
+            else:
+                conditions.append({'$or': alternatives})
+        if len(conditions) == 1:
+            stages.append({'$match': conditions[0]})
+        else:
+            stages.append({'$match': {'$and': conditions}})
+        stages.append({'$project': {alias: 0 for alias in aliases}})
+        return stages
+
+    ## @brief Runs a relational filter subquery
+    #
+    # Results are reused in a filters cache scope.
+    # @param leobject LeObject child class : the queried class
+    # @param sq_filters dict : pymongo filters
+    # @param uid_fname str : the uid field name
+    # @return a set of uids
+    def __subquery(self, leobject, sq_filters, uid_fname):
+        cache = getattr(self._filters_local, 'subqueries', None)
+        key = (object_collection_name(leobject), repr(sq_filters))
+        if cache is not None and key in cache:
+            return cache[key]
+        cursor = self.__collection(leobject).find(
+            filter=sq_filters,
+            projection=uid_fname)
+        res = frozenset(doc[uid_fname] for doc in cursor)
+        if cache is not None:
+            cache[key] = res
+        return res
+
+    ## @brief Opens a filters cache scope
+    #
+    # In a scope, the processed filters (see __process_filters() ) and the
+    # subqueries results are memoized. Nested scopes share the caches of the
+    # outermost one, closed at its end.
+    @contextlib.contextmanager
+    def _filters_scope(self):
+        local = self._filters_local
+        outermost = getattr(local, 'filters', None) is None
+        if outermost:
+            local.filters, local.subqueries = dict(), dict()
+        try:
+            yield
+        finally:
+            if outermost:
+                local.filters = local.subqueries = None
+
+    ## @brief Empties the filters cache of the current scope
+    #
+    # Called after each write : subqueries results may change. In a scope
+    # spanning several writes (like deletes or updates of an abstract class
+    # running on each child class) the following filters are processed
+    # again.
+    def _filters_cache_clear(self):
+        local = self._filters_local
+        if getattr(local, 'filters', None) is not None:
+            local.filters.clear()
+            local.subqueries.clear()
+
     ## @brief Generate subqueries from rfilters tree
     #
     # Returned struct organization :
@@ -751,7 +1504,6 @@ on non abstract childs" % act.__name__)
         for (fname, rfields), op, value in relational_filters:
             if fname not in rfilters:
                 rfilters[fname] = dict()
-            rfilters[fname] = dict()
             # Stores the representative leobject for associated to a collection
             # name
             leo_collname = dict()
@@ -763,7 +1515,7 @@ on non abstract childs" % act.__name__)
                 cur_collname = object_collection_name(leobject)
                 if cur_collname not in leo_collname:
                     leo_collname[cur_collname] = leobject
-                    rfilters[fname][leobject] = dict()
+                    rfilters[fname].setdefault(leobject, dict())
                 #Fecthing the collection's representative leobject
                 repr_leo = leo_collname[cur_collname]
 
@@ -825,7 +1577,12 @@ by an equality filter")
         # Converting lodel2 wildcarded string into a case insensitive
         # mongodb re
         if mongop in cls.mongo_op_re:
-            if value.startswith('(') and value.endswith(')'):
+            if isinstance(value, (list, tuple, set)):
+                if getattr(dhdl, 'cast_type', None) is not None:
+                    mongoval = [ dhdl.cast_type(item) for item in value ]
+                else:
+                    mongoval = list(value)
+            elif value.startswith('(') and value.endswith(')'):
                 if (dhdl.cast_type is not None):
                     mongoval = [ dhdl.cast_type(item) for item in mongoval[1:-1].split(',') ]
                 else:
@@ -851,7 +1608,8 @@ by an equality filter")
     def __op_value_listconv(cls, op_value_list, dhdl):
         result = dict()
         for op, value in op_value_list:
-            mongop, mongoval = cls.__op_value_conv(op, value, dhdl)
+            op, mongoval = cls.__op_value_conv(op, value, dhdl)
+            mongop = cls.lodel2mongo_op_map[op]
             if mongop in result:
                 warnings.warn("Duplicated value given for a single \
 field/operator couple in a query. We will keep only the first one")
@@ -859,21 +1617,6 @@ field/operator couple in a query. We will keep only the first one")
                 result[mongop] = mongoval
         return result
 
-    ##@brief Generate a comparison function for post reccursion sorting in
-    #select
-    #@return a lambda function that take 2 dict as arguement
-    @classmethod
-    def __generate_lambda_cmp_order(cls, order):
-        if len(order) == 0:
-            return lambda a,b: 0
-        glco = cls.__generate_lambda_cmp_order
-        fname, cmpdir = order[0]
-        order = order[1:]
-        return lambda a,b: glco(order)(a,b) if a[fname] == b[fname] else (\
-            1 if (a[fname]>b[fname] if cmpdir == 'ASC' else a[fname]<b[fname])\
-            else -1)
-
-
     ##@brief Correct some datas before giving them to pymongo
     #
     #For example sets has to be casted to lise
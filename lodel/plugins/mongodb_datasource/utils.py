@@ -20,6 +20,7 @@
 
 import pymongo
 from pymongo import MongoClient
+from pymongo.write_concern import WriteConcern
 
 from lodel.context import LodelContext
 LodelContext.expose_modules(globals(), {
@@ -28,7 +29,8 @@ LodelContext.expose_modules(globals(), {
 
 common_collections = {
     'object': 'objects',
-    'relation': 'relation'
+    'relation': 'relation',
+    'counters': 'counters'
 }
 
 LODEL_SORT_OPERATORS_MAP = {
@@ -79,6 +81,24 @@ to fails")
         ret += '?readOnly='+str(bool(ro))
     return ret
 
+## @brief Builds a write concern from the datasource options
+# @param w str|None : number of acknowledging nodes or a tag (like
+# "majority")
+# @param j bool|None : if True writes are acknowledged once journaled
+# @param wtimeout int|None : acknowledgement timeout in milliseconds
+# @return a pymongo WriteConcern instance or None if no option is set
+def write_concern(w = None, j = None, wtimeout = None):
+    options = dict()
+    if w is not None:
+        options['w'] = int(w) if str(w).isdigit() else w
+    if j is not None:
+        options['j'] = bool(j)
+    if wtimeout is not None:
+        options['wtimeout'] = int(wtimeout)
+    if len(options) == 0:
+        return None
+    return WriteConcern(**options)
+
 ##@brief Return an instanciated MongoClient from a connstring
 #@param connstring str : as returned by connection_string() method
 #@return A MongoClient instance
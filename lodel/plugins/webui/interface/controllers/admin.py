@@ -109,11 +109,10 @@ def admin_update(request):
         raise HttpException(400)
     else:
         # Check if the object actually exists
-        # We get it from the database
-        query_filters = list()
-        query_filters.append((uid_field,'=',lodel_id))
-        obj = target_leo.get(query_filters)
-        if len(obj) == 0:
+        # We get it from the database, the fetched object is kept in the
+        # request identity map for the template
+        obj = target_leo.get_from_uid(lodel_id)
+        if obj is None:
             raise HttpException(404)
     return get_response('admin/admin_edit.html', target=target_leo, lodel_id =lodel_id)
 
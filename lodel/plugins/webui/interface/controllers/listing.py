@@ -18,6 +18,8 @@
 #
 
 
+from collections import OrderedDict
+
 from lodel.context import LodelContext
 LodelContext.expose_modules(globals(), {'lodel.logger': 'logger'})
 LodelContext.expose_dyncode(globals(), 'dyncode')
@@ -26,6 +28,9 @@ from .base import get_response
 from .utils import *
 from ...exceptions import *
 
+##@brief Number of objects displayed by page when listing a class
+SHOW_CLASS_PAGE_SIZE = 100
+
 ##@brief These functions are called by the rules defined in ../urls.py
 ## To browse the editorial model
 
@@ -45,6 +50,34 @@ def list_classes(request):
 def collections(request):
     return get_response('listing/collections.html', my_classes=dyncode, get_authors=get_authors)
 
+##@brief Returns the authors of the texts of issues
+#
+# The texts of all the issues are fetched with one query and their authors
+# are prefetched (see LeObject.get() ) instead of running a Person query by
+# issue
+# @param issues list : Issue instances
+# @return a dict of Person instances lists indexed by issue uid
+def get_authors(issues):
+    text_uids = set()
+    for issue in issues:
+        text_uids |= set(issue.data('linked_texts') or ())
+    texts = dict()
+    if len(text_uids) > 0:
+        uid_field = dyncode.Text.uid_fieldname()[0]
+        for text in dyncode.Text.get([(uid_field, 'in', sorted(text_uids))],
+                prefetch = ['linked_persons']):
+            texts[text.uid()] = text
+    authors = dict()
+    for issue in issues:
+        issue_authors = OrderedDict()
+        for text_uid in issue.data('linked_texts') or ():
+            if text_uid not in texts:
+                continue
+            for person in texts[text_uid].referenced('linked_persons') or ():
+                issue_authors[person.uid()] = person
+        authors[issue.uid()] = list(issue_authors.values())
+    return authors
+
 ##@brief Controller's function to list all types (classes) of the editorial model
 # @param request : the request (get or post)
 # @note the response is given in a html page called in get_response_function
@@ -67,7 +100,17 @@ def show_class(request):
             classname = None
     else:
         raise HttpException(400)
-    return get_response('listing/show_class.html', classname=classname)
+    objects, next_page = None, None
+    if classname is not None and not target_leo.is_abstract():
+        after = request.GET['after'][0] if 'after' in request.GET else None
+        try:
+            objects, next_page = target_leo.get_page(
+                None, SHOW_CLASS_PAGE_SIZE, after = after)
+        except ValueError:
+            # invalid continuation token
+            raise HttpException(400)
+    return get_response('listing/show_class.html', classname=classname,
+        objects = objects, next_page = next_page)
 
 ##@brief Controller's function to display an instance or a certain type
 # @param request : the request (get or post)
@@ -101,10 +144,10 @@ def show_object(request):
     if not test_valid:
         raise HttpException(400)
     else:
-        query_filters = list()
-        query_filters.append((uid_field,'=',lodel_id))
-        obj = target_leo.get(query_filters)
-        if len(obj) == 0:
+        # The fetched object is kept in the request identity map, the
+        # template will not query it again
+        obj = target_leo.get_from_uid(lodel_id)
+        if obj is None:
             raise HttpException(404)
     return get_response('listing/show_object.html', lodel_id=lodel_id, classname=classname)
 
@@ -140,10 +183,10 @@ def show_object_detailled(request):
     if not test_valid:
         raise HttpException(400)
     else:
-        query_filters = list()
-        query_filters.append((uid_field,'=',lodel_id))
-        obj = target_leo.get(query_filters)
-        if len(obj) == 0:
+        # The fetched object is kept in the request identity map, the
+        # template will not query it again
+        obj = target_leo.get_from_uid(lodel_id)
+        if obj is None:
             raise HttpException(404)
 
     return get_response('listing/show_object_detailled.html', lodel_id=lodel_id, classname=classname)
@@ -43,8 +43,8 @@ def signin(request):
         leoclass=WebUiClient['__auth_user_infos']['leoclass']
         query_filter=list()
         query_filter.append((leoclass.uid_fieldname()[0],'=', uid))
-        user = leoclass.get(query_filter)
-        return get_response('users/welcome.html', username = user[0].data('login'))
+        login = leoclass.values_list(query_filter, ['login'], flat = True)
+        return get_response('users/welcome.html', username = login[0])
     else:
         return get_response('users/signin.html')
     
@@ -33,6 +33,7 @@ from werkzeug.wrappers import Response
 LodelContext.expose_modules(globals(), {
     'lodel.settings': ['Settings'],
     'lodel.logger': 'logger',
+    'lodel.leapi.identity_map': ['LeIdentityMap'],
     'lodel.auth.exceptions': ['ClientError', 'ClientAuthenticationFailure',
         'ClientPermissionDenied', 'ClientAuthenticationError']})
 
@@ -93,6 +94,9 @@ except NameError:
 def application(env, start_response):
     request = LodelRequest(env)
     session_token = None
+    # Objects fetched by uid are shared by the controller and the templates
+    # for the duration of the request
+    LeIdentityMap.open()
     try:
         #We have to create the client before restoring cookie in order to be able
         #to log messages with client infos
@@ -125,9 +129,13 @@ def application(env, start_response):
         response = HttpException(200).render(request)
         empty_cookie(response)
     except Exception as e:
+        LeIdentityMap.close()
         raise e
 
-    res = response(env, start_response)
+    try:
+        res = response(env, start_response)
+    finally:
+        LeIdentityMap.close()
 
     WebUiClient.clean()
     return res
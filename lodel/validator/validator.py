@@ -465,6 +465,8 @@ LODEL2_CONF_SPECS = {
         'debug': (True, Validator('bool')),
         'sitename': ('noname', Validator('strip')),
         'runtest': (False, Validator('bool')),
+        'subqueries_workers': (1, Validator('int')),
+        'hooks_stats': (False, Validator('bool')),
     },
     'lodel2.logging.*': {
         'level': ('ERROR', Validator('loglevel')),
@@ -483,6 +485,9 @@ LODEL2_CONF_SPECS = {
     'lodel2.datasources.*': {
         'read_only': (False, Validator('bool')),
         'identifier': (None, Validator('string')),
+        'cache_size': (0, Validator('int')),
+        'cache_ttl': (300, Validator('int')),
+        'cache_max_result': (100, Validator('int')),
     },
     'lodel2.auth': {
         'login_classfield': ('user.login', Validator('emfield')),
@@ -20,8 +20,10 @@
 
 import unittest
 
-from lodel.leapi.datahandlers.base_classes import DataHandler
-from lodel.leapi.datahandlers.datas import Varchar
+from lodel.leapi.datahandlers.base_classes import DataHandler, \
+    construct_order, construct_downstream
+from lodel.leapi.datahandlers.datas import Varchar, Concat, FormatString, \
+    DateTime
 
 
 class DataHandlerTestCase(unittest.TestCase):
@@ -62,3 +64,39 @@ class DataHandlerTestCase(unittest.TestCase):
             DataHandler.from_name('test_varchar3')
         except Exception as err:
             self.assertEqual(NameError, type(err))
+
+
+class ConstructOrderTestCase(unittest.TestCase):
+    """ Testing the fields construction order """
+
+    def setUp(self):
+        self.fields = {
+            'title': Concat(['name', 'number']),
+            'label': FormatString('%s (%s)', ['title', 'name']),
+            'name': Varchar(),
+            'number': Varchar(),
+            'date_update': DateTime(now_on_update = True, internal = True),
+            'date_create': DateTime(now_on_create = True, internal = True)}
+
+    def test_construct_order(self):
+        """ Testing that dependencies are constructed first """
+        self.assertEqual(
+            construct_order(self.fields),
+            ('name', 'number', 'title', 'label', 'date_update',
+             'date_create'))
+
+    def test_circular_dependencies(self):
+        """ Testing circular dependencies detection """
+        self.fields['name'] = FormatString('%s', ['label'])
+        with self.assertRaises(RuntimeError):
+            construct_order(self.fields)
+
+    def test_construct_downstream(self):
+        """ Testing the fields to construct again when a field changes """
+        res = construct_downstream(
+            self.fields, construct_order(self.fields))
+        self.assertEqual(res['name'], ('title', 'label', 'date_update'))
+        self.assertEqual(res['number'], ('title', 'label', 'date_update'))
+        self.assertEqual(res['title'], ('label', 'date_update'))
+        self.assertEqual(res['date_create'], ('date_update',))
+        self.assertEqual(res['date_update'], ())
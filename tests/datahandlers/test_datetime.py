@@ -43,3 +43,17 @@ class DatetimeTestCase(unittest.TestCase):
         for test_value in ['2016-01-01-test', '2016/01/01', 2016]:
             with self.assertRaises(FieldValidationError):
                 test_datetime._check_data_value(test_value)
+
+    def test_check_data_values(self):
+        """ Testing that a column of dates is checked """
+        test_datetime = DateTime()
+        res = test_datetime.check_data_values(
+            ['2016-01-01', '2016/01/01', '2016-01-01',
+             datetime.datetime(2017, 1, 1)])
+        self.assertEqual(
+            [value for value, _ in res],
+            [datetime.datetime(2016, 1, 1), None, datetime.datetime(2016, 1, 1),
+             datetime.datetime(2017, 1, 1)])
+        self.assertIsInstance(res[1][1], FieldValidationError)
+        self.assertEqual([err is None for _, err in res],
+                         [True, False, True, True])
@@ -53,3 +53,13 @@ class IntegerTestCase(unittest.TestCase):
     def test_can_override(self):
         test_boolean = Boolean()
         self.assertFalse(test_int.can_override(test_boolean))
+
+    def test_check_data_values(self):
+        """ Testing that column checks give the check_data_value() results """
+        values = [10, '15.2', 15.0, True, 2 ** 60, None, 'ok']
+        res = test_int.check_data_values(values)
+        self.assertEqual(
+            [value for value, _ in res], [10, 15, 15, 1, 2 ** 60, None, None])
+        self.assertEqual(
+            [type(err) for _, err in res],
+            [type(test_int.check_data_value(value)[1]) for value in values])
@@ -54,6 +54,16 @@ class RegexTestCase(unittest.TestCase):
             
     def test_valid_field_value_is_returned(self):
         self.assertEqual(self.valid_value, self.testee._check_data_value(self.valid_value))
+
+
+    def test_check_data_values(self):
+        values = [self.valid_value, '', self.valid_value * 2, None]
+        res = self.testee.check_data_values(values)
+        self.assertEqual(res[0], (self.valid_value, None))
+        self.assertEqual(
+            [type(err) for _, err in res],
+            [type(self.testee.check_data_value(value)[1])
+             for value in values])
         
         
     def test_can_override_returns_false_if_different_datahandler_base_type(self):
@@ -43,3 +43,13 @@ class VarcharTestCase(unittest.TestCase):
 
         self.assertFalse(test_varchar1.can_override(test_integer))
         self.assertTrue(test_varchar1.can_override(test_varchar2))
+
+    def test_check_data_values(self):
+        """ Testing that column checks give the check_data_value() results """
+        values = ["c" * 10, "c" * 11, 42, None]
+        res = test_varchar.check_data_values(values)
+        self.assertEqual(res[0], ("c" * 10, None))
+        self.assertEqual(
+            [type(err) for _, err in res],
+            [type(test_varchar.check_data_value(value)[1])
+             for value in values])
@@ -27,7 +27,8 @@ from unittest.mock import patch
 import tests.loader_utils
 from tests.leapi.query.utils import dyncode_module as dyncode
 from lodel.leapi.query import LeDeleteQuery, LeUpdateQuery, LeGetQuery, \
-    LeInsertQuery
+    LeInsertQuery, LeCountQuery, LeQuery, LeQueryProfile, LeAggregateQuery
+from lodel.plugin.hooks import LodelHook
 from lodel.leapi.exceptions import *
 
 class LeQueryDatasourceTestCase(unittest.TestCase):
@@ -157,6 +158,43 @@ class LeQueryDatasourceTestCase(unittest.TestCase):
         self.check_nocall(read = False, exclude = ['insert'])
         self.check_nocall(read = True)
 
+    def test_insert_multi(self):
+        """ Testing LeInsertQuery multiple insert mocking datasource """
+        cls = self.dyncode['Person']
+        query = LeInsertQuery(
+            target_class = cls)
+        self.mockwrite.reserve_ids.return_value = [10, 11]
+        self.mockwrite.insert_multi.return_value = [10, 11]
+        datas_list = [
+            {'firstname': 'foo', 'lastname': 'bar', 'alias': None},
+            {'firstname': 'bar', 'lastname': 'foo', 'alias': None}]
+        res = query.execute_multi(datas_list)
+        self.assertEqual(res, [10, 11])
+        self.mockwrite.reserve_ids.assert_called_once_with(cls, 2)
+        self.assertEqual(self.mockwrite.insert_multi.call_count, 1)
+        cargs, _ = self.mockwrite.insert_multi.call_args
+        self.assertEqual(cargs[0], cls)
+        self.assertEqual(
+            [(d['lodel_id'], d['firstname'], d['fullname']) for d in cargs[1]],
+            [(10, 'foo', 'foo bar'), (11, 'bar', 'bar foo')])
+        self.check_nocall(read = False)
+        # references consistency checks are done using the read datasource
+        self.check_nocall(read = True, exclude = ['select'])
+
+    def test_insert_multi_bad_datas(self):
+        """ Testing that LeInsertQuery multiple insert fails without inserting
+            anything if a record is invalid """
+        cls = self.dyncode['Person']
+        query = LeInsertQuery(
+            target_class = cls)
+        datas_list = [
+            {'firstname': 'foo', 'lastname': 'bar', 'alias': None},
+            {'firstname': 'bar', 'lodel_id': 42}]
+        with self.assertRaises(LeApiDataCheckErrors):
+            query.execute_multi(datas_list)
+        self.assertFalse(self.mockwrite.reserve_ids.called)
+        self.assertFalse(self.mockwrite.insert_multi.called)
+
     def test_update_instance(self):
         """ Testing LeUpdateQuery with an instance mocking datasource """
         cls = self.dyncode['Person']
@@ -209,3 +247,242 @@ class LeQueryDatasourceTestCase(unittest.TestCase):
             [('lodel_id', '=', '1')],
             [],
             expt_datas)
+
+    def test_update_filter_set_based(self):
+        """ Testing that LeUpdateQuery with filters runs a single set based
+            update when no field needs per record treatment """
+        cls = self.dyncode['Person']
+        query = LeUpdateQuery(cls, [('lodel_id', '>', 1)])
+        self.mockwrite.update_many.return_value = 3
+        self.assertEqual(query.execute({'alias': None}), 3)
+        self.assertEqual(self.mockwrite.update_many.call_count, 1)
+        cargs, _ = self.mockwrite.update_many.call_args
+        self.assertEqual(cargs[:3], (cls, [('lodel_id', '>', 1)], []))
+        self.assertEqual(set(cargs[3].keys()), {'alias', 'date_update'})
+        self.assertIsNone(cargs[3]['alias'])
+        self.check_nocall(read = True)
+        self.check_nocall(read = False)
+
+    def test_update_filter_constructed(self):
+        """ Testing that LeUpdateQuery with filters updates constructed
+            fields record by record """
+        cls = self.dyncode['Person']
+        self.mockread.select.return_value = [{
+            'lodel_id': 1,
+            'firstname': 'barfoo',
+            'lastname': 'foobar',
+            'fullname': 'barfoo foobar',
+            'alias': None,
+            'linked_texts': None,
+            'help_text': None,
+            'classname': 'Person',
+            'date_create': None,
+            'date_update': None}]
+        query = LeUpdateQuery(cls, [('lodel_id', '=', 1)])
+        query.execute({'firstname': 'foo'})
+        cargs, _ = self.mockwrite.update_many.call_args
+        self.assertEqual(set(cargs[3].keys()), {'firstname', 'date_update'})
+        # back referenced fields are always given to the datasource
+        self.mockwrite.update.assert_called_once_with(
+            cls, [('lodel_id', '=', 1)], [],
+            {'fullname': 'foo foobar', 'linked_texts': None})
+
+    def test_count(self):
+        """ Testing LeCountQuery mocking datasource """
+        cls = self.dyncode['Person']
+        self.mockread.count.return_value = 3
+        query = LeCountQuery(cls, [('lodel_id', '>', 1)])
+        self.assertEqual(query.execute(), 3)
+        self.mockread.count.assert_called_once_with(
+            target = cls,
+            filters = [('lodel_id', '>', 1)],
+            relational_filters = [],
+            limit = None)
+        self.check_nocall(read = True)
+        self.check_nocall(read = False)
+
+    def test_count_limit(self):
+        """ Testing LeCountQuery limit argument """
+        cls = self.dyncode['Person']
+        query = LeCountQuery(cls, [], limit = 1)
+        query.execute()
+        self.mockread.count.assert_called_once_with(
+            target = cls, filters = [], relational_filters = [], limit = 1)
+        for badlimit in (0, -1, 'foo'):
+            with self.assertRaises(ValueError):
+                LeCountQuery(cls, [], limit = badlimit)
+
+    def test_aggregate(self):
+        """ Testing LeAggregateQuery mocking datasource """
+        cls = self.dyncode['Person']
+        self.mockread.aggregate.return_value = [{'alias': 1, 'n': 2}]
+        query = LeAggregateQuery(
+            cls, [('lodel_id', '>', 1)], group_by = ['alias'],
+            metrics = {'n': 'count', 'last': ('max', 'date_update')},
+            order = ['alias', ('n', 'desc')], limit = 10)
+        self.assertEqual(query.execute(), [{'alias': 1, 'n': 2}])
+        self.mockread.aggregate.assert_called_once_with(
+            target = cls,
+            filters = [('lodel_id', '>', 1)],
+            relational_filters = [],
+            group_by = ['alias'],
+            metrics = {'last': ('max', 'date_update'), 'n': ('count', None)},
+            order = [('alias', 'ASC'), ('n', 'DESC')],
+            limit = 10,
+            offset = 0)
+        self.check_nocall(read = True)
+        self.check_nocall(read = False)
+
+    def test_aggregate_errors(self):
+        """ Testing LeAggregateQuery arguments checks """
+        cls = self.dyncode['Person']
+        bad_aggregations = (
+            (['foobar'], None),
+            (['alias'], {'alias': 'count'}),
+            (None, {'n': ('foo', 'alias')}),
+            (None, {'n': ('sum', 'foobar')}),
+            (None, {'n': ('sum', None)}),
+            (None, {'n': 'foobar'}))
+        for group_by, metrics in bad_aggregations:
+            with self.assertRaises(LeApiQueryErrors):
+                LeAggregateQuery(
+                    cls, [], group_by = group_by, metrics = metrics)
+        with self.assertRaises(ValueError):
+            LeAggregateQuery(
+                cls, [], group_by = ['alias'], order = ['lastname'])
+        with self.assertRaises(ValueError):
+            LeAggregateQuery(cls, [], limit = 0)
+
+    def test_get_iter(self):
+        """ Testing LeGetQuery.execute_iter mocking datasource """
+        cls = self.dyncode['Person']
+        fake_db_datas = iter([{'lodel_id': 1}, {'lodel_id': 2}])
+        self.mockread.select_iter.return_value = fake_db_datas
+        query = LeGetQuery(cls, [('lodel_id', '>', 0)],
+            field_list = ['lodel_id'])
+        res = query.execute_iter(batch_size = 10)
+        self.assertEqual(list(res), [{'lodel_id': 1}, {'lodel_id': 2}])
+        self.mockread.select_iter.assert_called_once_with(
+            target = cls,
+            field_list = ['lodel_id'],
+            filters = [('lodel_id', '>', 0)],
+            relational_filters = [],
+            order = None,
+            group = None,
+            limit = None,
+            offset = 0,
+            after = None,
+            batch_size = 10)
+        self.check_nocall(read = True)
+        self.check_nocall(read = False)
+        for bad_bsize in (0, -1, 'foo'):
+            with self.assertRaises(ValueError):
+                query.execute_iter(batch_size = bad_bsize)
+
+    def test_get_after(self):
+        """ Testing LeGetQuery keyset pagination mocking datasource """
+        cls = self.dyncode['Person']
+        self.mockread.select.return_value = []
+        query = LeGetQuery(cls, [], field_list = ['lodel_id'],
+            order = ['lastname', ('firstname', 'desc')], limit = 10,
+            after = ('foo', 'bar', '42'))
+        query.execute()
+        self.mockread.select.assert_called_once_with(
+            target = cls,
+            field_list = ['lodel_id'],
+            filters = [],
+            relational_filters = [],
+            order = [
+                ('lastname', 'ASC'), ('firstname', 'DESC'),
+                ('lodel_id', 'ASC')],
+            group = None,
+            limit = 10,
+            offset = 0,
+            after = ('foo', 'bar', 42))
+
+    def test_get_after_token(self):
+        """ Testing LeGetQuery continuation tokens """
+        cls = self.dyncode['Person']
+        order = LeGetQuery.keyset_order(cls, ['lastname'])
+        token = LeGetQuery.continuation_token(
+            order, {'lastname': 'foo', 'lodel_id': 42, 'firstname': 'bar'})
+        query = LeGetQuery(cls, [], order = ['lastname'], after = token)
+        self.assertEqual(query.dump_infos()['after'], ('foo', 42))
+        with self.assertRaises(ValueError):
+            # token forged for another order
+            LeGetQuery(cls, [], order = ['firstname'], after = token)
+        for bad_after in ('foobar', (1, 2, 3)):
+            with self.assertRaises(ValueError):
+                LeGetQuery(cls, [], order = ['lastname'], after = bad_after)
+        with self.assertRaises(ValueError):
+            LeGetQuery(cls, [], offset = 10, after = (42,))
+
+    def test_profile_disabled(self):
+        """ Testing that queries are not profiled by default """
+        self.mockread.select.return_value = []
+        query = LeGetQuery(self.dyncode['Person'], [])
+        query.execute()
+        self.assertIsNone(query.last_profile)
+        self.assertIsNone(query.explain()['profile'])
+
+    def test_profile_get(self):
+        """ Testing get query profile """
+        def select(**kwargs):
+            LeQueryProfile.annotate(filter = {'lodel_id': 42})
+            return [{'lodel_id': 42}]
+        self.mockread.select.side_effect = select
+        LeQuery.set_profiling(True)
+        try:
+            query = LeGetQuery(
+                self.dyncode['Person'], [('lodel_id', '=', 42)])
+            with patch.object(
+                    LodelHook, 'call_hook',
+                    side_effect = lambda name, caller, payload: payload) \
+                    as mock_hook:
+                query.execute()
+        finally:
+            LeQuery.set_profiling(False)
+            self.mockread.select.side_effect = None
+        profile = query.last_profile
+        self.assertEqual(profile.rows, 1)
+        self.assertEqual(profile.datasource, [{'filter': {'lodel_id': 42}}])
+        self.assertEqual(
+            set(profile.stages.keys()),
+            {'subqueries', 'pre_hooks', 'datasource', 'post_hooks'})
+        self.assertGreaterEqual(profile.total, sum(profile.stages.values()))
+        mock_hook.assert_called_with(
+            LeQuery.profile_hook_name, query, profile)
+        explain = query.explain()
+        self.assertEqual(explain['query'], query.dump_infos())
+        self.assertEqual(explain['profile']['rows'], 1)
+
+    def test_profile_update(self):
+        """ Testing that update profiles count data checks and updated
+            records """
+        self.mockwrite.update_many.return_value = 3
+        LeQuery.set_profiling(True)
+        try:
+            query = LeUpdateQuery(
+                self.dyncode['Person'], [('lastname', '=', 'foo')])
+            query.execute({'alias': None})
+        finally:
+            LeQuery.set_profiling(False)
+        profile = query.last_profile
+        self.assertEqual(profile.rows, 3)
+        self.assertIn('check', profile.stages)
+        self.assertIn('prepare', profile.stages)
+
+    def test_profile_error(self):
+        """ Testing that failing queries profiles are ended """
+        self.mockread.select.side_effect = RuntimeError()
+        LeQuery.set_profiling(True)
+        try:
+            query = LeGetQuery(self.dyncode['Person'], [])
+            with self.assertRaises(RuntimeError):
+                query.execute()
+        finally:
+            LeQuery.set_profiling(False)
+            self.mockread.select.side_effect = None
+        self.assertIsNotNone(query.last_profile.total)
+        self.assertIsNone(query.last_profile.rows)
+        self.assertIsNone(query._profile)
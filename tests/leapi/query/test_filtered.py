@@ -18,13 +18,17 @@
 #
 
 
+import threading
 import unittest
+from unittest import mock
+from unittest.mock import patch
 
 import tests.loader_utils
 from tests.leapi.query.utils import dyncode_module as dyncode
 
 from lodel.leapi.exceptions import *
-from lodel.leapi.query import LeDeleteQuery, LeUpdateQuery, LeGetQuery
+from lodel.leapi.query import LeDeleteQuery, LeUpdateQuery, LeGetQuery, \
+    LeFilteredQuery, LeQueryFilter, LeQueryParam, LeCompiledFilters
 
 class LeFilteredQueryTestCase(unittest.TestCase):
 
@@ -125,6 +129,75 @@ class LeFilteredQueryTestCase(unittest.TestCase):
             self.assertEqual(   qinfos['query_filter'],
                                 e_qfilter)
 
+    def test_filters_dedup(self):
+        """ Testing duplicated filters removal """
+        get_q = LeGetQuery(dyncode.Publication,
+            ['lodel_id = 42', 'lodel_id = 42', 'lodel_id > 1'])
+        self.assertEqual(
+            get_q.dump_infos()['query_filter'],
+            ([('lodel_id', '=', 42), ('lodel_id', '>', 1)], []))
+
+    def test_filters_cache(self):
+        """ Testing that string filters are parsed once per target
+            class """
+        LeGetQuery(dyncode.Publication, 'lodel_id = 1337')
+        with patch.object(
+            LeFilteredQuery, 'split_filter',
+            wraps = LeFilteredQuery.split_filter) as mock_split:
+            for q_class in self.q_classes:
+                get_q = q_class(dyncode.Publication, 'lodel_id = 1337')
+                self.assertEqual(
+                    get_q.dump_infos()['query_filter'],
+                    ([('lodel_id', '=', 1337)], []))
+            self.assertFalse(mock_split.called)
+            LeGetQuery(dyncode.Collection, 'lodel_id = 1337')
+            mock_split.assert_called_once_with('lodel_id = 1337')
+
+    def test_filters_cache_size(self):
+        """ Testing that the filters cache is bounded """
+        with patch.object(LeFilteredQuery, '_filters_cache_size', 2):
+            for i in range(5):
+                LeGetQuery(dyncode.Publication, 'lodel_id = %d' % i)
+            self.assertLessEqual(len(LeFilteredQuery._filters_cache), 2)
+            self.assertIn(
+                (dyncode.Publication, 'lodel_id = 4'),
+                LeFilteredQuery._filters_cache)
+
+    def test_filter_objects(self):
+        """ Testing structured filters """
+        get_q = LeGetQuery(dyncode.Publication,
+            [LeQueryFilter('lodel_id', '>=', 42)])
+        self.assertEqual(
+            get_q.dump_infos()['query_filter'],
+            ([('lodel_id', '>=', 42)], []))
+
+    def test_compiled_filters(self):
+        """ Testing compiled filters with bound parameters """
+        compiled = LeCompiledFilters(dyncode.Publication, [
+            LeQueryFilter('lodel_id', '=', LeQueryParam('uid')),
+            'lodel_id > 1'])
+        self.assertEqual(compiled.params, {'uid'})
+        for uid in (42, '43'):
+            for q_class in self.q_classes:
+                get_q = q_class(dyncode.Publication, compiled.bind(uid = uid))
+                self.assertEqual(
+                    get_q.dump_infos()['query_filter'],
+                    ([('lodel_id', '=', int(uid)), ('lodel_id', '>', 1)], []))
+
+    def test_compiled_filters_errors(self):
+        """ Testing compiled filters misuses """
+        compiled = LeQueryFilter(
+            'lodel_id', '=', LeQueryParam('uid')).compile(dyncode.Publication)
+        with self.assertRaises(LeApiQueryError):
+            compiled.bind()
+        with self.assertRaises(LeApiQueryError):
+            # unbound parameter
+            LeGetQuery(dyncode.Publication, compiled)
+        with self.assertRaises(LeApiQueryError):
+            # compiled for another class
+            LeGetQuery(dyncode.Collection, compiled.bind(uid = 1))
+        with self.assertRaises(LeApiDataCheckErrors):
+            LeCompiledFilters(dyncode.Publication, 'not_exists = 1')
 
 class LeFilteredQueryMultiDataHandlerTestCase(unittest.TestCase):
     """ Testing LeFilteredQuery behavior when relational fields implies
@@ -150,7 +223,7 @@ class LeFilteredQueryMultiDataHandlerTestCase(unittest.TestCase):
         self.assertEqual(
             qinfos['query_filter'],
             ([('title', '=', 'super titre !')],[])) 
-        self.assertEqual(qinfos['field_list'], ['title'])
+        self.assertEqual(qinfos['field_list'], ['lodel_id'])
 
     def test_uid_as_ref_field(self):
         """ Testing basic query optimisation with a relationnal filter 
@@ -192,3 +265,79 @@ class LeFilteredQueryMultiDataHandlerTestCase(unittest.TestCase):
             (   [],
                 [(('linked_persons', {dyncode.Person:'fullname'}),'=', 'John Doe')]))
 
+    @staticmethod
+    def mock_subqueries(query, results):
+        """ Replaces subqueries execute methods by mocks returning given
+            uids """
+        for (_, subq), uids in zip(query.subqueries, results):
+            subq.execute = mock.Mock(
+                return_value = [{'lodel_id': uid} for uid in uids])
+
+    def test_subqueries_filters(self):
+        """ Testing subqueries results intersection in 'in' filters """
+        getq = LeGetQuery(
+            dyncode.Indextheme,
+            ['texts.title = foo', 'texts.subtitle = bar'])
+        self.assertEqual(len(getq.subqueries), 2)
+        self.mock_subqueries(getq, [[1, 2, 3], [3, 2]])
+        self.assertEqual(
+            getq._subqueries_filters(), ([('texts', 'in', [2, 3])], []))
+        self.assertFalse(getq._no_match)
+
+    def test_subqueries_linked_classes(self):
+        """ Testing that the subqueries of a relational filter on several
+            linked classes are unioned """
+        with patch.object(
+                type(dyncode.Indextheme.field('texts')), 'linked_classes',
+                new_callable = mock.PropertyMock,
+                return_value = [dyncode.Section, dyncode.Subsection]):
+            getq = LeGetQuery(
+                dyncode.Indextheme,
+                ['texts.title = linked', 'texts.subtitle = classes'])
+        self.assertEqual(len(getq.subqueries), 4)
+        self.mock_subqueries(getq, [[], [1, 2], [2], [3]])
+        self.assertEqual(
+            getq._subqueries_filters(), ([('texts', 'in', [2])], []))
+        self.assertFalse(getq._no_match)
+        # a relational filter matching nothing on every linked class
+        self.mock_subqueries(getq, [[], [], [2], [3]])
+        getq._subqueries_filters()
+        self.assertTrue(getq._no_match)
+        self.assertFalse(getq.subqueries[2][1].execute.called)
+
+    def test_subqueries_no_match(self):
+        """ Testing that the main query is not executed when a subquery
+            matches nothing """
+        getq = LeGetQuery(
+            dyncode.Indextheme,
+            ['texts.title = foo', 'texts.subtitle = bar'])
+        self.mock_subqueries(getq, [[], [1]])
+        with patch.object(LeGetQuery, '_query') as mock_query:
+            self.assertEqual(getq.execute(), [])
+            self.assertFalse(mock_query.called)
+        # Sequential execution stops at the first empty result
+        self.assertFalse(getq.subqueries[1][1].execute.called)
+        self.assertFalse(getq._no_match)
+        self.assertEqual(list(getq.execute_iter()), [])
+
+    def test_subqueries_workers(self):
+        """ Testing concurrent subqueries execution """
+        getq = LeGetQuery(
+            dyncode.Indextheme,
+            ['texts.title = foo', 'texts.subtitle = bar'])
+        barrier = threading.Barrier(2, timeout = 5)
+        def subq_execute(uids):
+            # Blocks until both subqueries are running
+            barrier.wait()
+            return [{'lodel_id': uid} for uid in uids]
+        for (_, subq), uids in zip(getq.subqueries, [[1, 2], [2]]):
+            subq.execute = lambda uids = uids: subq_execute(uids)
+        LeFilteredQuery.set_subqueries_workers(2)
+        try:
+            self.assertEqual(
+                getq._subqueries_filters(), ([('texts', 'in', [2])], []))
+        finally:
+            LeFilteredQuery.set_subqueries_workers(1)
+        for bad in (0, -1, 'foo', None):
+            with self.assertRaises(ValueError):
+                LeFilteredQuery.set_subqueries_workers(bad)
@@ -0,0 +1,162 @@
+#
+# This file is part of Lodel 2 (https://github.com/OpenEdition)
+#
+# Copyright (C) 2015-2017 Cléo UMS-3287
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+from unittest import mock
+from unittest.mock import patch
+
+import tests.loader_utils
+import leapi_dyncode as dyncode
+
+from lodel.leapi.identity_map import LeIdentityMap
+from lodel.leapi.query import LeDeleteQuery, LeUpdateQuery, LeGetQuery, \
+    LeInsertQuery
+
+
+class LeIdentityMapTestCase(unittest.TestCase):
+    """ Testing the request scoped identity map """
+
+    def setUp(self):
+        self.imap = LeIdentityMap.open()
+
+    def tearDown(self):
+        while LeIdentityMap.current() is not None:
+            LeIdentityMap.close()
+
+    @staticmethod
+    def person_datas(uid):
+        return {'lodel_id': uid, 'firstname': 'foo', 'lastname': 'bar',
+                'classname': 'Person'}
+
+    def test_open_close(self):
+        """ Testing identity maps stack """
+        self.assertIs(LeIdentityMap.current(), self.imap)
+        nested = LeIdentityMap.open()
+        self.assertIs(LeIdentityMap.current(), nested)
+        self.assertIs(LeIdentityMap.close(), nested)
+        self.assertIs(LeIdentityMap.current(), self.imap)
+        self.assertIs(LeIdentityMap.close(), self.imap)
+        self.assertIsNone(LeIdentityMap.current())
+        self.assertIsNone(LeIdentityMap.close())
+
+    def test_lookup_hierarchy(self):
+        """ Testing that instances are found using parent classes """
+        leo = dyncode.Section.__new__(
+            dyncode.Section, lodel_id = 1, classname = 'Section')
+        self.imap.add(leo)
+        self.assertEqual(len(self.imap), 1)
+        for leo_cls in (dyncode.Section, dyncode.Text, dyncode.Object):
+            self.assertIs(self.imap.lookup(leo_cls, 1), leo)
+        self.assertIsNone(self.imap.lookup(dyncode.Person, 1))
+        self.assertIsNone(self.imap.lookup(dyncode.Section, 2))
+
+    def test_get_from_uid(self):
+        """ Testing that get_from_uid queries an object only once """
+        with patch.object(
+                LeGetQuery, 'execute',
+                return_value = [self.person_datas(42)]) as mock_exec:
+            leo = dyncode.Person.get_from_uid(42)
+            self.assertIs(dyncode.Person.get_from_uid(42), leo)
+            # uid values are casted before lookup
+            self.assertIs(dyncode.Person.get_from_uid('42'), leo)
+            self.assertEqual(mock_exec.call_count, 1)
+
+    def test_get_field_list(self):
+        """ Testing that partial objects are not stored """
+        with patch.object(
+                LeGetQuery, 'execute',
+                return_value = [self.person_datas(42)]):
+            dyncode.Person.get(None, field_list = ['firstname'])
+        self.assertEqual(len(self.imap), 0)
+        with patch.object(
+                LeGetQuery, 'execute',
+                return_value = [self.person_datas(42)]):
+            dyncode.Person.get(None)
+        self.assertEqual(len(self.imap), 1)
+
+    def test_no_identity_map(self):
+        """ Testing that nothing is cached without opened identity map """
+        LeIdentityMap.close()
+        with patch.object(
+                LeGetQuery, 'execute',
+                return_value = [self.person_datas(42)]) as mock_exec:
+            dyncode.Person.get_from_uid(42)
+            dyncode.Person.get_from_uid(42)
+            self.assertEqual(mock_exec.call_count, 2)
+
+    def test_write_invalidation(self):
+        """ Testing that write queries clear the identity map """
+        queries = (
+            (LeInsertQuery, (dyncode.Person,), {'lastname': 'foo'}),
+            (LeUpdateQuery, (dyncode.Person, []), {'lastname': 'foo'}),
+            (LeDeleteQuery, (dyncode.Person, []), None))
+        for query_cls, args, data in queries:
+            self.imap.add(dyncode.Person.__new__(
+                dyncode.Person, **self.person_datas(42)))
+            with patch.object(query_cls, '_query', return_value = 1):
+                with patch.object(dyncode.Person, 'check_datas_value'):
+                    with patch.object(dyncode.Person, 'prepare_datas'):
+                        query_cls(*args).execute(data)
+            self.assertEqual(len(self.imap), 0)
+
+    def test_get_referenced(self):
+        """ Testing that multiple references use the identity map """
+        texts = [
+            dyncode.Section.__new__(
+                dyncode.Section, lodel_id = i, classname = 'Section')
+            for i in (1, 2)]
+        for text in texts:
+            self.imap.add(text)
+        fdh = dyncode.Person.data_handler('linked_texts')
+        with patch.object(dyncode.Text, 'get') as mock_get:
+            res = fdh.get_referenced([1, 2])
+            self.assertFalse(mock_get.called)
+        self.assertEqual(sorted(res, key = lambda leo: leo.uid()), texts)
+
+    def test_prefetch(self):
+        """ Testing that prefetch only fetches missing objects """
+        known = dyncode.Section.__new__(
+            dyncode.Section, lodel_id = 1, classname = 'Section')
+        fetched = dyncode.Section.__new__(
+            dyncode.Section, lodel_id = 2, classname = 'Section')
+        self.imap.add(known)
+        person = dyncode.Person.__new__(
+            dyncode.Person, linked_texts = [1, 2], **self.person_datas(3))
+        with patch.object(
+                dyncode.Text, 'get', return_value = [fetched]) as mock_get:
+            dyncode.Person._prefetch_references([person], ['linked_texts'])
+            mock_get.assert_called_once_with([('lodel_id', 'in', [2])])
+        self.assertEqual(person.referenced('linked_texts'), [known, fetched])
+
+    def test_get_from_uid_prefetch(self):
+        """ Testing that get_from_uid prefetches the references of an object
+            found in the identity map """
+        person = dyncode.Person.__new__(
+            dyncode.Person, linked_texts = [1], **self.person_datas(3))
+        text = dyncode.Section.__new__(
+            dyncode.Section, lodel_id = 1, classname = 'Section')
+        self.imap.add(person)
+        with patch.object(
+                dyncode.Text, 'get', return_value = [text]) as mock_get:
+            res = dyncode.Person.get_from_uid(
+                3, prefetch = ['linked_texts'])
+            mock_get.assert_called_once_with([('lodel_id', 'in', [1])])
+        self.assertIs(res, person)
+        self.assertEqual(person.referenced('linked_texts'), [text])
@@ -27,7 +27,7 @@ import leapi_dyncode as dyncode
 
 from lodel.leapi.leobject import LeObject
 from lodel.leapi.query import LeDeleteQuery, LeUpdateQuery, LeGetQuery, \
-    LeInsertQuery
+    LeInsertQuery, LeCountQuery, LeQuery, LeAggregateQuery
 from lodel.leapi.exceptions import *
 
 class LeObjectDummyTestCase(unittest.TestCase):
@@ -108,6 +108,44 @@ but invalid name %s was given" % badname):
         self.assertEqual(set(fnames),
             {'lastname', 'linked_texts', 'firstname', 'alias'})
 
+    def test_metadata_tables(self):
+        """ Testing that metadata accessors return precomputed tables """
+        for leo_cls in dyncode.dynclasses:
+            for include_ro in (True, False):
+                self.assertIs(leo_cls.fieldnames(include_ro),
+                    leo_cls.fieldnames(include_ro))
+                self.assertIsInstance(leo_cls.fieldnames(include_ro), tuple)
+                self.assertIs(leo_cls.fields(include_ro),
+                    leo_cls.fields(include_ro))
+                with self.assertRaises(TypeError):
+                    leo_cls.fields(include_ro)['foo'] = None
+            self.assertEqual(
+                leo_cls.fieldnames(True), tuple(leo_cls._fields.keys()))
+            self.assertEqual(
+                set(leo_cls.fieldnames(False)),
+                {fname for fname, fdh in leo_cls._fields.items()
+                 if not fdh.is_internal()})
+            self.assertIs(leo_cls.hierarch(), leo_cls.hierarch())
+            self.assertIs(leo_cls.child_classes(), leo_cls.child_classes())
+        self.assertEqual(
+            set(dyncode.Person.reference_handlers(False)),
+            {'linked_texts', 'alias'})
+        self.assertEqual(
+            set(dyncode.Person.reference_handlers(True)), {'linked_texts'})
+        self.assertIsInstance(
+            dyncode.Person.data_handler('linked_texts').linked_classes,
+            frozenset)
+
+    def test_hierarch_descendants(self):
+        """ Testing hierarch(), descendants() and uid_source() """
+        self.assertEqual(dyncode.Section.hierarch(),
+            (dyncode.Section, dyncode.Text, dyncode.Entitie, dyncode.Object,
+             dyncode.Abstract_Object))
+        self.assertEqual(dyncode.Text.descendants(),
+            frozenset((dyncode.Section, dyncode.Subsection)))
+        self.assertEqual(dyncode.Subsection.descendants(), frozenset())
+        self.assertEqual(dyncode.Section.uid_source(), dyncode.Object)
+
     def test_bad_insert(self):
         """ Insert with bad arguments """
         badargs = [
@@ -124,6 +162,56 @@ but invalid name %s was given" % badname):
             lodel_id = 1, firstname = "foo", lastname = "bar")
         inst.delete()
 
+    def test_construct_order(self):
+        """ Testing the construction order emitted by lefactory """
+        from lodel.leapi.datahandlers.base_classes import construct_order
+        metadata = dyncode.Person._metadata()
+        self.assertEqual(
+            metadata.construct_order, construct_order(dyncode.Person._fields))
+        order = metadata.construct_order
+        self.assertLess(order.index('lastname'), order.index('fullname'))
+        self.assertEqual(
+            dyncode.Person._update_dependencies(['lastname', 'alias']),
+            (set(), {'fullname'}))
+
+    def test_set_data_downstream(self):
+        """ Testing that only the fields downstream of a modified field are
+            constructed again """
+        datas = {'lodel_id': 1, 'firstname': 'foo', 'lastname': 'bar',
+                 'alias': None, 'linked_texts': None, 'classname': 'Person',
+                 'fullname': 'foo bar', 'help_text': 'help',
+                 'date_create': None, 'date_update': None}
+        obj = dyncode.Person._hydrate(datas)
+        self.assertTrue(obj.initialized)
+        obj.set_data('lastname', 'baz')
+        self.assertEqual(obj.data('fullname'), 'foo baz')
+        self.assertIsNotNone(obj.data('date_update'))
+        self.assertIsNone(obj.data('date_create'))
+        self.assertEqual(obj.data('help_text'), 'help')
+        with self.assertRaises(LeApiErrors):
+            obj.set_data('lastname', 'foo' * 100)
+
+    def test_check_datas_values(self):
+        """ Testing bulk datas check """
+        rows = [
+            {'lastname': 'foo', 'firstname': 'bar'},
+            {'lastname': 'foo' * 100, 'firstname': 'bar'},
+            {'lastname': 'foo', 'firstname': 'bar', 'lodel_id': 1},
+            {'firstname': 'bar'}]
+        checked, errors = dyncode.Person.check_datas_values(
+            rows, complete = True, allow_internal = False)
+        self.assertEqual(
+            checked, [{'lastname': 'foo', 'firstname': 'bar'}, None, None,
+                      None])
+        self.assertEqual(sorted(errors), [1, 2, 3])
+        self.assertEqual(list(errors[1]), ['lastname'])
+        self.assertEqual(list(errors[2]), ['lodel_id'])
+        self.assertEqual(list(errors[3]), ['lastname'])
+        for i in (1, 2, 3):
+            with self.assertRaises(LeApiDataCheckErrors):
+                dyncode.Person.check_datas_value(
+                    rows[i], complete = True, allow_internal = False)
+
 
 class LeObjectQueryMockTestCase(unittest.TestCase):
     """ Testing LeObject mocking LeQuery objects """
@@ -147,6 +235,20 @@ class LeObjectQueryMockTestCase(unittest.TestCase):
             ret = dyncode.Person.insert(datas)
             self.assertEqual(ret, 42, 'Bad return value forwarding')
             mock_insert.assert_called_once_with(datas)
+
+    def test_insert_many(self):
+        """ Checking that LeObject insert_many method calls
+            LeInsertQuery.execute_multi correctly """
+        datas_list = [
+            {'lastname': 'foo', 'firstname': 'bar'},
+            {'lastname': 'bar', 'firstname': 'foo'}]
+        with patch.object(
+            LeInsertQuery, 'execute_multi',
+            return_value = [1, 2]) as mock_insert:
+
+            ret = dyncode.Person.insert_many(datas_list)
+            self.assertEqual(ret, [1, 2], 'Bad return value forwarding')
+            mock_insert.assert_called_once_with(datas_list)
     
     def test_delete(self):
         """ Checking that LeObject delete method calls LeDeleteQuery
@@ -246,6 +348,7 @@ class LeObjectQueryMockTestCase(unittest.TestCase):
 
             mock_init.assert_called_once_with(
                 dyncode.Person,
+                after = None, prefetch = None,
                 **get_args)
 
         ret_val = [{
@@ -280,7 +383,8 @@ class LeObjectQueryMockTestCase(unittest.TestCase):
                 dyncode.Person,
                 query_filters = ['lodel_id = 1'],
                 field_list = None,
-                order = None, group = None, limit = None, offset = 0)
+                order = None, group = None, limit = None, offset = 0,
+                after = None, prefetch = None)
 
         with patch.object(
             LeGetQuery, 'execute', return_value = []) as mock_exec:
@@ -288,3 +392,251 @@ class LeObjectQueryMockTestCase(unittest.TestCase):
             dyncode.Person.get(['lodel_id = 1'])
             mock_exec.assert_called_once_with()
 
+
+    def test_count(self):
+        """ Checking that LeObject.count method calls LeCountQuery
+            correctly """
+        with patch.object(
+            LeCountQuery, '__init__', return_value = None) as mock_init:
+
+            try:
+                dyncode.Person.count(['lodel_id > 1'])
+            except AttributeError:
+                pass
+            mock_init.assert_called_once_with(
+                dyncode.Person, ['lodel_id > 1'])
+
+        with patch.object(
+            LeCountQuery, 'execute', return_value = 42) as mock_exec:
+
+            ret = dyncode.Person.count(['lodel_id > 1'])
+            self.assertEqual(ret, 42, 'Bad return value forwarding')
+            mock_exec.assert_called_once_with()
+
+    def test_aggregate(self):
+        """ Checking that LeObject.aggregate method calls LeAggregateQuery
+            correctly """
+        with patch.object(
+            LeAggregateQuery, '__init__', return_value = None) as mock_init:
+            try:
+                dyncode.Person.aggregate(
+                    None, ['alias'], {'n': 'count'}, limit = 5)
+            except AttributeError:
+                pass
+            mock_init.assert_called_once_with(
+                dyncode.Person, None, group_by = ['alias'],
+                metrics = {'n': 'count'}, order = None, limit = 5,
+                offset = 0)
+        with patch.object(
+            LeAggregateQuery, 'execute', return_value = [{'n': 3}]):
+            self.assertEqual(
+                dyncode.Person.aggregate(None, metrics = {'n': 'count'}),
+                [{'n': 3}])
+
+    def test_exists(self):
+        """ Checking that LeObject.exists method calls LeCountQuery
+            with a limit """
+        with patch.object(
+            LeCountQuery, '__init__', return_value = None) as mock_init:
+
+            try:
+                dyncode.Person.exists(['lodel_id = 1'])
+            except AttributeError:
+                pass
+            mock_init.assert_called_once_with(
+                dyncode.Person, ['lodel_id = 1'], limit = 1)
+
+        for count, expected in ((0, False), (1, True)):
+            with patch.object(
+                LeCountQuery, 'execute', return_value = count):
+                self.assertEqual(
+                    dyncode.Person.exists(['lodel_id = 1']), expected)
+
+    def test_iter_get(self):
+        """ Checking that LeObject.iter_get method calls
+            LeGetQuery.execute_iter and instanciates results lazily """
+        ret_val = [{
+            'lodel_id': 1,
+            'firstname': 'foo',
+            'lastname': 'bar',
+            'classname': 'Person'}]
+        with patch.object(
+            LeGetQuery, 'execute_iter',
+            return_value = iter(ret_val)) as mock_exec:
+
+            results = dyncode.Person.iter_get(['lodel_id = 1'],
+                batch_size = 100)
+            mock_exec.assert_called_once_with(batch_size = 100)
+            self.assertNotIsInstance(results, list)
+            results = list(results)
+            self.assertEqual(len(results), 1)
+            self.assertIsInstance(results[0], dyncode.Person)
+            self.assertEqual(results[0].data('firstname'), 'foo')
+
+    def test_values(self):
+        """ Checking that LeObject.values returns datasource records """
+        ret_val = [{'lodel_id': 1, 'firstname': 'foo'}]
+        with patch.object(
+            LeGetQuery, '__init__', return_value = None) as mock_init:
+            try:
+                dyncode.Person.values(['lodel_id = 1'], ('firstname',))
+            except AttributeError:
+                pass
+            mock_init.assert_called_once_with(
+                dyncode.Person, query_filters = ['lodel_id = 1'],
+                field_list = ['firstname'], order = None, group = None,
+                limit = None, offset = 0, after = None)
+        with patch.object(
+            LeGetQuery, 'execute', return_value = ret_val) as mock_exec:
+            with patch.object(LeObject, '_hydrate') as mock_hydrate:
+                res = dyncode.Person.values(None, ['firstname'])
+                self.assertIs(res, ret_val)
+                self.assertFalse(mock_hydrate.called)
+        with patch.object(
+            LeGetQuery, 'execute_iter',
+            return_value = iter(ret_val)) as mock_exec:
+            res = dyncode.Person.values(
+                None, ['firstname'], iterator = True, batch_size = 10)
+            mock_exec.assert_called_once_with(batch_size = 10)
+            self.assertEqual(list(res), ret_val)
+
+    def test_values_list(self):
+        """ Checking LeObject.values_list tuples """
+        ret_val = [{'lodel_id': 1, 'firstname': 'foo'}, {'lodel_id': 2}]
+        with patch.object(LeGetQuery, 'execute', return_value = ret_val):
+            self.assertEqual(
+                dyncode.Person.values_list(None, ['lodel_id', 'firstname']),
+                [(1, 'foo'), (2, None)])
+            self.assertEqual(
+                dyncode.Person.values_list(None, ['lodel_id'], flat = True),
+                [1, 2])
+        with patch.object(
+            LeGetQuery, 'execute_iter', return_value = iter(ret_val)):
+            res = dyncode.Person.values_list(
+                None, ['lodel_id'], flat = True, iterator = True)
+            self.assertNotIsInstance(res, list)
+            self.assertEqual(list(res), [1, 2])
+        with self.assertRaises(ValueError):
+            dyncode.Person.values_list(
+                None, ['lodel_id', 'firstname'], flat = True)
+
+    def test_get_page(self):
+        """ Checking that LeObject.get_page method calls LeObject.get
+            with keyset pagination and returns a continuation token """
+        objects = [
+            dyncode.Person(lodel_id = i, firstname = 'foo', lastname = 'bar')
+            for i in (1, 2)]
+        with patch.object(
+            LeObject, 'get', return_value = objects) as mock_get:
+
+            res, token = dyncode.Person.get_page(None, 2)
+            mock_get.assert_called_once_with(None, field_list = None,
+                order = None, limit = 2, after = ())
+            self.assertEqual(res, objects)
+            self.assertEqual(
+                LeGetQuery.decode_token([('lodel_id', 'ASC')], token), (2,))
+
+            mock_get.reset_mock()
+            res, token = dyncode.Person.get_page(None, 3, after = token)
+            self.assertEqual(mock_get.call_args[1]['after'],
+                LeGetQuery.continuation_token([('lodel_id', 'ASC')],
+                    objects[-1]))
+            self.assertIsNone(token)
+
+    def test_get_prefetch(self):
+        """ Checking that LeObject.get prefetch referenced objects with one
+            query per linked class """
+        ret_val = [
+            {'lodel_id': 1, 'firstname': 'foo', 'lastname': 'bar',
+                'linked_texts': [1, 2], 'classname': 'Person'},
+            {'lodel_id': 2, 'firstname': 'bar', 'lastname': 'foo',
+                'linked_texts': [2], 'classname': 'Person'},
+            {'lodel_id': 3, 'firstname': 'foo', 'lastname': 'foo',
+                'linked_texts': None, 'classname': 'Person'}]
+        texts = [
+            dyncode.Section.__new__(dyncode.Section, lodel_id = i,
+                classname = 'Section')
+            for i in (1, 2)]
+        with patch.object(LeGetQuery, 'execute', return_value = ret_val):
+            with patch.object(
+                dyncode.Text, 'get', return_value = texts) as mock_get:
+
+                res = dyncode.Person.get(None, prefetch = ['linked_texts'])
+                mock_get.assert_called_once_with(
+                    [('lodel_id', 'in', [1, 2])])
+                self.assertEqual(res[0].referenced('linked_texts'), texts)
+                self.assertEqual(res[1].referenced('linked_texts'), [texts[1]])
+                self.assertIsNone(res[2].referenced('linked_texts'))
+                self.assertEqual(mock_get.call_count, 1)
+
+    def test_get_bad_prefetch(self):
+        """ Checking that prefetch only accepts reference fields """
+        for badfield in ('firstname', 'foobar'):
+            with self.assertRaises(LeApiQueryErrors):
+                LeGetQuery(dyncode.Person, [], prefetch = [badfield])
+
+    def test_get_profile(self):
+        """ Checking that LeObject.get profiles objects hydration """
+        ret_val = [{'lodel_id': 1, 'firstname': 'foo', 'lastname': 'bar',
+                    'classname': 'Person'}]
+        profiles = list()
+        LeQuery.set_profiling(True)
+        try:
+            with patch.object(LeGetQuery, 'execute', return_value = ret_val):
+                with patch.object(
+                        LeGetQuery, '_profile_end', autospec = True,
+                        side_effect = lambda query: profiles.append(
+                            query._profile)):
+                    dyncode.Person.get(None)
+        finally:
+            LeQuery.set_profiling(False)
+        self.assertEqual(len(profiles), 1)
+        self.assertIn('hydration', profiles[0].stages)
+
+    def test_hydrate(self):
+        """ Checking the fast instanciation from datasource records """
+        datas = {'lodel_id': 1, 'firstname': 'foo', 'lastname': 'bar',
+                 'alias': None, 'classname': 'Person'}
+        obj = dyncode.Person._hydrate(datas)
+        self.assertFalse(hasattr(obj, '__dict__'))
+        self.assertEqual(obj.data('firstname'), 'foo')
+        self.assertEqual(obj.d.lastname, 'bar')
+        self.assertEqual(
+            obj.initialized,
+            dyncode.Person.__new__(dyncode.Person, **datas).initialized)
+        # records are not modified nor shared
+        obj.set_data('firstname', 'bar')
+        self.assertEqual(datas['firstname'], 'foo')
+        # partial records
+        obj = dyncode.Person._hydrate({'lodel_id': 1})
+        self.assertFalse(obj.initialized)
+        with self.assertRaises(RuntimeError):
+            obj.data('firstname')
+
+    def test_values_accessor(self):
+        """ Checking that the d accessor is kept until a set_data() call """
+        obj = dyncode.Person._hydrate(
+            {'lodel_id': 1, 'firstname': 'foo', 'lastname': 'bar'})
+        values = obj.d
+        self.assertIs(obj.d, values)
+        obj.set_data('firstname', 'bar')
+        self.assertIsNot(obj.d, values)
+        self.assertEqual(obj.d.firstname, 'bar')
+        # no ad-hoc attributes on instances
+        with self.assertRaises(AttributeError):
+            obj.foo = 'bar'
+
+    def test_hydrate_initialized(self):
+        """ Checking the initialized state of complete records """
+        datas = {fname: None for fname in dyncode.Person.fieldnames(True)}
+        datas['lodel_id'] = 1
+        self.assertTrue(dyncode.Person._hydrate(datas).initialized)
+        del(datas['lastname'])
+        self.assertFalse(dyncode.Person._hydrate(datas).initialized)
+
+    def test_name2class_table(self):
+        """ Checking name2class with the dynamic code classes table """
+        self.assertIs(dyncode.Person._dynclasses, dyncode.dynclasses_dict)
+        self.assertIs(dyncode.Object.name2class('Section'), dyncode.Section)
+        with self.assertRaises(LeApiError):
+            dyncode.Object.name2class('Foobar')
@@ -0,0 +1,189 @@
+#
+# This file is part of Lodel 2 (https://github.com/OpenEdition)
+#
+# Copyright (C) 2015-2017 Cléo UMS-3287
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+from unittest import mock
+from unittest.mock import patch
+
+import tests.loader_utils
+import leapi_dyncode as dyncode
+
+from lodel.leapi.session import LeSession
+from lodel.leapi.query import LeDeleteQuery, LeInsertQuery, LeUpdateQuery
+from lodel.leapi.identity_map import LeIdentityMap
+from lodel.leapi.exceptions import LeApiDataCheckErrors
+from lodel.plugin.hooks import LodelHook
+
+
+class LeSessionTestCase(unittest.TestCase):
+    """ Testing the batched write session """
+
+    def setUp(self):
+        self.mockread = mock.MagicMock()
+        self.mockwrite = mock.MagicMock()
+        self.mockwrite.new_numeric_id.return_value = 42
+        self.mockwrite.bulk_write.side_effect = lambda ops: [
+            op[0] for op in ops]
+        self.patches = list()
+        for dyncls in dyncode.dynclasses:
+            for attr, mockds in (('_ro_datasource', self.mockread),
+                                 ('_rw_datasource', self.mockwrite)):
+                dspatch = patch.object(dyncls, attr, mockds)
+                dspatch.start()
+                self.patches.append(dspatch)
+
+    def tearDown(self):
+        for dspatch in self.patches:
+            dspatch.stop()
+
+    def test_current(self):
+        """ Testing sessions stack """
+        self.assertIsNone(LeSession.current())
+        with LeSession() as session:
+            self.assertIs(LeSession.current(), session)
+            with LeSession() as nested:
+                self.assertIs(LeSession.current(), nested)
+            self.assertIs(LeSession.current(), session)
+        self.assertIsNone(LeSession.current())
+
+    def test_flush(self):
+        """ Testing that queued queries are written in one bulk write """
+        section = dyncode.Section.__new__(
+            dyncode.Section, lodel_id = 2, classname = 'Section')
+        with LeSession() as session:
+            uid = dyncode.Person.insert(
+                {'firstname': 'foo', 'lastname': 'bar'})
+            self.assertEqual(uid, 42)
+            self.assertIsNone(section.update({'subtitle': 'foo'}))
+            self.assertIsNone(dyncode.Person.delete_bundle(['lodel_id = 1']))
+            self.assertEqual(len(session), 3)
+            self.assertFalse(self.mockwrite.bulk_write.called)
+        self.assertEqual(len(session), 0)
+        self.mockwrite.bulk_write.assert_called_once()
+        ops = self.mockwrite.bulk_write.call_args[0][0]
+        self.assertEqual([op[:2] for op in ops], [
+            ('insert', dyncode.Person),
+            ('update_many', dyncode.Section),
+            ('delete', dyncode.Person)])
+        self.assertEqual(ops[0][2]['lodel_id'], 42)
+        self.assertEqual(ops[1][2:4], ([('lodel_id', '=', 2)], []))
+        self.assertEqual(ops[1][4]['subtitle'], 'foo')
+        self.assertEqual(ops[2][2:], ([('lodel_id', '=', 1)], []))
+
+    def test_flush_hooks(self):
+        """ Testing batched hooks and flush() results """
+        session = LeSession()
+        session.add(LeDeleteQuery(dyncode.Person, ['lodel_id = 1']))
+        session.add(LeDeleteQuery(dyncode.Person, ['lodel_id = 2']))
+        session.add(LeInsertQuery(dyncode.Person),
+                    {'firstname': 'foo', 'lastname': 'bar'})
+        imap = LeIdentityMap.open()
+        try:
+            imap.add(dyncode.Person.__new__(
+                dyncode.Person, lodel_id = 1, classname = 'Person'))
+            with patch.object(
+                    LodelHook, 'call_hook',
+                    side_effect = lambda name, caller, payload: payload) \
+                    as mock_hook:
+                res = session.flush()
+            self.assertEqual(len(imap), 0)
+        finally:
+            LeIdentityMap.close()
+        self.assertEqual(res, ['delete', 'delete', 'insert'])
+        self.assertEqual(
+            [hook_call[0][:2] for hook_call in mock_hook.call_args_list],
+            [('leapi_delete_multi_pre', dyncode.Person),
+             ('leapi_insert_multi_pre', dyncode.Person),
+             ('leapi_delete_multi_post', dyncode.Person),
+             ('leapi_insert_multi_post', dyncode.Person)])
+        self.assertEqual(
+            mock_hook.call_args_list[2][0][2], ['delete', 'delete'])
+        self.assertEqual(session.flush(), [])
+
+    def test_discard(self):
+        """ Testing that queued queries are discarded on error """
+        with self.assertRaises(RuntimeError):
+            with LeSession() as session:
+                dyncode.Person.delete_bundle(['lodel_id = 1'])
+                raise RuntimeError()
+        self.assertEqual(len(session), 0)
+        self.assertIsNone(LeSession.current())
+        self.assertFalse(self.mockwrite.bulk_write.called)
+
+    def test_data_check(self):
+        """ Testing that data are checked when queries are queued """
+        with LeSession() as session:
+            with self.assertRaises(LeApiDataCheckErrors):
+                dyncode.Person.insert({})
+            self.assertEqual(len(session), 0)
+
+    def test_update_checked_once(self):
+        """ Testing that the data of a queued update are checked once """
+        with patch.object(
+                dyncode.Person, 'check_datas_value',
+                wraps = dyncode.Person.check_datas_value) as mock_check:
+            with LeSession() as session:
+                session.add(
+                    LeUpdateQuery(dyncode.Person, ['lodel_id > 1']),
+                    {'alias': None})
+        self.assertEqual(mock_check.call_count, 1)
+        ops = self.mockwrite.bulk_write.call_args[0][0]
+        self.assertEqual(ops[0][0], 'update_many')
+        self.assertIsNone(ops[0][4]['alias'])
+
+    def test_reads(self):
+        """ Testing that operations are written before a query reading
+            records """
+        section = dyncode.Section.__new__(
+            dyncode.Section, lodel_id = 2, classname = 'Section')
+        with patch.object(
+                LeUpdateQuery, '_bulk_reads', return_value = True):
+            with LeSession():
+                dyncode.Person.delete_bundle(['lodel_id = 1'])
+                section.update({'subtitle': 'foo'})
+        self.assertEqual(
+            [[op[0] for op in bulk_call[0][0]]
+             for bulk_call in self.mockwrite.bulk_write.call_args_list],
+            [['delete'], ['update_many']])
+
+    def test_subqueries(self):
+        """ Testing queued queries with relational filters on another
+            datasource """
+        self.mockread.select.return_value = [{'lodel_id': 3}]
+        with LeSession() as session:
+            session.add(
+                LeDeleteQuery(dyncode.Indextheme, ['texts.title = foo']))
+            session.add(LeUpdateQuery(
+                dyncode.Indextheme, ['texts.title = foo']), {'name': 'bar'})
+        # Subqueries read records : the delete is written before the
+        # update subquery
+        delete_call, update_call = self.mockwrite.bulk_write.call_args_list
+        self.assertEqual(delete_call[0][0], [('delete', dyncode.Indextheme,
+            [('texts', 'in', [3])], [])])
+        self.assertEqual(update_call[0][0][0][:4], ('update_many',
+            dyncode.Indextheme, [('texts', 'in', [3])], []))
+        # The subqueries match nothing
+        self.mockread.select.return_value = []
+        self.mockwrite.bulk_write.reset_mock()
+        with LeSession() as session:
+            dyncode.Indextheme.delete_bundle(['texts.title = foo'])
+        self.mockwrite.bulk_write.assert_not_called()
+        session.add(LeDeleteQuery(dyncode.Indextheme, ['texts.title = foo']))
+        self.assertEqual(session.flush(), [0])
@@ -0,0 +1,146 @@
+#
+# This file is part of Lodel 2 (https://github.com/OpenEdition)
+#
+# Copyright (C) 2015-2017 Cléo UMS-3287
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+from unittest import mock
+from unittest.mock import patch
+
+import tests.loader_utils
+import leapi_dyncode as dyncode
+
+from lodel.plugin.datasource_cache import DatasourceCache, \
+    CachedDatasource, datasource_cache_invalidation_hook
+
+
+class DatasourceCacheTestCase(unittest.TestCase):
+    """ Testing the datasource cache storage """
+
+    def test_get_set(self):
+        """ Testing that cached records are copies """
+        cache = DatasourceCache(10)
+        records = [{'lodel_id': 1, 'linked_texts': [1, 2]}]
+        self.assertIsNone(cache.get('foo'))
+        self.assertTrue(cache.set('foo', [dyncode.Person], records))
+        records[0]['linked_texts'].append(3)
+        res = cache.get('foo')
+        self.assertEqual(res, [{'lodel_id': 1, 'linked_texts': [1, 2]}])
+        res[0]['lodel_id'] = 2
+        self.assertEqual(cache.get('foo')[0]['lodel_id'], 1)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_max_result(self):
+        """ Testing that big results are not cached """
+        cache = DatasourceCache(100, max_result = 2)
+        self.assertFalse(cache.set('foo', [dyncode.Person], [{}, {}, {}]))
+        self.assertIsNone(cache.get('foo'))
+
+    def test_lru(self):
+        """ Testing records count bound and LRU eviction """
+        cache = DatasourceCache(3)
+        cache.set('a', [dyncode.Person], [{}, {}])
+        cache.set('b', [dyncode.Person], [])
+        cache.get('a')
+        cache.set('c', [dyncode.Person], [{}])
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl(self):
+        """ Testing entries expiration """
+        cache = DatasourceCache(10, ttl = 60)
+        with patch('time.monotonic', return_value = 1000):
+            cache.set('foo', [dyncode.Person], [{}])
+        with patch('time.monotonic', return_value = 1059):
+            self.assertIsNotNone(cache.get('foo'))
+        with patch('time.monotonic', return_value = 1061):
+            self.assertIsNone(cache.get('foo'))
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate(self):
+        """ Testing invalidation of parents and childs classes entries """
+        cache = DatasourceCache(10)
+        cache.set('section', [dyncode.Section], [])
+        cache.set('text', [dyncode.Text], [])
+        cache.set('person', [dyncode.Person], [])
+        cache.set('rel', [dyncode.Person, dyncode.Text], [])
+        self.assertEqual(cache.invalidate(dyncode.Section), 3)
+        self.assertIsNotNone(cache.get('person'))
+        cache.set('section', [dyncode.Section], [])
+        self.assertEqual(cache.invalidate(dyncode.Text), 1)
+        self.assertEqual(cache.invalidate(dyncode.Object), 1)
+        self.assertEqual(len(cache), 0)
+
+
+class CachedDatasourceTestCase(unittest.TestCase):
+    """ Testing the datasource wrapper """
+
+    def setUp(self):
+        self.datasource = mock.MagicMock()
+        self.datasource.select.return_value = [{'lodel_id': 1}]
+        self.cache = DatasourceCache(10)
+        self.cached = CachedDatasource(self.datasource, self.cache)
+
+    def test_select(self):
+        """ Testing that a select hits the datasource once """
+        for _ in range(3):
+            res = self.cached.select(
+                dyncode.Person, ['lodel_id'], [('lodel_id', '=', 1)], [])
+            self.assertEqual(res, [{'lodel_id': 1}])
+        self.assertEqual(self.datasource.select.call_count, 1)
+        self.cached.select(
+            dyncode.Person, ['lodel_id'], [('lodel_id', '=', 2)], [])
+        self.assertEqual(self.datasource.select.call_count, 2)
+
+    def test_select_kwargs(self):
+        """ Testing select with the keyword arguments used by LeGetQuery """
+        self.cached.select(
+            target = dyncode.Person, field_list = None, filters = [],
+            relational_filters = [], order = None, group = None,
+            limit = None, offset = 0, after = None)
+        self.datasource.select.assert_called_once_with(
+            dyncode.Person, None, [], [], order = None, group = None,
+            limit = None, offset = 0, after = None)
+
+    def test_forward(self):
+        """ Testing that other methods are forwarded """
+        self.cached.count(dyncode.Person, [], [])
+        self.datasource.count.assert_called_once_with(
+            dyncode.Person, [], [], limit = None)
+        self.cached.database
+        self.cached.insert(dyncode.Person, {'lodel_id': 1})
+        self.datasource.insert.assert_called_once_with(
+            dyncode.Person, {'lodel_id': 1})
+        self.cached.bulk_write([])
+        self.datasource.bulk_write.assert_called_once_with([])
+
+    def test_hook_invalidation(self):
+        """ Testing invalidation by write queries hooks """
+        rel_filters = [(('linked_texts', {dyncode.Text: 'title'}), '=', 'a')]
+        self.cached.select(dyncode.Person, ['lodel_id'], [], rel_filters)
+        self.cached.select(dyncode.Collection, ['lodel_id'], [], [])
+        ret = datasource_cache_invalidation_hook(
+            'leapi_update_post', dyncode.Section, 42)
+        self.assertEqual(ret, 42)
+        # The Person select depends on Text through its relational filter
+        self.assertEqual(len(self.cache), 1)
+        # Publication.collection has a back reference in Collection
+        datasource_cache_invalidation_hook(
+            'leapi_insert_post', dyncode.Publication, 42)
+        self.assertEqual(len(self.cache), 0)
@@ -0,0 +1,131 @@
+#
+# This file is part of Lodel 2 (https://github.com/OpenEdition)
+#
+# Copyright (C) 2015-2017 Cléo UMS-3287
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+from collections import OrderedDict
+
+import tests.loader_utils
+import leapi_dyncode as dyncode
+
+from lodel.plugin.datasource_plugin import AbstractDatasource
+
+
+class ListDatasource(AbstractDatasource):
+    """ Datasource returning a list of records, whatever the filters """
+
+    def __init__(self, records):
+        self.records = records
+        self.select_args = None
+
+    def select(self, target, field_list, filters, rel_filters=None,
+               order=None, group=None, limit=None, offset=0, after=None):
+        self.select_args = (target, sorted(field_list), filters, rel_filters)
+        return [{fname: record[fname] for fname in field_list
+                 if fname in record}
+                for record in self.records]
+
+
+class AbstractDatasourceAggregateTestCase(unittest.TestCase):
+    """ Testing the python implementation of AbstractDatasource.aggregate """
+
+    def setUp(self):
+        self.datasource = ListDatasource([
+            {'lodel_id': 1, 'lastname': 'foo', 'alias': [2, 3]},
+            {'lodel_id': 2, 'lastname': 'bar', 'alias': [3]},
+            {'lodel_id': 3, 'lastname': 'foo', 'alias': []},
+            {'lodel_id': 4, 'lastname': None}])
+
+    def aggregate(self, group_by, metrics, **kwargs):
+        return self.datasource.aggregate(
+            dyncode.Person, [('lodel_id', '>', 0)], [], group_by,
+            OrderedDict(sorted(metrics.items())), **kwargs)
+
+    def test_metrics(self):
+        """ Testing groups metrics """
+        res = self.aggregate(
+            ['lastname'],
+            {'n': ('count', None), 'sum': ('sum', 'lodel_id'),
+             'avg': ('avg', 'lodel_id'), 'min': ('min', 'lodel_id'),
+             'max': ('max', 'lodel_id')},
+            order = [('lastname', 'ASC')])
+        self.assertEqual(res, [
+            {'lastname': None, 'n': 1, 'sum': 4, 'avg': 4, 'min': 4,
+             'max': 4},
+            {'lastname': 'bar', 'n': 1, 'sum': 2, 'avg': 2, 'min': 2,
+             'max': 2},
+            {'lastname': 'foo', 'n': 2, 'sum': 4, 'avg': 2, 'min': 1,
+             'max': 3}])
+        self.assertEqual(
+            self.datasource.select_args,
+            (dyncode.Person, ['lastname', 'lodel_id'],
+             [('lodel_id', '>', 0)], []))
+
+    def test_unwind(self):
+        """ Testing groups on a multiple reference """
+        res = self.aggregate(
+            ['alias'], {'n': ('count', None)}, order = [('n', 'DESC')])
+        self.assertEqual(res, [{'alias': 3, 'n': 2}, {'alias': 2, 'n': 1}])
+
+    def test_single_group(self):
+        """ Testing metrics without group fields and limit """
+        self.assertEqual(
+            self.aggregate([], {'n': ('count', None)}), [{'n': 4}])
+        res = self.aggregate(
+            ['lastname'], {}, order = [('lastname', 'DESC')], limit = 1,
+            offset = 1)
+        self.assertEqual(res, [{'lastname': 'bar'}])
+
+
+class AbstractDatasourceBulkWriteTestCase(unittest.TestCase):
+    """ Testing the default AbstractDatasource.bulk_write """
+
+    def test_bulk_write(self):
+        """ Testing that operations are run in order """
+        datasource = ListDatasource([])
+        calls = list()
+        datasource.insert = lambda *args: calls.append(('insert', args)) or 1
+        datasource.delete = lambda *args: calls.append(('delete', args)) or 2
+        res = datasource.bulk_write([
+            ('insert', dyncode.Person, {'lodel_id': 1}),
+            ('delete', dyncode.Person, [('lodel_id', '=', 2)], [])])
+        self.assertEqual(res, [1, 2])
+        self.assertEqual(calls, [
+            ('insert', (dyncode.Person, {'lodel_id': 1})),
+            ('delete', (dyncode.Person, [('lodel_id', '=', 2)], []))])
+        self.assertEqual(datasource.bulk_write([]), [])
+        with self.assertRaises(ValueError):
+            datasource.bulk_write([('select', dyncode.Person, None, [])])
+
+
+class AbstractDatasourceReserveIdsTestCase(unittest.TestCase):
+    """ Testing the default AbstractDatasource.reserve_ids """
+
+    def test_reserve_ids(self):
+        """ Testing that reserved ids are distinct with a datasource
+            computing ids from the greatest stored one """
+        datasource = ListDatasource([])
+        calls = list()
+        # Nothing is stored : the same id is returned on each call
+        datasource.new_numeric_id = lambda emcomp: calls.append(emcomp) or 5
+        self.assertEqual(
+            datasource.reserve_ids(dyncode.Person, 3), [5, 6, 7])
+        self.assertEqual(calls, [dyncode.Person])
+        self.assertEqual(datasource.reserve_ids(dyncode.Person, 0), [])
+        self.assertEqual(len(calls), 1)
@@ -0,0 +1,844 @@
+#
+# This file is part of Lodel 2 (https://github.com/OpenEdition)
+#
+# Copyright (C) 2015-2017 Cléo UMS-3287
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import itertools
+import threading
+import unittest
+from collections import OrderedDict
+from unittest import mock
+from unittest.mock import patch
+
+import tests.loader_utils
+import leapi_dyncode as dyncode
+
+from lodel.leapi.datahandlers.references import Link, Set, Map
+from lodel.leapi.query import LeUpdateQuery
+
+try:
+    import pymongo
+except ImportError:
+    pymongo = None
+
+if pymongo is not None:
+    from bson.son import SON
+    from lodel.plugins.mongodb_datasource import utils as mongo_utils
+    from lodel.plugins.mongodb_datasource.datasource import \
+        MongoDbDatasource, MongoWriteBuffer
+    from lodel.plugins.mongodb_datasource.exceptions import \
+        MongoDbDataSourceError, MongoDbConsistencyError
+
+
+class MockCursor(list):
+    """ pymongo cursor mock """
+
+    batch = None
+
+    def batch_size(self, batch_size):
+        self.batch = batch_size
+        return self
+
+
+class MockDatabase(object):
+    """ pymongo database mock, collections mocks are created on first
+        access """
+
+    def __init__(self):
+        self.collections = dict()
+        self.options = None
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            collection = mock.MagicMock(name = name)
+            collection.name = name
+            collection.find.return_value = []
+            self.collections[name] = collection
+        return self.collections[name]
+
+    def with_options(self, **kwargs):
+        self.options = kwargs
+        return self
+
+
+## @brief Distinct database names : connections are shared by name
+_db_names = ('lodel_test_%d' % i for i in itertools.count())
+
+
+def mongo_datasource(**kwargs):
+    """ Returns a (MongoDbDatasource, MockDatabase) tuple """
+    database = MockDatabase()
+    client = mock.MagicMock()
+    client.__getitem__.return_value = database
+    with patch.object(mongo_utils, 'connect', return_value = client):
+        datasource = MongoDbDatasource(
+            'localhost', None, next(_db_names), 'lodel', 'pass', **kwargs)
+    return datasource, database
+
+
+@unittest.skipIf(pymongo is None, "pymongo is not installed")
+class AbstractSelectTestCase(unittest.TestCase):
+    """ Testing the merge of the child classes cursors of an abstract class
+        select """
+
+    def setUp(self):
+        self.datasource, self.database = mongo_datasource()
+
+    def set_documents(self, sections, subsections):
+        """ Sets the documents returned by the child collections finds """
+        for coll_name, docs in (('Section', sections),
+                                ('Subsection', subsections)):
+            self.database[coll_name].find.return_value = MockCursor(
+                dict(doc) for doc in docs)
+
+    def test_merge(self):
+        """ Testing offset and limit applied on the merged cursors """
+        self.set_documents(
+            [{'lodel_id': 1, 'title': 'a'}, {'lodel_id': 4, 'title': 'c'}],
+            [{'lodel_id': 2, 'title': 'b'}, {'lodel_id': 3, 'title': 'd'}])
+        res = self.datasource.select(
+            dyncode.Text, ['lodel_id', 'title'], [],
+            order = [('title', 'ASC')], limit = 2, offset = 1)
+        self.assertEqual([doc['lodel_id'] for doc in res], [2, 4])
+        for coll_name in ('Section', 'Subsection'):
+            # each child returns at most offset + limit documents
+            self.database[coll_name].find.assert_called_once_with(
+                {'classname': coll_name},
+                projection = {'lodel_id': 1, 'title': 1, '_id': 0},
+                skip = 0, limit = 3, sort = [('title', 1)])
+
+    def test_merge_desc(self):
+        """ Testing DESC and mixed directions orders """
+        self.set_documents(
+            [{'lodel_id': 1, 'title': 'b'}, {'lodel_id': 3, 'title': 'a'}],
+            [{'lodel_id': 2, 'title': 'b'}, {'lodel_id': 4, 'title': 'a'}])
+        res = self.datasource.select(
+            dyncode.Text, ['lodel_id', 'title'], [],
+            order = [('title', 'DESC'), ('lodel_id', 'ASC')])
+        self.assertEqual([doc['lodel_id'] for doc in res], [1, 2, 3, 4])
+        self.set_documents(
+            [{'lodel_id': 3, 'title': 'a'}, {'lodel_id': 1, 'title': 'a'}],
+            [{'lodel_id': 2, 'title': 'a'}, {'lodel_id': 4, 'title': 'b'}])
+        res = self.datasource.select(
+            dyncode.Text, ['lodel_id', 'title'], [],
+            order = [('title', 'ASC'), ('lodel_id', 'DESC')])
+        self.assertEqual([doc['lodel_id'] for doc in res], [3, 2, 1, 4])
+
+    def test_merge_none(self):
+        """ Testing that None values come first in ascending orders """
+        sections = [{'lodel_id': 1, 'title': None},
+                    {'lodel_id': 3, 'title': 'b'}]
+        subsections = [{'lodel_id': 2, 'title': 'a'}, {'lodel_id': 4}]
+        self.set_documents(sections, [subsections[1], subsections[0]])
+        res = self.datasource.select(
+            dyncode.Text, ['lodel_id', 'title'], [],
+            order = [('title', 'ASC')])
+        self.assertEqual([doc['lodel_id'] for doc in res], [1, 4, 2, 3])
+        self.set_documents(sections[::-1], subsections)
+        res = self.datasource.select(
+            dyncode.Text, ['lodel_id', 'title'], [],
+            order = [('title', 'DESC')])
+        self.assertEqual([doc['lodel_id'] for doc in res], [3, 2, 1, 4])
+
+    def test_hidden_order_fields(self):
+        """ Testing that order fields missing in field list are fetched then
+            removed """
+        self.set_documents(
+            [{'lodel_id': 2, 'title': 'b'}],
+            [{'lodel_id': 1, 'title': 'a'}])
+        res = list(self.datasource.select_iter(
+            dyncode.Text, ['lodel_id'], [], order = [('title', 'ASC')],
+            batch_size = 10))
+        self.assertEqual(res, [{'lodel_id': 1}, {'lodel_id': 2}])
+        self.assertEqual(
+            self.database['Section'].find.return_value.batch, 10)
+        _, kwargs = self.database['Section'].find.call_args
+        self.assertEqual(
+            kwargs['projection'], {'lodel_id': 1, 'title': 1, '_id': 0})
+
+
+class MockCounters(object):
+    """ counters collection mock implementing the atomic $inc and the $max
+        upsert """
+
+    def __init__(self):
+        self.seqs = dict()
+        self.lock = threading.Lock()
+
+    def find_one_and_update(self, query, update, return_document = None):
+        with self.lock:
+            if query['_id'] not in self.seqs:
+                return None
+            self.seqs[query['_id']] += update['$inc']['seq']
+            return {'_id': query['_id'], 'seq': self.seqs[query['_id']]}
+
+    def update_one(self, query, update, upsert = False):
+        with self.lock:
+            self.seqs[query['_id']] = max(
+                self.seqs.get(query['_id'], 0), update['$max']['seq'])
+
+
+@unittest.skipIf(pymongo is None, "pymongo is not installed")
+class IdsAllocatorTestCase(unittest.TestCase):
+    """ Testing the hi/lo ids allocator """
+
+    def setUp(self):
+        self.counters = mock.MagicMock(wraps = MockCounters())
+
+    def allocator(self, ids_block_size = 5, max_id = 7):
+        """ Returns a datasource sharing the counters collection, max_id is
+            the greatest existing id """
+        datasource, database = mongo_datasource(
+            ids_block_size = ids_block_size)
+        database.collections['counters'] = self.counters
+        datasource.select = mock.MagicMock(
+            return_value = [{'lodel_id': max_id}] if max_id else [])
+        return datasource
+
+    def test_counter_seeding(self):
+        """ Testing the counter creation from the greatest existing id """
+        datasource = self.allocator()
+        self.assertEqual(datasource.reserve_ids(dyncode.Person, 3), [8, 9, 10])
+        name = mongo_utils.object_collection_name(dyncode.Person.uid_source())
+        inc = mock.call({'_id': name}, {'$inc': {'seq': 5}},
+            return_document = pymongo.ReturnDocument.AFTER)
+        self.assertEqual(self.counters.find_one_and_update.mock_calls,
+            [inc, inc])
+        self.counters.update_one.assert_called_once_with(
+            {'_id': name}, {'$max': {'seq': 7}}, upsert = True)
+        datasource.select.assert_called_once_with(
+            dyncode.Person.uid_source(), field_list = ['lodel_id'],
+            filters = [], order = [('lodel_id', 'DESC')], limit = 1)
+        # Existing counter : no seeding
+        self.assertEqual(
+            self.allocator(max_id = 42).reserve_ids(dyncode.Person, 1), [13])
+        self.counters.update_one.assert_called_once()
+        datasource.select.assert_called_once()
+
+    def test_counter_seeding_empty(self):
+        """ Testing the counter creation without any existing object """
+        datasource = self.allocator(max_id = None)
+        self.assertEqual(datasource.reserve_ids(dyncode.Person, 2), [1, 2])
+        self.counters.update_one.assert_called_once_with(
+            mock.ANY, {'$max': {'seq': 0}}, upsert = True)
+
+    def test_counter_failure(self):
+        """ Testing the error raised when the counter cannot be created """
+        datasource = self.allocator()
+        self.counters.find_one_and_update.return_value = None
+        with self.assertRaises(MongoDbDataSourceError):
+            datasource.reserve_ids(dyncode.Person, 1)
+        self.assertEqual(self.counters.find_one_and_update.call_count, 2)
+
+    def test_block_refill(self):
+        """ Testing that the counter is incremented once per block """
+        datasource = self.allocator()
+        self.assertEqual(datasource.reserve_ids(dyncode.Person, 0), [])
+        self.assertEqual(datasource.reserve_ids(dyncode.Person, 2), [8, 9])
+        self.assertEqual(
+            datasource.reserve_ids(dyncode.Person, 3), [10, 11, 12])
+        self.assertEqual(self.counters.find_one_and_update.call_count, 2)
+        # Block exhausted : the remaining ids are taken from a new block
+        self.assertEqual(datasource.reserve_ids(dyncode.Person, 2), [13, 14])
+        self.assertEqual(self.counters.find_one_and_update.call_count, 3)
+        self.assertEqual(self.counters.find_one_and_update.call_args[0][1],
+            {'$inc': {'seq': 5}})
+
+    def test_large_reservation(self):
+        """ Testing that reservations larger than a block are contiguous """
+        datasource = self.allocator()
+        self.assertEqual(datasource.reserve_ids(dyncode.Person, 1), [8])
+        self.assertEqual(
+            datasource.reserve_ids(dyncode.Person, 10), list(range(9, 19)))
+        self.assertEqual(self.counters.find_one_and_update.call_args[0][1],
+            {'$inc': {'seq': 6}})
+        self.assertEqual(datasource.reserve_ids(dyncode.Person, 1), [19])
+
+    def test_concurrent_allocators(self):
+        """ Testing that concurrent allocators never reserve the same id """
+        allocators = [self.allocator(ids_block_size = size)
+                      for size in (1, 3, 5)]
+        results = list()
+
+        def reserve(datasource, n):
+            ids = list()
+            for i in range(50):
+                ids.extend(datasource.reserve_ids(dyncode.Person, n))
+            results.append(ids)
+
+        # Threads sharing a datasource and datasources sharing a counter
+        threads = [threading.Thread(target = reserve, args = (datasource, n))
+                   for datasource in allocators for n in (1, 2, 7)]
+        threads.extend(
+            threading.Thread(target = reserve, args = (allocators[2], 4))
+            for _ in range(4))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ids = list(itertools.chain.from_iterable(results))
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(len(ids), 50 * (3 * 10 + 4 * 4))
+        self.assertGreater(min(ids), 7)
+
+
+def add_requests(uid, fname, values):
+    """ Returns the requests adding values in a multiple back reference """
+    return [
+        pymongo.UpdateOne({'lodel_id': uid, fname: {'$type': 'array'}},
+            {'$addToSet': {fname: {'$each': values}}}),
+        pymongo.UpdateOne({'lodel_id': uid, fname: None},
+            {'$set': {fname: values}})]
+
+
+def pull_requests(uid, fname, values):
+    """ Returns the requests removing values from a multiple back reference
+    """
+    return [pymongo.UpdateOne({'lodel_id': uid, fname: {'$type': 'array'}},
+        {'$pull': {fname: {'$in': values}}})]
+
+
+@unittest.skipIf(pymongo is None, "pymongo is not installed")
+class BackReferencesTestCase(unittest.TestCase):
+    """ Testing the back references bulk requests """
+
+    def setUp(self):
+        self.datasource, self.database = mongo_datasource()
+
+    def assert_requests(self, coll_names, requests):
+        """ Asserts that requests were sent unordered in a single bulk write
+            on each given collection """
+        for coll_name in coll_names:
+            self.database[coll_name].bulk_write.assert_called_once_with(
+                requests, ordered = False)
+
+    def test_insert(self):
+        """ Testing back references of an inserted object """
+        datas = {'lodel_id': 1, 'linked_texts': [3, 4]}
+        self.datasource.insert(dyncode.Person, datas)
+        self.database['Person'].insert_one.assert_called_once_with(datas)
+        # Text is abstract : requests are sent to the child collections
+        self.assert_requests(['Section', 'Subsection'],
+            add_requests(3, 'linked_persons', [1])
+            + add_requests(4, 'linked_persons', [1]))
+
+    def test_update(self):
+        """ Testing back references of an updated object """
+        self.database['Person'].find.return_value = [
+            {'lodel_id': 1, 'linked_texts': [3, 4]}]
+        self.datasource.update(dyncode.Person, [('lodel_id', '=', 1)], [],
+            {'linked_texts': [4, 5]})
+        self.database['Person'].update_many.assert_called_once_with(
+            mock.ANY, {'$set': {'linked_texts': [4, 5]}})
+        self.assert_requests(['Section', 'Subsection'],
+            pull_requests(3, 'linked_persons', [1])
+            + add_requests(5, 'linked_persons', [1]))
+
+    def test_update_unchanged(self):
+        """ Testing that unchanged references give no request """
+        self.database['Person'].find.return_value = [
+            {'lodel_id': 1, 'linked_texts': [3]}]
+        self.datasource.update(dyncode.Person, [('lodel_id', '=', 1)], [],
+            {'linked_texts': [3], 'firstname': 'foo'})
+        self.database['Section'].bulk_write.assert_not_called()
+
+    def test_delete(self):
+        """ Testing that back references are updated before deletion """
+        manager = mock.Mock()
+        manager.attach_mock(self.database['Section'].bulk_write, 'bulk_write')
+        manager.attach_mock(self.database['Person'].delete_many, 'delete_many')
+        self.database['Person'].find.return_value = [
+            {'lodel_id': 1, 'linked_texts': [3]},
+            {'lodel_id': 2, 'linked_texts': [3, 4]}]
+        self.datasource.delete(dyncode.Person, [('lodel_id', '>', 0)], [])
+        self.assert_requests(['Section', 'Subsection'],
+            pull_requests(3, 'linked_persons', [1, 2])
+            + pull_requests(4, 'linked_persons', [2]))
+        self.assertEqual([name for name, _, _ in manager.mock_calls],
+            ['bulk_write', 'delete_many'])
+
+    def test_set_and_dict_values(self):
+        """ Testing back references of set and dict reference fields """
+        for handler_cls, old_value, new_value in (
+                (Set, {3, 4}, {4, 5}),
+                (Map, {3: 'a', 4: 'b'}, {4: 'b', 5: 'c'})):
+            datasource, database = mongo_datasource()
+            handler = handler_cls(
+                back_reference = (dyncode.Text, 'linked_persons'),
+                allowed_classes = [dyncode.Text])
+            database['Person'].find.return_value = [
+                {'lodel_id': 1, 'linked_texts': old_value}]
+            with patch.object(dyncode.Person, 'reference_handlers',
+                    return_value = {'linked_texts': handler}):
+                datasource.update(dyncode.Person, [('lodel_id', '=', 1)], [],
+                    {'linked_texts': new_value})
+            database['Section'].bulk_write.assert_called_once_with(
+                pull_requests(3, 'linked_persons', [1])
+                + add_requests(5, 'linked_persons', [1]), ordered = False)
+
+    def test_single_back_reference(self):
+        """ Testing single back references set with $set """
+        self.datasource.insert(dyncode.Collection,
+            {'lodel_id': 2, 'publications': [10, 11]})
+        self.assert_requests(['Publication'], [
+            pymongo.UpdateOne({'lodel_id': 10}, {'$set': {'collection': 2}}),
+            pymongo.UpdateOne({'lodel_id': 11}, {'$set': {'collection': 2}})])
+        # Emptied single back references are set to the default value
+        self.database['Collection'].find.return_value = [
+            {'lodel_id': 2, 'publications': [10]}]
+        self.datasource.delete(dyncode.Collection, [('lodel_id', '=', 2)], [])
+        self.assertEqual(self.database['Publication'].bulk_write.call_args,
+            mock.call([pymongo.UpdateOne(
+                {'lodel_id': 10}, {'$set': {'collection': None}})],
+                ordered = False))
+
+    def test_single_reference(self):
+        """ Testing back references of a single reference field """
+        self.database['Publication'].find.return_value = [
+            {'lodel_id': 10, 'collection': 2}]
+        self.datasource.update(dyncode.Publication, [('lodel_id', '=', 10)],
+            [], {'collection': 3})
+        self.assert_requests(['Collection'],
+            pull_requests(2, 'publications', [10])
+            + add_requests(3, 'publications', [10]))
+
+    def test_coalesced_changes(self):
+        """ Testing that changes on a same object are coalesced """
+        self.datasource.insert_multi(dyncode.Person, [
+            {'lodel_id': 1, 'linked_texts': [3]},
+            {'lodel_id': 2, 'linked_texts': [3, 4]}])
+        self.assert_requests(['Section', 'Subsection'],
+            add_requests(3, 'linked_persons', [1, 2])
+            + add_requests(4, 'linked_persons', [2]))
+
+    def test_single_without_default(self):
+        """ Testing that emptying a single back reference without default
+            value raises """
+        handler = Link(allowed_classes = [dyncode.Collection],
+            back_reference = (dyncode.Collection, 'publications'))
+        self.database['Collection'].find.return_value = [
+            {'lodel_id': 2, 'publications': [10]}]
+        with patch.object(dyncode.Publication, 'data_handler',
+                return_value = handler):
+            with self.assertRaises(MongoDbConsistencyError):
+                self.datasource.delete(
+                    dyncode.Collection, [('lodel_id', '=', 2)], [])
+        self.database['Collection'].delete_many.assert_not_called()
+        self.database['Publication'].bulk_write.assert_not_called()
+
+    def test_check_backrefs(self):
+        """ Testing the back references checks """
+        datasource, database = mongo_datasource(check_backrefs = True)
+        database['Person'].find.return_value = [
+            {'lodel_id': 1, 'linked_texts': [3]}]
+        for sections, subsections in (
+                ([], []), # missing object
+                ([{'lodel_id': 3, 'linked_persons': [2]}], []), # not found
+                ([], [{'lodel_id': 4, 'linked_persons': [1]}]), # found
+                ):
+            database['Section'].find.return_value = sections
+            database['Subsection'].find.return_value = subsections
+            with self.assertRaises(MongoDbConsistencyError):
+                datasource.update(dyncode.Person, [('lodel_id', '=', 1)], [],
+                    {'linked_texts': [4]})
+        database['Section'].find.assert_called_with(
+            {'lodel_id': {'$in': [3, 4]}}, ['lodel_id', 'linked_persons'])
+        database['Section'].bulk_write.assert_not_called()
+        database['Section'].find.return_value = [
+            {'lodel_id': 3, 'linked_persons': [1]}]
+        database['Subsection'].find.return_value = [{'lodel_id': 4}]
+        datasource.update(dyncode.Person, [('lodel_id', '=', 1)], [],
+            {'linked_texts': [4]})
+        database['Subsection'].bulk_write.assert_called_once_with(
+            pull_requests(3, 'linked_persons', [1])
+            + add_requests(4, 'linked_persons', [1]), ordered = False)
+
+
+@unittest.skipIf(pymongo is None, "pymongo is not installed")
+class WriteBufferTestCase(unittest.TestCase):
+    """ Testing MongoWriteBuffer and bulk_write() batching """
+
+    def setUp(self):
+        self.database = MockDatabase()
+        self.manager = mock.Mock()
+
+    def watch(self, coll_name, method = 'bulk_write'):
+        """ Records the calls of a collection method in self.manager """
+        self.manager.attach_mock(
+            getattr(self.database[coll_name], method),
+            '%s_%s' % (coll_name, method))
+
+    def test_grouping(self):
+        """ Testing requests grouping per collection and ordered flag """
+        self.watch('A')
+        self.watch('B')
+        buffer = MongoWriteBuffer(self.database)
+        buffer.add('A', ['r1'])
+        buffer.add('A', ['r2', 'r3'])
+        buffer.add('B', ['r4'])
+        buffer.add('A', [])
+        buffer.add('A', ['r5'])
+        buffer.add('A', ['r6'], ordered = False)
+        buffer.add('A', ['r7'], ordered = False)
+        buffer.add('A', ['r8'])
+        self.assertEqual(len(buffer), 8)
+        self.manager.assert_not_called()
+        results = buffer.flush()
+        self.assertEqual(self.manager.mock_calls, [
+            mock.call.A_bulk_write(['r1', 'r2', 'r3'], ordered = True),
+            mock.call.B_bulk_write(['r4'], ordered = True),
+            mock.call.A_bulk_write(['r5'], ordered = True),
+            mock.call.A_bulk_write(['r6', 'r7'], ordered = False),
+            mock.call.A_bulk_write(['r8'], ordered = True)])
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(buffer), 0)
+        buffer.flush()
+        self.assertEqual(len(self.manager.mock_calls), 5)
+
+    def test_writes_on(self):
+        """ Testing the detection of buffered writes other than deletes """
+        buffer = MongoWriteBuffer(self.database)
+        buffer.add('A', ['d1'], deletes = True)
+        self.assertFalse(buffer.writes_on('A'))
+        buffer.add('A', ['r1'])
+        self.assertTrue(buffer.writes_on('A'))
+        self.assertFalse(buffer.writes_on('B'))
+        buffer.flush()
+        self.assertFalse(buffer.writes_on('A'))
+
+    def test_bulk_write(self):
+        """ Testing bulk_write() requests grouping and flush order """
+        datasource, self.database = mongo_datasource()
+        for coll_name in ('Person', 'Publication', 'Section', 'Subsection'):
+            self.watch(coll_name)
+        self.watch('Person', 'find')
+        self.database['Person'].find.return_value = [
+            {'lodel_id': 1, 'linked_texts': None}]
+        res = datasource.bulk_write([
+            ('insert', dyncode.Person, {'lodel_id': 1}),
+            ('insert', dyncode.Person, {'lodel_id': 2}),
+            ('update_many', dyncode.Person, [('lodel_id', '=', 2)], [],
+                {'firstname': 'foo'}),
+            ('insert', dyncode.Publication, {'lodel_id': 10}),
+            # Records are read after the pending writes are flushed
+            ('update', dyncode.Person, [('lodel_id', '=', 1)], [],
+                {'linked_texts': [3]}),
+            ('delete', dyncode.Publication, [('lodel_id', '=', 10)], [])])
+        self.assertEqual(res, [1, 2, None, 10, 1, 0])
+        process_filters = datasource._MongoDbDatasource__process_filters
+        mongo_filter = lambda uid: process_filters(
+            dyncode.Person, [('lodel_id', '=', uid)], [])
+        self.assertEqual(self.manager.mock_calls, [
+            mock.call.Person_bulk_write([
+                pymongo.InsertOne({'lodel_id': 1}),
+                pymongo.InsertOne({'lodel_id': 2}),
+                pymongo.UpdateMany(
+                    mongo_filter(2), {'$set': {'firstname': 'foo'}})],
+                ordered = True),
+            mock.call.Publication_bulk_write([
+                pymongo.InsertOne({'lodel_id': 10})], ordered = True),
+            mock.call.Person_find(mongo_filter(1)),
+            mock.call.Person_bulk_write([pymongo.UpdateMany(
+                mongo_filter(1), {'$set': {'linked_texts': [3]}})],
+                ordered = True),
+            mock.call.Publication_bulk_write([pymongo.DeleteMany(
+                {'lodel_id': 10})], ordered = True),
+            # Back references are written last, unordered
+            mock.call.Section_bulk_write(
+                add_requests(3, 'linked_persons', [1]), ordered = False),
+            mock.call.Subsection_bulk_write(
+                add_requests(3, 'linked_persons', [1]), ordered = False)])
+
+    def test_write_concern(self):
+        """ Testing the write concern options """
+        datasource, database = mongo_datasource()
+        self.assertIsNone(database.options)
+        datasource, database = mongo_datasource(write_concern_w = 'majority',
+            write_concern_j = True, write_concern_wtimeout = '1000')
+        self.assertEqual(database.options, {'write_concern':
+            pymongo.WriteConcern(w = 'majority', j = True, wtimeout = 1000)})
+        datasource, database = mongo_datasource(write_concern_w = '2')
+        self.assertEqual(database.options,
+            {'write_concern': pymongo.WriteConcern(w = 2)})
+        with self.assertRaises(MongoDbDataSourceError):
+            mongo_datasource(write_concern_w = '0')
+
+
+@unittest.skipIf(pymongo is None, "pymongo is not installed")
+class FiltersCacheTestCase(unittest.TestCase):
+    """ Testing the memoization of relational filters subqueries """
+
+    ## @brief Texts linked to a person named foo
+    rfilters = [(('linked_persons', {dyncode.Person: 'lastname'}), '=', 'foo')]
+
+    def setUp(self):
+        self.datasource, self.database = mongo_datasource(
+            relational_lookup = False)
+        self.database['Person'].find.return_value = [{'lodel_id': 5}]
+
+    def assert_subqueries(self, count):
+        """ Asserts the number of subqueries run """
+        self.assertEqual(self.database['Person'].find.call_count, count)
+
+    def test_memoization(self):
+        """ Testing that a subquery runs once by datasource call """
+        self.datasource.select(dyncode.Text, ['lodel_id'], [], self.rfilters)
+        self.assert_subqueries(1)
+        for coll_name in ('Section', 'Subsection'):
+            mongo_filters = self.database[coll_name].find.call_args[0][0]
+            self.assertEqual(mongo_filters['linked_persons'], {'$in': [5]})
+        # The cache is emptied at the end of the call
+        self.datasource.select(dyncode.Text, ['lodel_id'], [], self.rfilters)
+        self.assert_subqueries(2)
+        # Calls in a scope share the cache
+        with self.datasource._filters_scope():
+            self.datasource.select(
+                dyncode.Section, ['lodel_id'], [], self.rfilters)
+            self.datasource.count(dyncode.Section, [], self.rfilters)
+        self.assert_subqueries(3)
+
+    def test_write_invalidation(self):
+        """ Testing that writes empty the cache of the scope """
+        with self.datasource._filters_scope():
+            self.datasource.select(
+                dyncode.Section, ['lodel_id'], [], self.rfilters)
+            self.datasource.insert(dyncode.Person, {'lodel_id': 6})
+            self.datasource.select(
+                dyncode.Section, ['lodel_id'], [], self.rfilters)
+        self.assert_subqueries(2)
+
+    def test_abstract_writes(self):
+        """ Testing that the writes on each child class of an abstract class
+            empty the cache """
+        self.datasource.update_many(
+            dyncode.Text, [], self.rfilters, {'subtitle': 'bar'})
+        self.assert_subqueries(2)
+        self.database['Section'].find.return_value = [
+            {'lodel_id': 1, 'linked_persons': [5]}]
+        self.datasource.delete(dyncode.Text, [], self.rfilters)
+        self.assert_subqueries(4)
+        self.database['Person'].bulk_write.assert_called_once_with(
+            pull_requests(5, 'linked_texts', [1]), ordered = False)
+
+
+@unittest.skipIf(pymongo is None, "pymongo is not installed")
+class RelationalLookupTestCase(unittest.TestCase):
+    """ Testing the relational filters $lookup stages """
+
+    def setUp(self):
+        self.datasource, self.database = mongo_datasource(
+            relational_lookup = True)
+
+    def pipeline(self, coll_name):
+        """ Returns the pipeline of the aggregation run on a collection """
+        self.database[coll_name].aggregate.assert_called_once()
+        return self.database[coll_name].aggregate.call_args[0][0]
+
+    def test_default(self):
+        """ Testing that relational filters are resolved by subqueries by
+            default """
+        datasource, database = mongo_datasource()
+        database['Person'].find.return_value = [{'lodel_id': 5}]
+        datasource.select(dyncode.Section, ['lodel_id'], [],
+            [(('linked_persons', {dyncode.Person: 'lastname'}), '=', 'foo')])
+        database['Section'].aggregate.assert_not_called()
+        database['Person'].find.assert_called_once()
+        mongo_filters = database['Section'].find.call_args[0][0]
+        self.assertEqual(mongo_filters, {'linked_persons': {'$in': [5]}})
+
+    def test_single_class(self):
+        """ Testing the pipeline of a filter on a single referenced class """
+        self.database['Section'].aggregate.return_value = []
+        self.datasource.select(dyncode.Section, ['lodel_id'],
+            [('title', '=', 'bar')],
+            [(('linked_persons', {dyncode.Person: 'lastname'}), '=', 'foo')],
+            order = [('lodel_id', 'ASC')], limit = 2, offset = 1)
+        self.assertEqual(self.pipeline('Section'), [
+            {'$match': {'title': 'bar'}},
+            {'$lookup': {'from': 'Person', 'localField': 'linked_persons',
+                'foreignField': 'lodel_id', 'as': '_lookup_0'}},
+            {'$match': {'_lookup_0': {'$elemMatch': {
+                'lastname': {'$eq': 'foo'}}}}},
+            {'$project': {'_lookup_0': 0}},
+            {'$sort': {'lodel_id': 1}},
+            {'$skip': 1},
+            {'$limit': 2},
+            {'$project': {'lodel_id': 1, '_id': 0}}])
+        # No subquery is run
+        self.database['Person'].find.assert_not_called()
+        self.database['Section'].find.assert_not_called()
+
+    def test_multiple_classes(self):
+        """ Testing the pipeline of filters on an abstract referenced class
+            and on several fields """
+        self.datasource.count(dyncode.Person, [],
+            [(('linked_texts', {dyncode.Text: 'title'}), '=', 'foo'),
+             (('linked_texts', {dyncode.Text: 'subtitle'}), '=', 'bar'),
+             (('alias', {dyncode.Person: 'lastname'}), '=', 'baz')])
+        self.assertEqual(self.pipeline('Person'), [
+            {'$lookup': {'from': 'Section', 'localField': 'linked_texts',
+                'foreignField': 'lodel_id', 'as': '_lookup_0'}},
+            {'$lookup': {'from': 'Subsection', 'localField': 'linked_texts',
+                'foreignField': 'lodel_id', 'as': '_lookup_1'}},
+            {'$lookup': {'from': 'Person', 'localField': 'alias',
+                'foreignField': 'lodel_id', 'as': '_lookup_2'}},
+            {'$match': {'$and': [
+                {'$or': [
+                    {'_lookup_0': {'$elemMatch': {
+                        'title': {'$eq': 'foo'},
+                        'subtitle': {'$eq': 'bar'}}}},
+                    {'_lookup_1': {'$elemMatch': {
+                        'title': {'$eq': 'foo'},
+                        'subtitle': {'$eq': 'bar'}}}}]},
+                {'_lookup_2': {'$elemMatch': {
+                    'lastname': {'$eq': 'baz'}}}}]}},
+            {'$project': {'_lookup_0': 0, '_lookup_1': 0, '_lookup_2': 0}},
+            {'$count': 'count'}])
+
+    def test_other_datasource(self):
+        """ Testing that referenced classes of other datasources are
+            resolved by subqueries """
+        self.database['Section'].find.return_value = [{'lodel_id': 5}]
+        self.datasource.select(dyncode.Indextheme, ['lodel_id'], [],
+            [(('texts', {dyncode.Text: 'title'}), '=', 'foo')])
+        self.database['Indextheme'].aggregate.assert_not_called()
+        self.database['Indextheme'].find.assert_called_once()
+
+
+@unittest.skipIf(pymongo is None, "pymongo is not installed")
+class UpdateQueryBackReferencesTestCase(unittest.TestCase):
+    """ Testing the back references updates of LeUpdateQuery operations """
+
+    def setUp(self):
+        self.datasource, self.database = mongo_datasource()
+
+    def run_update(self, target, query_filters, data, stored):
+        """ Runs the operations of an update query on the stored records
+            through bulk_write() """
+        # the missing fields are stored as None
+        stored = [dict(dict.fromkeys(target.fieldnames(True)), **record)
+                  for record in stored]
+        self.database[target.__name__].find.return_value = MockCursor(
+            dict(record) for record in stored)
+        # The referenced objects are not stored : the consistency checks
+        # fetching them are disabled
+        with patch.object(target, '_ro_datasource', self.datasource), \
+                patch.object(target, '_check_datas_consistency'):
+            query = LeUpdateQuery(target, query_filters)
+            ops = query._bulk_ops(query._check_data(data))
+        self.database[target.__name__].find.return_value = [
+            dict(record) for record in stored]
+        self.datasource.bulk_write(ops)
+        return ops
+
+    def test_constructed_field(self):
+        """ Testing that updating a field constructed per record keeps the
+            back references """
+        ops = self.run_update(dyncode.Person, [('lastname', '=', 'foo')],
+            {'firstname': 'b'}, [{'lodel_id': 5, 'classname': 'Person',
+                'firstname': 'a', 'lastname': 'foo', 'fullname': 'a foo',
+                'linked_texts': [7, 8]}])
+        self.assertEqual(ops[-1][:4],
+            ('update', dyncode.Person, [('lodel_id', '=', 5)], []))
+        self.assertEqual(ops[-1][4]['fullname'], 'b foo')
+        self.assertEqual(ops[-1][4]['linked_texts'], [7, 8])
+        self.database['Section'].bulk_write.assert_not_called()
+        self.database['Subsection'].bulk_write.assert_not_called()
+
+    def test_one_back_reference(self):
+        """ Testing that updating a back referenced field keeps the other
+            ones """
+        self.run_update(dyncode.Section, [('title', '=', 'foo')],
+            {'linked_persons': [1]}, [{'lodel_id': 7, 'classname': 'Section',
+                'title': 'foo', 'linked_persons': [], 'indexes': [9]}])
+        self.database['Person'].bulk_write.assert_called_once_with(
+            add_requests(1, 'linked_texts', [7]), ordered = False)
+        self.database['Indextheme'].bulk_write.assert_not_called()
+
+
+@unittest.skipIf(pymongo is None, "pymongo is not installed")
+class AggregateTestCase(unittest.TestCase):
+    """ Testing the aggregation pipelines """
+
+    def setUp(self):
+        self.datasource, self.database = mongo_datasource()
+
+    def pipeline(self, coll_name):
+        """ Returns the pipeline of the aggregation run on a collection """
+        self.database[coll_name].aggregate.assert_called_once()
+        return self.database[coll_name].aggregate.call_args[0][0]
+
+    def test_pipeline(self):
+        """ Testing the stages of a grouped aggregation """
+        rows = [{'subtitle': 'a', 'n': 2, 'last': 4}]
+        self.database['Section'].aggregate.return_value = iter(rows)
+        res = self.datasource.aggregate(dyncode.Section,
+            [('title', '=', 'foo')], [], ['subtitle'],
+            OrderedDict([('n', ('count', None)),
+                ('last', ('max', 'lodel_id'))]),
+            order = [('n', 'DESC')], limit = 5, offset = 2)
+        self.assertEqual(res, rows)
+        self.assertEqual(self.pipeline('Section'), [
+            {'$match': {'title': 'foo'}},
+            {'$group': {'_id': SON([('subtitle', '$subtitle')]),
+                'n': {'$sum': 1}, 'last': {'$max': '$lodel_id'}}},
+            {'$project': {'_id': 0, 'subtitle': '$_id.subtitle',
+                'n': 1, 'last': 1}},
+            {'$sort': SON([('n', -1)])},
+            {'$skip': 2},
+            {'$limit': 5}])
+
+    def test_count(self):
+        """ Testing the count metric without group """
+        self.database['Person'].aggregate.return_value = iter([{'total': 3}])
+        res = self.datasource.aggregate(
+            dyncode.Person, [], [], [], {'total': ('count', None)})
+        self.assertEqual(res, [{'total': 3}])
+        self.assertEqual(self.pipeline('Person'), [
+            {'$group': {'_id': None, 'total': {'$sum': 1}}},
+            {'$project': {'_id': 0, 'total': 1}}])
+
+    def test_multiple_reference(self):
+        """ Testing that multiple references group fields are unwinded """
+        self.datasource.aggregate(dyncode.Person, [], [],
+            ['linked_texts', 'lastname'], {'n': ('count', None)})
+        self.assertEqual(self.pipeline('Person'), [
+            {'$unwind': '$linked_texts'},
+            {'$group': {
+                '_id': SON([('linked_texts', '$linked_texts'),
+                    ('lastname', '$lastname')]),
+                'n': {'$sum': 1}}},
+            {'$project': {'_id': 0, 'linked_texts': '$_id.linked_texts',
+                'lastname': '$_id.lastname', 'n': 1}}])
+
+    def test_select_group(self):
+        """ Testing that a grouped select returns the distinct values of the
+            group fields """
+        rows = [{'lastname': 'bar'}, {'lastname': 'foo'}]
+        self.database['Person'].aggregate.return_value = iter(rows)
+        res = self.datasource.select(dyncode.Person, ['lastname'],
+            [('firstname', '=', 'a')], group = [('lastname', 'ASC')],
+            limit = 2, offset = 1)
+        self.assertEqual(res, rows)
+        self.assertEqual(self.pipeline('Person'), [
+            {'$match': {'firstname': 'a'}},
+            {'$group': {'_id': SON([('lastname', '$lastname')])}},
+            {'$project': {'_id': 0, 'lastname': '$_id.lastname'}},
+            {'$sort': SON([('lastname', 1)])},
+            {'$skip': 1},
+            {'$limit': 2}])
+        self.database['Person'].find.assert_not_called()
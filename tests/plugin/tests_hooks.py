@@ -79,3 +79,40 @@ class HookTestCase(unittest.TestCase):
         result = LodelHook.call_hook(testhook, 'me', 'WootWoot')
         self.assertEqual(result, '1234WootWoot')
 
+
+    def test_same_priority_order(self):
+        """ Testing that hooks with the same priority are called in
+            registration order """
+        for char in 'abc':
+            LodelHook(testhook, 10)(
+                lambda name, caller, payload, char = char: payload + char)
+        LodelHook(testhook, 1)(lambda name, caller, payload: payload + '0')
+        self.assertEqual(LodelHook.call_hook(testhook, 'me', ''), '0abc')
+
+    def test_no_hook(self):
+        """ Testing that the payload is returned when no hook is
+            registered """
+        payload = object()
+        self.assertIs(LodelHook.call_hook(testhook, 'me', payload), payload)
+
+    def test_stats(self):
+        """ Testing hooks calls count and timing """
+        @LodelHook(testhook)
+        def stats_hook(name, caller, payload):
+            return payload
+        LodelHook.call_hook(testhook, 'me', None)
+        self.assertEqual(
+            LodelHook.hook_stats(), {testhook: [(stats_hook, 0xFFFF, 0, 0)]})
+        LodelHook.set_stats(True)
+        try:
+            for _ in range(3):
+                LodelHook.call_hook(testhook, 'me', None)
+        finally:
+            LodelHook.set_stats(False)
+        (hook, _, calls, total_time), = LodelHook.hook_stats([testhook])[
+            testhook]
+        self.assertIs(hook, stats_hook)
+        self.assertEqual(calls, 3)
+        self.assertGreater(total_time, 0)
+        LodelHook.reset_stats()
+        self.assertEqual(LodelHook.hook_stats()[testhook][0][2:], (0, 0))